@@ -0,0 +1,284 @@
+"""Parallel, time sharded backfill of a historical CTM360 range.
+
+The range is split into shards that are walked at the same time, each from
+its own added_after and with its own cursor and checkpoint. Pages are
+fetched, transformed and packed in a process pool; the batches they produce
+go through the uploader of the parent process, and the checkpoint of a
+shard only moves past a page once all of its batches are acknowledged.
+
+A shard is over when the feed is exhausted or when it reaches indicators
+added after the end of the shard, which the next shard covers. Pages are
+expected in the order the indicators were added to CTM360, recorded in the
+``created_at`` attribute of the CTM extension.
+"""
+
+import itertools
+from concurrent import futures
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from urllib.parse import quote
+
+import requests
+
+import retry
+import transformer
+import transport
+import utils
+from checkpoint import Checkpoint, CheckpointStore, NO_MORE_DATA
+from pipeline import FetchError, UploadError, acked_position
+
+# Pages of a shard waiting for their uploads, before the next one is fetched.
+_MAX_PENDING_PAGES = 2
+
+
+def parse_time(value: str) -> datetime:
+    """Parses an ISO 8601 timestamp, naive ones being UTC."""
+    parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed
+
+
+@dataclass
+class Shard:
+    """A slice of the backfill range.
+
+    Attributes:
+      start (str): added_after of the first page, ISO 8601.
+      end (str): Indicators added from this time on belong to the next shard.
+    """
+    start: str
+    end: str
+
+    @property
+    def key(self) -> str:
+        """Name of the shard checkpoint."""
+        return "BACKFILL_" + parse_time(self.start).strftime("%Y%m%dT%H%M%S")
+
+
+def split_range(start: str, end: str, count: int) -> List[Shard]:
+    """Splits [start, end) into count shards of the same duration."""
+    first, last = parse_time(start), parse_time(end)
+    if last <= first:
+        raise ValueError("The end of the backfill range must follow its start.")
+    count = max(1, count)
+    step = (last - first) / count
+    bounds = [first + step * i for i in range(count)] + [last]
+    return [Shard(a.isoformat(), b.isoformat()) for a, b in zip(bounds, bounds[1:])]
+
+
+@dataclass
+class FetchConfig:
+    """What a worker process needs to fetch and pack pages.
+
+    Attributes:
+      url_base (str): CTM collection endpoint, without query string.
+      headers (dict): Headers of the CTM requests.
+      customer_id (str): Chronicle customer ID.
+      max_size (int): Maximum size of a batchCreate body, in bytes.
+      max_attempts (int): Attempts made for a CTM page.
+    """
+    url_base: str
+    headers: Dict[str, str]
+    customer_id: str
+    max_size: int
+    max_attempts: int = 5
+
+
+@dataclass
+class PageResult:
+    """A page fetched and packed by a worker process.
+
+    Attributes:
+      batches (list): Packed batchCreate bodies.
+      next (str): Cursor of the following page.
+      done (bool): True when the shard has no page after this one.
+    """
+    batches: List[utils.Batch]
+    next: str
+    done: bool
+
+
+# State of the worker processes, set by _init_worker.
+_worker: Dict[str, Any] = {}
+
+
+def _init_worker(config: FetchConfig):
+    _worker["config"] = config
+    _worker["http"] = transport.Transport.from_env()
+    _worker["policy"] = retry.RetryPolicy(config.max_attempts)
+
+
+def _fetch_page(shard: Shard, cursor: str, skip: int) -> PageResult:
+    """Fetches, transforms and packs a page of a shard, in a worker process."""
+    config = _worker["config"]
+    if cursor:
+        url = f"{config.url_base}?next={cursor}"
+    else:
+        # the "+" of the UTC offset would be read as a space
+        url = f"{config.url_base}?added_after={quote(shard.start)}"
+    # the errors are raised as FetchError, which pickles back to the parent
+    # process, where the run saves the checkpoints of the other shards
+    try:
+        response = _worker["policy"].call(
+            lambda: _worker["http"].get(url, headers=config.headers))
+    except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+        raise FetchError(str(e), 0) from e
+    if response.status_code != 200:
+        raise FetchError(response.text, response.status_code)
+    end = parse_time(shard.end)
+    try:
+        data = response.json()
+        objects = [
+            obj for obj in data['objects']
+            if parse_time(obj['extensions'][transformer.CTM_EXTENSION]['created_at']) < end
+        ]
+        past_end = len(objects) < len(data['objects'])
+        events = itertools.islice(transformer.iter_transform(objects, utils.now()), skip, None)
+        batches = list(utils.pack_entities(events, config.customer_id, config.max_size))
+        return PageResult(batches, data.get('next', ""), past_end or not data['more'])
+    except (KeyError, TypeError, ValueError) as e:
+        raise FetchError(f"Malformed CTM page: {e!r}", 502) from e
+
+
+@dataclass
+class _ShardRun:
+    shard: Shard
+    store: CheckpointStore
+    checkpoint: Checkpoint
+    fetch: Optional[futures.Future] = None
+    # (checkpoint after the page, skip of the page, upload futures with the
+    # position in the page reached once each is acknowledged)
+    pending: List[Tuple[Checkpoint, int, List[Tuple[futures.Future, Checkpoint]]]] = field(default_factory=list)
+    done: bool = False
+
+
+class Backfill:
+    """Walks the shards of a range concurrently.
+
+    Args:
+      config (FetchConfig): Passed to the worker processes.
+      uploader (BatchUploader): Uploader shared by all the shards.
+      store_for (Callable[[str], CheckpointStore]): Returns the checkpoint
+        store of a shard from its key.
+      processes (int): Worker processes, defaults to one per shard.
+    """
+
+    def __init__(
+        self,
+        config: FetchConfig,
+        uploader: Any,
+        store_for: Callable[[str], CheckpointStore],
+        processes: Optional[int] = None,
+    ):
+        self.config = config
+        self.uploader = uploader
+        self.store_for = store_for
+        self.processes = processes
+
+    def run(self, shards: List[Shard],
+            should_stop: Callable[[], bool] = lambda: False) -> str:
+        """Ingests the shards.
+
+        Args:
+          shards (List[Shard]): Shards of the range, see split_range.
+          should_stop (Callable[[], bool]): Checked before each page fetch; a
+            True value stops the run once the pages in flight are uploaded.
+
+        Returns:
+          str: "ok" when every shard is complete, "TIMEOUT" when stopped.
+
+        Raises:
+          FetchError, UploadError: When a page can not be fetched or sent,
+            after the checkpoints of the other shards have been saved.
+        """
+        runs = []
+        for shard in shards:
+            store = self.store_for(shard.key)
+            cp = store.load()
+            runs.append(_ShardRun(shard, store, cp, done=cp.next == NO_MORE_DATA))
+        stopped = False
+        with futures.ProcessPoolExecutor(
+                max_workers=self.processes or max(1, len(shards)),
+                initializer=_init_worker, initargs=(self.config,)) as pool:
+            try:
+                while True:
+                    stopped = stopped or should_stop()
+                    for run in runs:
+                        self._commit(run)
+                        if (not run.done and not stopped and run.fetch is None
+                                and len(run.pending) < _MAX_PENDING_PAGES):
+                            cursor, skip = self._next_page(run)
+                            run.fetch = pool.submit(_fetch_page, run.shard, cursor, skip)
+                    waiting = [f for run in runs for f in self._waiting(run)]
+                    if not waiting:
+                        break
+                    futures.wait(waiting, return_when=futures.FIRST_COMPLETED)
+                    for run in runs:
+                        if run.fetch is not None and run.fetch.done():
+                            self._uploads(run, run.fetch.result())
+            except (FetchError, UploadError):
+                for run in runs:
+                    self._abort(run)
+                raise
+            finally:
+                # the stores may hold the last checkpoint back, see
+                # checkpoint.ThrottledCheckpointStore
+                for run in runs:
+                    run.store.flush()
+        return "TIMEOUT" if stopped and not all(run.done for run in runs) else "ok"
+
+    @staticmethod
+    def _next_page(run: _ShardRun) -> Tuple[str, int]:
+        """Cursor and skip of the page following the pending ones."""
+        last = run.pending[-1][0] if run.pending else run.checkpoint
+        return last.next, last.offset
+
+    @staticmethod
+    def _waiting(run: _ShardRun) -> List[futures.Future]:
+        waiting = [f for _, _, uploads in run.pending for f, _ in uploads if not f.done()]
+        if run.fetch is not None:
+            waiting.append(run.fetch)
+        return waiting
+
+    def _uploads(self, run: _ShardRun, result: PageResult):
+        cursor, skip = self._next_page(run)
+        run.fetch = None
+        after = Checkpoint(NO_MORE_DATA if result.done else result.next)
+        uploads = []
+        done = skip
+        for batch in result.batches:
+            # the oversize entities dropped by pack_entities are passed too
+            done += batch.skipped + batch.count
+            uploads.append((self.uploader.submit(batch), Checkpoint(cursor, done)))
+        run.pending.append((after, skip, uploads))
+        if result.done:
+            run.done = True
+
+    def _commit(self, run: _ShardRun):
+        """Saves the checkpoint of the leading pages whose uploads are over.
+
+        A page stays pending until its uploads succeeded, so when one failed
+        _abort still saves the part of the page that was acknowledged.
+        """
+        while run.pending and all(f.done() for f, _ in run.pending[0][2]):
+            after, _, uploads = run.pending[0]
+            self.uploader.wait([f for f, _ in uploads])
+            run.pending.pop(0)
+            run.checkpoint = after
+            run.store.save(after)
+
+    def _abort(self, run: _ShardRun):
+        """Saves what a shard got acknowledged before an error stopped the run."""
+        if run.fetch is not None:
+            run.fetch.cancel()
+        for after, _, uploads in run.pending:
+            futures.wait([f for f, _ in uploads])
+            if any(f.exception() is not None for f, _ in uploads):
+                acked = acked_position(uploads)
+                if acked is not None:
+                    run.store.save(acked)
+                return
+            run.checkpoint = after
+            run.store.save(after)
@@ -0,0 +1,359 @@
+"""Offline ingestion of STIX export files, without the CTM360 API.
+
+A file holds STIX objects either as one JSON document, a bundle or a CTM
+page with an ``objects`` array or a bare array, or as JSON lines, one object
+(or bundle) per line; both may be gzipped. Only the objects carrying the
+CTM360 extension are converted, the other ones (identities, marking
+definitions...) are counted and skipped.
+
+Files are cut into chunks that a process pool parses, transforms and packs
+into batchCreate bodies. Uncompressed JSON lines files are memory-mapped and
+split on line boundaries, a worker only receives the byte range of its chunk
+and maps the file itself; the other files are read in this process, with
+the objects of a JSON document streamed by streaming.PageStream, and sent to
+the workers in lists of objects or blocks of lines. The batches go through a
+pipeline.BatchAccumulator, so the last batch of a chunk is merged with the
+first ones of the next, and are handed to the same uploader as the Cloud
+Function, or to a BatchWriter that writes them to disk.
+"""
+
+import gzip
+import itertools
+import json
+import mmap
+import os
+import threading
+import time
+from collections import deque
+from concurrent import futures
+from dataclasses import dataclass
+from typing import Any, Deque, Dict, Iterator, List, Optional, Tuple
+
+import transformer
+import utils
+from checkpoint import Checkpoint
+from pipeline import BatchAccumulator, UploadError, acked_position
+from streaming import PageStream
+from utils import Batch
+
+_GZIP_MAGIC = b"\x1f\x8b"
+_LINES_SUFFIXES = (".jsonl", ".ndjson")
+_READ_SIZE = 1 << 20
+
+
+@dataclass
+class Chunk:
+    """A part of a file, parsed and packed by a worker process.
+
+    Exactly one of the byte range, lines and objects is set.
+
+    Attributes:
+      path (str): File of the chunk.
+      start (int): Offset of the first line of the chunk, for a memory-mapped
+        JSON lines file.
+      end (int): Offset after its last line.
+      lines (bytes): JSON lines, for a gzipped JSON lines file.
+      objects (list): STIX objects, for a JSON document.
+    """
+    path: str
+    start: int = 0
+    end: int = 0
+    lines: Optional[bytes] = None
+    objects: Optional[List[Dict[str, Any]]] = None
+
+
+@dataclass
+class PackedChunk:
+    """The batches a worker process built from a chunk.
+
+    Attributes:
+      batches (list): Packed batchCreate bodies, in file order.
+      objects (int): STIX objects read.
+      skipped (int): Objects without the CTM360 extension.
+    """
+    batches: List[Batch]
+    objects: int
+    skipped: int
+
+
+def file_format(path: str) -> str:
+    """Returns "jsonl" for .jsonl and .ndjson files, gzipped or not, else "json"."""
+    name = path[:-3] if path.endswith(".gz") else path
+    return "jsonl" if name.endswith(_LINES_SUFFIXES) else "json"
+
+
+def _is_gzip(path: str) -> bool:
+    with open(path, "rb") as f:
+        return f.read(2) == _GZIP_MAGIC
+
+
+def _expand(value: Any) -> Iterator[Dict[str, Any]]:
+    """Yields the STIX objects of a decoded value, a bundle being expanded."""
+    if isinstance(value, list):
+        yield from value
+    elif isinstance(value, dict) and isinstance(value.get("objects"), list):
+        yield from value["objects"]
+    else:
+        yield value
+
+
+def _parse_lines(data: bytes) -> Iterator[Dict[str, Any]]:
+    for line in data.splitlines():
+        if line.strip():
+            yield from _expand(json.loads(line))
+
+
+def _stream_document(chunks: Iterator[bytes], first: bytes) -> Iterator[Dict[str, Any]]:
+    """Streams the objects of a JSON document, given its first bytes."""
+    if first.lstrip()[:1] == b"[":
+        # a bare array is read as the objects of a page
+        chunks = itertools.chain([b'{"objects":'], chunks, [b"}"])
+    return iter(PageStream(chunks))
+
+
+def _line_ranges(data: Any, chunk_bytes: int) -> Iterator[Tuple[int, int]]:
+    """Splits a memory-mapped file into ranges of whole lines."""
+    start = 0
+    while start < len(data):
+        end = data.find(b"\n", min(start + chunk_bytes, len(data)) - 1)
+        end = len(data) if end < 0 else end + 1
+        yield start, end
+        start = end
+
+
+def read_chunks(path: str, fmt: str = "auto", chunk_bytes: int = 8 << 20,
+                chunk_objects: int = 5000) -> Iterator[Chunk]:
+    """Cuts a file into chunks for the worker processes.
+
+    Args:
+      path (str): JSON or JSON lines file, gzipped or not.
+      fmt (str): "json", "jsonl" or "auto" to tell from the file name.
+      chunk_bytes (int): Bytes of JSON lines per chunk, rounded up to the
+        end of a line.
+      chunk_objects (int): Objects of a JSON document per chunk.
+
+    Yields:
+      Chunk: The chunks of the file, in order.
+    """
+    lines = (file_format(path) if fmt == "auto" else fmt) == "jsonl"
+    if _is_gzip(path):
+        with gzip.open(path, "rb") as f:
+            if lines:
+                while True:
+                    data = f.read(chunk_bytes) + f.readline()
+                    if not data:
+                        return
+                    yield Chunk(path, lines=data)
+            else:
+                objects = _stream_document(iter(lambda: f.read(_READ_SIZE), b""), f.peek(64))
+                yield from _object_chunks(path, objects, chunk_objects)
+        return
+    if os.path.getsize(path) == 0:
+        return
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        if lines:
+            for start, end in _line_ranges(data, chunk_bytes):
+                yield Chunk(path, start, end)
+        else:
+            blocks = (data[i:i + _READ_SIZE] for i in range(0, len(data), _READ_SIZE))
+            objects = _stream_document(blocks, data[:64])
+            yield from _object_chunks(path, objects, chunk_objects)
+
+
+def _object_chunks(path: str, objects: Iterator[Dict[str, Any]], size: int) -> Iterator[Chunk]:
+    while True:
+        block = list(itertools.islice(objects, size))
+        if not block:
+            return
+        yield Chunk(path, objects=block)
+
+
+# State of the worker processes, set by _init_worker.
+_worker: Dict[str, Any] = {}
+
+
+def _init_worker(customer_id: str, max_size: int):
+    _worker["customer_id"] = customer_id
+    _worker["max_size"] = max_size
+
+
+def _pack_chunk(chunk: Chunk) -> PackedChunk:
+    """Parses, transforms and packs a chunk, in a worker process."""
+    if chunk.objects is not None:
+        objects = chunk.objects
+    elif chunk.lines is not None:
+        objects = list(_parse_lines(chunk.lines))
+    else:
+        with open(chunk.path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            objects = list(_parse_lines(data[chunk.start:chunk.end]))
+    ctm = [obj for obj in objects
+           if isinstance(obj, dict) and transformer.CTM_EXTENSION in obj.get('extensions', ())]
+    events = transformer.iter_transform(ctm, utils.now())
+    batches = list(utils.pack_entities(events, _worker["customer_id"], _worker["max_size"]))
+    return PackedChunk(batches, len(objects), len(objects) - len(ctm))
+
+
+class BatchWriter:
+    """Stands in for the uploader of a dry run, writing the batches to disk.
+
+    Every batchCreate body is written as is to ``batch-NNNNNN.json`` in the
+    directory, so that they can be inspected or measured offline.
+
+    Args:
+      directory (str): Where the batches are written, created if missing.
+
+    Attributes:
+      batches (int): Batches written.
+      bytes (int): Bytes written.
+    """
+
+    concurrency = 1
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.batches = 0
+        self.bytes = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def submit(self, batch: Batch) -> futures.Future:
+        """Writes a batch, returning a future already holding its entity count."""
+        with self._lock:
+            self.batches += 1
+            self.bytes += len(batch.body)
+            path = os.path.join(self.directory, f"batch-{self.batches:06d}.json")
+        with open(path, "wb") as f:
+            f.write(batch.body)
+        future = futures.Future()
+        future.set_result(batch.count)
+        return future
+
+    @staticmethod
+    def wait(uploads: List[futures.Future]) -> int:
+        """Returns the entities of the batches written."""
+        return sum(future.result() for future in uploads)
+
+    def close(self):
+        """Nothing to release, for symmetry with BatchUploader."""
+
+
+class BulkIngest:
+    """Ingests STIX export files through a process pool.
+
+    Args:
+      customer_id (str): Chronicle customer ID of the batches.
+      uploader: BatchUploader posting the batches, or BatchWriter.
+      processes (int): Worker processes, defaults to the number of CPUs.
+      max_size (int): Maximum size of a batchCreate body, in bytes.
+      fmt (str): "json", "jsonl" or "auto" to tell from the file names.
+      chunk_bytes (int): Bytes of JSON lines per chunk.
+      chunk_objects (int): Objects of a JSON document per chunk.
+      metrics (metrics.Metrics): Receives the chunk and object counters and
+        the time spent waiting for the workers.
+    """
+
+    def __init__(
+        self,
+        customer_id: str,
+        uploader: Any,
+        processes: Optional[int] = None,
+        max_size: int = 1048576,
+        fmt: str = "auto",
+        chunk_bytes: int = 8 << 20,
+        chunk_objects: int = 5000,
+        metrics: Optional[Any] = None,
+    ):
+        self.customer_id = customer_id
+        self.uploader = uploader
+        self.processes = processes or os.cpu_count() or 1
+        self.max_size = max_size
+        self.fmt = fmt
+        self.chunk_bytes = chunk_bytes
+        self.chunk_objects = chunk_objects
+        self.metrics = metrics
+
+    def _count(self, name: str, value: float = 1):
+        if self.metrics is not None:
+            self.metrics.count(name, value)
+
+    def run(self, paths: List[str]) -> Dict[str, Any]:
+        """Ingests the files, in order.
+
+        Args:
+          paths (List[str]): The export files.
+
+        Returns:
+          dict: objects, skipped and entities counts, seconds and
+            entities_per_sec.
+
+        Raises:
+          UploadError: When a batch can not be sent, after the position
+            reached in the files has been printed.
+        """
+        started = time.perf_counter()
+        totals = {"objects": 0, "skipped": 0, "entities": 0}
+        accumulator = BatchAccumulator(self.max_size)
+        # uploads with the position in the files reached once they are acknowledged
+        inflight: List[Tuple[futures.Future, Checkpoint]] = []
+        position = {"path": None, "done": 0, "acked": None}
+        max_inflight = 2 * self.uploader.concurrency
+
+        def submit(batch, end):
+            while sum(not f.done() for f, _ in inflight) >= max_inflight:
+                futures.wait([f for f, _ in inflight], return_when=futures.FIRST_COMPLETED)
+            inflight.append((self.uploader.submit(batch), end))
+
+        def post(path: str, packed: PackedChunk):
+            if path != position["path"]:
+                position.update(path=path, done=0)
+            totals["objects"] += packed.objects
+            totals["skipped"] += packed.skipped
+            for batch in packed.batches:
+                begin = Checkpoint(path, position["done"])
+                position["done"] += batch.skipped + batch.count
+                if batch.skipped:
+                    self._count("pack.oversize", batch.skipped)
+                for ready in accumulator.add(batch, begin, Checkpoint(path, position["done"])):
+                    submit(*ready)
+            # the acknowledged uploads are released as the run goes
+            while len(inflight) > max_inflight and inflight[0][0].done():
+                future, position["acked"] = inflight.pop(0)
+                totals["entities"] += self.uploader.wait([future])
+
+        # only the chunks in the pool are held in memory
+        pending: Deque[Tuple[str, futures.Future]] = deque()
+        try:
+            with futures.ProcessPoolExecutor(
+                    max_workers=self.processes, initializer=_init_worker,
+                    initargs=(self.customer_id, self.max_size)) as pool:
+                for path in paths:
+                    for chunk in read_chunks(path, self.fmt, self.chunk_bytes, self.chunk_objects):
+                        self._count("bulk.chunks")
+                        pending.append((path, pool.submit(_pack_chunk, chunk)))
+                        if len(pending) >= 2 * self.processes:
+                            post(*self._next(pending))
+                while pending:
+                    post(*self._next(pending))
+            taken = accumulator.flush()
+            if taken is not None:
+                submit(*taken)
+            totals["entities"] += self.uploader.wait([f for f, _ in inflight])
+        except UploadError:
+            futures.wait([f for f, _ in inflight])
+            acked = acked_position(inflight) or position["acked"]
+            if acked is not None:
+                print(f"Entities acknowledged up to {acked.offset} of {acked.next}")
+            raise
+        seconds = time.perf_counter() - started
+        self._count("bulk.objects", totals["objects"])
+        self._count("bulk.skipped", totals["skipped"])
+        return dict(totals, seconds=round(seconds, 3),
+                    entities_per_sec=round(totals["entities"] / seconds, 1) if seconds else 0)
+
+    def _next(self, pending: Deque[Tuple[str, futures.Future]]) -> Tuple[str, PackedChunk]:
+        path, future = pending.popleft()
+        started = time.perf_counter()
+        packed = future.result()
+        if self.metrics is not None:
+            self.metrics.observe("bulk.wait", time.perf_counter() - started)
+        return path, packed
@@ -0,0 +1,254 @@
+"""Progress of the CTM360 ingestion, saved between invocations.
+
+A checkpoint holds the CTM ``next`` cursor of the page being ingested and
+the number of entities of that page Chronicle has already acknowledged, so
+a run that stops in the middle of a page resumes where it left off instead
+of sending the whole page again.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from dataclasses import asdict, dataclass
+from typing import Callable, Optional
+
+import utils
+
+# Cursor saved once the feed has been exhausted, the next run starts from
+# the added_after window.
+NO_MORE_DATA = "NO MORE DATA"
+
+# Environment variables
+ENV_CHECKPOINT_BACKEND = "CHECKPOINT_BACKEND"
+ENV_CHECKPOINT_PATH = "CHECKPOINT_PATH"
+ENV_CHECKPOINT_PRUNE_VERSIONS = "CHECKPOINT_PRUNE_VERSIONS"
+ENV_CHECKPOINT_SAVE_PAGES = "CHECKPOINT_SAVE_PAGES"
+ENV_CHECKPOINT_SAVE_SECONDS = "CHECKPOINT_SAVE_SECONDS"
+
+
+@dataclass
+class Checkpoint:
+    """Position of the ingestion in the CTM feed.
+
+    Attributes:
+      next (str): CTM cursor of the page to ingest. Empty before the first
+        run, NO_MORE_DATA once the feed has been exhausted.
+      offset (int): Entities of that page already acknowledged by Chronicle.
+      added_after (str): added_after value used to fetch the page when next
+        is NO_MORE_DATA and offset is set, so the same page is requested.
+      page_size (int): CTM page size reached by paging.PageSizer, the next
+        run starts from it; 0 when not tuned. With an offset, the size the
+        page was fetched with, so the same page is requested.
+      ranked_at (float): With an offset, the reference time the page was
+        ranked with by priority.PriorityWindow, the offset counts entities
+        in that order; 0 when it counts them in feed order.
+    """
+    next: str = ""
+    offset: int = 0
+    added_after: str = ""
+    page_size: int = 0
+    ranked_at: float = 0.0
+
+    def dumps(self) -> str:
+        """Serializes the checkpoint.
+
+        A checkpoint at a page boundary is saved as the bare cursor, the
+        format used before sub-page offsets were recorded.
+        """
+        if not self.offset and not self.added_after and not self.page_size:
+            return self.next
+        return json.dumps(asdict(self))
+
+    @classmethod
+    def loads(cls, text: str) -> "Checkpoint":
+        """Parses a checkpoint written by dumps, or a bare cursor."""
+        if text.startswith("{"):
+            return cls(**json.loads(text))
+        return cls(next=text)
+
+
+class CheckpointStore:
+    """Where checkpoints are kept between invocations."""
+
+    def load(self) -> Checkpoint:
+        """Returns the saved checkpoint, or an empty one if there is none."""
+        raise NotImplementedError
+
+    def save(self, checkpoint: Checkpoint):
+        """Saves checkpoint, replacing the previous one."""
+        raise NotImplementedError
+
+    def flush(self):
+        """Writes the last checkpoint saved, if the store held it back."""
+
+
+class ThrottledCheckpointStore(CheckpointStore):
+    """Writes the checkpoints saved to another store every few pages or seconds.
+
+    Every write of the secret store adds a billed Secret Manager version, so
+    a checkpoint per page is held back until pages checkpoints were saved or
+    seconds went by since the last write. A run killed before flush resumes
+    from the last checkpoint written, at most that many pages back.
+
+    Args:
+      store (CheckpointStore): Store written to.
+      pages (int): Checkpoints saved per write, 1 writes all of them.
+      seconds (float): Time after which the next checkpoint saved is
+        written, 0 for no limit.
+      clock (Callable[[], float]): Monotonic clock, in seconds.
+    """
+
+    def __init__(self, store: CheckpointStore, pages: int = 1, seconds: float = 0.0,
+                 clock: Callable[[], float] = time.monotonic):
+        self.store = store
+        self.pages = max(1, pages)
+        self.seconds = seconds
+        self.clock = clock
+        self.held: Optional[Checkpoint] = None
+        self._saves = 0
+        self._written = clock()
+
+    def load(self) -> Checkpoint:
+        return self.store.load()
+
+    def save(self, checkpoint: Checkpoint):
+        self.held = checkpoint
+        self._saves += 1
+        if (self._saves >= self.pages
+                or (self.seconds and self.clock() - self._written >= self.seconds)):
+            self.flush()
+
+    def flush(self):
+        if self.held is None:
+            return
+        self.store.save(self.held)
+        self.held = None
+        self._saves = 0
+        self._written = self.clock()
+
+
+class SecretManagerCheckpointStore(CheckpointStore):
+    """Keeps the checkpoint in a Secret Manager secret.
+
+    Args:
+      resource_path (str): Latest version of the secret, e.g.
+        "projects/<project_id>/secrets/CTM_NEXT/versions/latest".
+      destroy_previous (bool): Destroys the version replaced by every save,
+        so the secret does not accumulate one version per run.
+    """
+
+    def __init__(self, resource_path: str, destroy_previous: bool = False):
+        self.resource_path = resource_path
+        self.secret_path = "/".join(resource_path.split("/")[:4])
+        self.destroy_previous = destroy_previous
+
+    def load(self) -> Checkpoint:
+        try:
+            return Checkpoint.loads(
+                utils.get_value_from_secret_manager(self.resource_path))
+        except Exception as e:  # pylint: disable=broad-except
+            print(f"Indicator secret not present, get all data from CTM360! error -> {e}")
+            if not str(e).endswith("has no versions."):
+                utils.create_secret(self.resource_path.split("/")[1],
+                                    self.secret_path.split("/")[3])
+            return Checkpoint()
+
+    def save(self, checkpoint: Checkpoint):
+        utils.update_secret(self.secret_path, checkpoint.dumps(),
+                            destroy_previous=self.destroy_previous)
+
+
+class FileCheckpointStore(CheckpointStore):
+    """Keeps the checkpoint in a local JSON file, for tests and local runs.
+
+    Args:
+      path (str): Path of the file, created on the first save.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def load(self) -> Checkpoint:
+        if not os.path.exists(self.path):
+            return Checkpoint()
+        with open(self.path, encoding="utf-8") as f:
+            return Checkpoint.loads(f.read())
+
+    def save(self, checkpoint: Checkpoint):
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(json.dumps(asdict(checkpoint)))
+        os.replace(tmp, self.path)
+
+
+class SQLiteCheckpointStore(CheckpointStore):
+    """Keeps checkpoints in a SQLite database, one row per key.
+
+    Args:
+      path (str): Path of the database, ":memory:" for a private one.
+      key (str): Name of the checkpoint in the database.
+    """
+
+    def __init__(self, path: str, key: str = "CTM_NEXT"):
+        self.key = key
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._db:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS checkpoints "
+                "(key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+
+    def load(self) -> Checkpoint:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT value FROM checkpoints WHERE key = ?",
+                (self.key,)).fetchone()
+        return Checkpoint.loads(row[0]) if row else Checkpoint()
+
+    def save(self, checkpoint: Checkpoint):
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO checkpoints (key, value) VALUES (?, ?)",
+                (self.key, json.dumps(asdict(checkpoint))))
+
+
+def store_from_env(resource_path: str, key: str = "") -> CheckpointStore:
+    """Builds the store selected by CHECKPOINT_BACKEND.
+
+    Args:
+      resource_path (str): Secret used by the "secret" backend, the default.
+      key (str): Name of a separate checkpoint, e.g. of a backfill shard,
+        appended to the secret name, the file name or used as SQLite key.
+
+    Returns:
+      CheckpointStore: The "secret", "file" or "sqlite" store, the last two
+        kept at CHECKPOINT_PATH. The secret store destroys replaced versions
+        when CHECKPOINT_PRUNE_VERSIONS is "true" and is written every
+        CHECKPOINT_SAVE_PAGES checkpoints or CHECKPOINT_SAVE_SECONDS, see
+        ThrottledCheckpointStore; the others are written every checkpoint.
+
+    Raises:
+      ValueError: If the backend is unknown.
+    """
+    backend = utils.get_env_var(ENV_CHECKPOINT_BACKEND, required=False,
+                                default="secret")
+    if backend == "secret":
+        prune = utils.get_env_var(ENV_CHECKPOINT_PRUNE_VERSIONS, required=False,
+                                  default="false").lower() == "true"
+        if key:
+            parts = resource_path.split("/")
+            parts[3] = f"{parts[3]}_{key}"
+            resource_path = "/".join(parts)
+        return ThrottledCheckpointStore(
+            SecretManagerCheckpointStore(resource_path, destroy_previous=prune),
+            pages=int(utils.get_env_var(ENV_CHECKPOINT_SAVE_PAGES, required=False, default=10)),
+            seconds=float(utils.get_env_var(ENV_CHECKPOINT_SAVE_SECONDS, required=False, default=30)))
+    if backend == "file":
+        path = utils.get_env_var(ENV_CHECKPOINT_PATH)
+        return FileCheckpointStore(f"{path}.{key}" if key else path)
+    if backend == "sqlite":
+        return SQLiteCheckpointStore(utils.get_env_var(ENV_CHECKPOINT_PATH),
+                                     key=key or "CTM_NEXT")
+    raise ValueError(f"Invalid checkpoint backend {backend}.")
@@ -0,0 +1,124 @@
+"""Index of the indicators already sent to Chronicle.
+
+CTM360 serves the same indicators again across added_after windows and
+cursors. The index remembers, for every STIX id, a hash of the fields that
+change when an indicator is updated, so entities already sent unchanged can
+be dropped before they are packed.
+"""
+
+import hashlib
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Iterable, Iterator, Tuple
+
+# Environment variables
+ENV_DEDUP_PATH = "DEDUP_PATH"
+ENV_DEDUP_MAX_AGE_HOURS = "DEDUP_MAX_AGE_HOURS"
+
+# Entities looked up in the index with a single query.
+_LOOKUP_SIZE = 500
+
+
+def entity_key(entity: Any) -> Tuple[str, str]:
+    """Returns the STIX id of a UDM entity and the hash of its content.
+
+    The entity is a udm.UdmEntity or its dict form.
+
+    The hash covers updated_at and valid_until, so an indicator is sent again
+    when CTM360 updates it or extends its validity.
+    """
+    if isinstance(entity, dict):
+        metadata = entity['metadata']
+        stix_id = metadata['product_entity_id']
+        updated = metadata['threat'][0]['last_updated_time']
+        end = metadata['interval']['end_time']
+    else:
+        stix_id = entity.product_entity_id
+        updated = entity.last_updated_time
+        end = entity.end_time
+    content = "|".join((updated or "", end or ""))
+    return (stix_id, hashlib.sha1(content.encode("utf-8")).hexdigest())
+
+
+class DedupIndex:
+    """SQLite index of the entities acknowledged by Chronicle.
+
+    Entries older than max_age are evicted when the index is opened, so an
+    indicator is sent again at least once every max_age seconds.
+
+    Args:
+      path (str): Path of the database, ":memory:" for a private one.
+      max_age (float): Seconds an entry is kept.
+
+    Attributes:
+      skipped (int): Entities dropped by filter in this run.
+      passed (int): Entities let through by filter in this run.
+    """
+
+    def __init__(self, path: str, max_age: float = 7 * 24 * 3600):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self.skipped = 0
+        self.passed = 0
+        with self._db:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS sent "
+                "(id TEXT PRIMARY KEY, digest TEXT NOT NULL, sent_at REAL NOT NULL)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS sent_at ON sent (sent_at)")
+            evicted = self._db.execute(
+                "DELETE FROM sent WHERE sent_at < ?",
+                (time.time() - max_age,)).rowcount
+        if evicted:
+            print(f"Evicted {evicted} entries from the dedup index")
+
+    def _sent(self, ids) -> Dict[str, str]:
+        with self._lock:
+            rows = self._db.execute(
+                f"SELECT id, digest FROM sent WHERE id IN ({','.join('?' * len(ids))})",
+                ids).fetchall()
+        return dict(rows)
+
+    def filter(self, entities: Iterable[Any]) -> Iterator[Any]:
+        """Drops the entities already sent with the same content.
+
+        Args:
+          entities (Iterable): UDM entities, see entity_key.
+
+        Yields:
+          The entities that are new or changed, in order.
+        """
+        pending = []
+        for entity in entities:
+            pending.append((entity, entity_key(entity)))
+            if len(pending) == _LOOKUP_SIZE:
+                yield from self._filter(pending)
+                pending = []
+        if pending:
+            yield from self._filter(pending)
+
+    def _filter(self, pending):
+        sent = self._sent([key[0] for _, key in pending])
+        for entity, (stix_id, digest) in pending:
+            if sent.get(stix_id) == digest:
+                self.skipped += 1
+                continue
+            self.passed += 1
+            yield entity
+
+    def mark(self, keys: Iterable[Tuple[str, str]]):
+        """Records entities acknowledged by Chronicle.
+
+        Args:
+          keys (Iterable[tuple]): Results of entity_key for the entities.
+        """
+        now = time.time()
+        with self._lock, self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO sent (id, digest, sent_at) VALUES (?, ?, ?)",
+                [(stix_id, digest, now) for stix_id, digest in keys])
+
+    def reset_counters(self):
+        """Sets skipped and passed back to zero, at the start of a run."""
+        self.skipped = 0
+        self.passed = 0
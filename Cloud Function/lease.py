@@ -0,0 +1,388 @@
+"""Expiring leases on the checkpoints, so overlapping invocations do not
+ingest the same pages.
+
+An invocation claims the checkpoint of a collection with a random owner
+token before it loads it, renews the claim in a daemon thread while it runs
+and releases it after its last save. Another invocation started meanwhile,
+e.g. by the next hourly trigger during a backlog, finds the lease held and
+skips the collection instead of walking the same pages; a lease whose owner
+died expires after its time to live and is taken over.
+
+Every claim is a compare-and-set on the backend: the annotations of the
+checkpoint secret updated with its etag, a SQLite transaction or a file
+locked with flock. Expiry times are wall-clock times, the invocations are
+expected to have clocks within a few seconds of each other.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+from typing import Callable, Optional
+
+import utils
+from checkpoint import ENV_CHECKPOINT_BACKEND, ENV_CHECKPOINT_PATH, Checkpoint, CheckpointStore
+
+# Environment variables
+ENV_LEASE_BACKEND = "LEASE_BACKEND"
+ENV_LEASE_PATH = "LEASE_PATH"
+ENV_LEASE_TTL = "LEASE_TTL"
+
+# Annotations of the checkpoint secret holding its lease.
+OWNER_ANNOTATION = "ctm-lease-owner"
+EXPIRES_ANNOTATION = "ctm-lease-expires"
+
+
+@dataclass
+class Holder:
+    """Invocation holding a lease.
+
+    Attributes:
+      owner (str): Owner token of the invocation.
+      expires (float): Epoch seconds at which the lease expires.
+    """
+    owner: str
+    expires: float
+
+
+class LeaseStore:
+    """Where the leases are kept, one per checkpoint key."""
+
+    def acquire(self, key: str, owner: str, ttl: float) -> Optional[Holder]:
+        """Takes or renews the lease of key for owner, for ttl seconds.
+
+        Returns:
+          Holder: The invocation holding the lease when it is not owner's,
+            None when owner holds it now.
+        """
+        raise NotImplementedError
+
+    def release(self, key: str, owner: str):
+        """Gives the lease of key up, if owner still holds it."""
+        raise NotImplementedError
+
+
+def _live(holder: Optional[Holder], owner: str, now: float) -> bool:
+    """Whether another owner holds a lease that has not expired."""
+    return holder is not None and holder.owner != owner and holder.expires > now
+
+
+class SecretManagerLeaseStore(LeaseStore):
+    """Keeps the leases in the annotations of the checkpoint secrets.
+
+    The annotations are updated with the etag read along with them, so of
+    two invocations claiming a lease at the same time only one succeeds.
+    Needs the secretmanager.secrets.get and secretmanager.secrets.update
+    permissions on the checkpoint secrets.
+
+    Args:
+      resource_path (str): Checkpoint secret version, e.g.
+        "projects/<project_id>/secrets/CTM_NEXT/versions/latest"; the key of
+        a lease is appended to the secret name, as checkpoint.store_from_env
+        does.
+      clock (Callable[[], float]): Wall-clock time source.
+    """
+
+    def __init__(self, resource_path: str, clock: Callable[[], float] = time.time):
+        self.parts = resource_path.split("/")
+        self.clock = clock
+
+    def _secret(self, key: str) -> str:
+        parts = list(self.parts[:4])
+        if key:
+            parts[3] = f"{parts[3]}_{key}"
+        return "/".join(parts)
+
+    @staticmethod
+    def _holder(secret) -> Optional[Holder]:
+        owner = secret.annotations.get(OWNER_ANNOTATION)
+        if not owner:
+            return None
+        return Holder(owner, float(secret.annotations.get(EXPIRES_ANNOTATION, 0)))
+
+    def _update(self, secret, annotations) -> bool:
+        """Writes the annotations unless the secret changed since it was read."""
+        # imported here, like the Secret Manager client
+        from google.api_core import exceptions  # pylint: disable=import-outside-toplevel
+        try:
+            utils.get_secret_client().update_secret(request={
+                "secret": {"name": secret.name, "annotations": annotations, "etag": secret.etag},
+                "update_mask": {"paths": ["annotations"]},
+            })
+        except (exceptions.Aborted, exceptions.FailedPrecondition):
+            return False
+        return True
+
+    def _get(self, key: str):
+        from google.api_core import exceptions  # pylint: disable=import-outside-toplevel
+        name = self._secret(key)
+        client = utils.get_secret_client()
+        try:
+            return client.get_secret(request={"name": name})
+        except exceptions.NotFound:
+            # the checkpoint secret of a new collection
+            try:
+                utils.create_secret(name.split("/")[1], name.split("/")[3])
+            except exceptions.AlreadyExists:
+                pass
+            return client.get_secret(request={"name": name})
+
+    def acquire(self, key: str, owner: str, ttl: float) -> Optional[Holder]:
+        secret = self._get(key)
+        now = self.clock()
+        holder = self._holder(secret)
+        if _live(holder, owner, now):
+            return holder
+        annotations = dict(secret.annotations)
+        annotations[OWNER_ANNOTATION] = owner
+        annotations[EXPIRES_ANNOTATION] = f"{now + ttl:.0f}"
+        if self._update(secret, annotations):
+            return None
+        # another invocation updated the secret first
+        return self._holder(self._get(key)) or Holder("", now)
+
+    def release(self, key: str, owner: str):
+        secret = self._get(key)
+        holder = self._holder(secret)
+        if holder is None or holder.owner != owner:
+            return
+        annotations = {name: value for name, value in secret.annotations.items()
+                       if name not in (OWNER_ANNOTATION, EXPIRES_ANNOTATION)}
+        self._update(secret, annotations)
+
+
+class FileLeaseStore(LeaseStore):
+    """Keeps every lease in a JSON file, updated under an exclusive flock.
+
+    flock is not honoured by every network file system; the SQLite store is
+    the one to use on a volume shared by several hosts if it is not.
+
+    Args:
+      path (str): Base path of the files, "<path>.lease" or
+        "<path>.<key>.lease".
+      clock (Callable[[], float]): Wall-clock time source.
+    """
+
+    def __init__(self, path: str, clock: Callable[[], float] = time.time):
+        self.path = path
+        self.clock = clock
+
+    def _file(self, key: str) -> str:
+        return f"{self.path}.{key}.lease" if key else f"{self.path}.lease"
+
+    def _update(self, key: str, change: Callable[[Optional[Holder]], Optional[Holder]]):
+        """Replaces the holder of key by change(holder), under the file lock."""
+        # imported here, the module is only available on POSIX systems
+        import fcntl  # pylint: disable=import-outside-toplevel
+        fd = os.open(self._file(key), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            data = os.read(fd, 4096)
+            holder = Holder(**json.loads(data)) if data.strip() else None
+            updated = change(holder)
+            if updated != holder:
+                os.lseek(fd, 0, os.SEEK_SET)
+                os.ftruncate(fd, 0)
+                if updated is not None:
+                    os.write(fd, json.dumps(updated.__dict__).encode("utf-8"))
+                os.fsync(fd)
+            return holder
+        finally:
+            os.close(fd)
+
+    def acquire(self, key: str, owner: str, ttl: float) -> Optional[Holder]:
+        now = self.clock()
+        holder = self._update(key, lambda h: h if _live(h, owner, now) else Holder(owner, now + ttl))
+        return holder if _live(holder, owner, now) else None
+
+    def release(self, key: str, owner: str):
+        self._update(key, lambda h: None if h is not None and h.owner == owner else h)
+
+
+class SQLiteLeaseStore(LeaseStore):
+    """Keeps the leases in a SQLite database, one row per key.
+
+    The checkpoints of the SQLite backend can share the database.
+
+    Args:
+      path (str): Path of the database.
+      clock (Callable[[], float]): Wall-clock time source.
+    """
+
+    def __init__(self, path: str, clock: Callable[[], float] = time.time):
+        self.clock = clock
+        self._lock = threading.Lock()
+        # transactions are started explicitly, see _claim
+        self._db = sqlite3.connect(path, timeout=30, isolation_level=None,
+                                   check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS leases "
+            "(key TEXT PRIMARY KEY, owner TEXT NOT NULL, expires REAL NOT NULL)")
+
+    def acquire(self, key: str, owner: str, ttl: float) -> Optional[Holder]:
+        key = key or "CTM_NEXT"
+        with self._lock:
+            # taken before the read, so that no other process claims the
+            # lease between the read and the write
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._db.execute(
+                    "SELECT owner, expires FROM leases WHERE key = ?", (key,)).fetchone()
+                now = self.clock()
+                holder = Holder(*row) if row else None
+                if _live(holder, owner, now):
+                    return holder
+                self._db.execute(
+                    "INSERT OR REPLACE INTO leases (key, owner, expires) VALUES (?, ?, ?)",
+                    (key, owner, now + ttl))
+                return None
+            finally:
+                self._db.execute("COMMIT")
+
+    def release(self, key: str, owner: str):
+        with self._lock:
+            self._db.execute("DELETE FROM leases WHERE key = ? AND owner = ?",
+                             (key or "CTM_NEXT", owner))
+
+
+class Lease:
+    """The lease of one checkpoint, held by this invocation.
+
+    Once acquired, the lease is renewed every third of its time to live by
+    a daemon thread. When a renewal finds another owner, or the lease
+    expires because the renewals failed, ``lost`` becomes True: the run must
+    stop without saving its checkpoint, which belongs to the new owner.
+
+    Args:
+      store (LeaseStore): Where the lease is kept.
+      key (str): Key of the checkpoint, "" for the default one.
+      ttl (float): Seconds the lease lasts without renewal.
+      owner (str): Owner token, a random one by default.
+      clock (Callable[[], float]): Wall-clock time source.
+
+    Attributes:
+      holder (Holder): The other invocation holding the lease, when
+        acquire failed.
+    """
+
+    def __init__(self, store: LeaseStore, key: str = "", ttl: float = 300,
+                 owner: Optional[str] = None, clock: Callable[[], float] = time.time):
+        self.store = store
+        self.key = key
+        self.ttl = ttl
+        self.owner = owner or uuid.uuid4().hex
+        self.clock = clock
+        self.holder: Optional[Holder] = None
+        self._expires = 0.0
+        self._lost = False
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def lost(self) -> bool:
+        """Whether the lease was acquired and is no longer held."""
+        if self._thread is not None and self.clock() >= self._expires:
+            self._lost = True
+        return self._lost
+
+    def _claim(self) -> bool:
+        now = self.clock()
+        self.holder = self.store.acquire(self.key, self.owner, self.ttl)
+        if self.holder is not None:
+            return False
+        self._expires = now + self.ttl
+        return True
+
+    def renew(self) -> bool:
+        """Extends the lease, returning False when it went to another owner."""
+        if self.lost or not self._claim():
+            # the new owner may have moved the checkpoint already, the lease
+            # stays lost even if it is free again later
+            self._lost = True
+            return False
+        return True
+
+    def acquire(self) -> bool:
+        """Takes the lease and starts its renewal, unless another owner holds it."""
+        if not self._claim():
+            return False
+        self._thread = threading.Thread(target=self._run, name="lease-renewal", daemon=True)
+        self._thread.start()
+        return True
+
+    def _run(self):
+        while not self._stop.wait(self.ttl / 3):
+            try:
+                if not self.renew():
+                    print(f"Lease {self.key or 'CTM_NEXT'} taken over by {self.holder.owner}")
+                    return
+            except Exception as e:  # pylint: disable=broad-except
+                print(f"Lease renewal failed: {e}")
+
+    def release(self):
+        """Stops the renewal and gives the lease up, unless it was lost."""
+        if self._thread is None:
+            return
+        self._stop.set()
+        if not self.lost:
+            self.store.release(self.key, self.owner)
+
+
+class LeasedCheckpointStore(CheckpointStore):
+    """A checkpoint store that stops saving once its lease is lost.
+
+    The checkpoint then belongs to the invocation that took the lease over,
+    which may have moved it already.
+
+    Args:
+      store (CheckpointStore): The store of the checkpoint.
+      held (Lease): The lease of the checkpoint, None to always save.
+    """
+
+    def __init__(self, store: CheckpointStore, held: Optional[Lease]):
+        self.store = store
+        self.held = held
+
+    def load(self) -> Checkpoint:
+        return self.store.load()
+
+    def save(self, checkpoint: Checkpoint):
+        if self.held is not None and self.held.lost:
+            print(f"Lease of {self.held.key} lost, checkpoint not saved")
+            return
+        self.store.save(checkpoint)
+
+    def flush(self):
+        if self.held is None or not self.held.lost:
+            self.store.flush()
+
+
+def store_from_env(resource_path: str) -> Optional[LeaseStore]:
+    """Builds the store selected by LEASE_BACKEND.
+
+    Args:
+      resource_path (str): Checkpoint secret, for the "secret" backend.
+
+    Returns:
+      LeaseStore: The "secret", "file" or "sqlite" store, the last two kept
+        at LEASE_PATH (default CHECKPOINT_PATH); None for "none". The
+        backend defaults to CHECKPOINT_BACKEND.
+
+    Raises:
+      ValueError: If the backend is unknown.
+    """
+    backend = utils.get_env_var(ENV_LEASE_BACKEND, required=False) or utils.get_env_var(
+        ENV_CHECKPOINT_BACKEND, required=False, default="secret")
+    if backend == "none":
+        return None
+    if backend == "secret":
+        return SecretManagerLeaseStore(resource_path)
+    path = utils.get_env_var(ENV_LEASE_PATH, required=False) or utils.get_env_var(ENV_CHECKPOINT_PATH)
+    if backend == "file":
+        return FileLeaseStore(path)
+    if backend == "sqlite":
+        return SQLiteLeaseStore(path)
+    raise ValueError(f"Invalid lease backend {backend}.")
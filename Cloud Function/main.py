@@ -1,16 +1,31 @@
 # Imports required for the sample - Google Auth and API Client Library Imports.
 # Get these packages from https://pypi.org/project/google-api-python-client/ or run $ pip
 # install google-api-python-client from your terminal
-from google.oauth2 import service_account
-import re
-import requests
+# google-auth and Secret Manager are imported when the instance starts, see Instance
 import json
 import utils
-import time
-from datetime import datetime, timedelta
+import checkpoint
+import backfill
+import dedup
+import metrics
+import pipeline
+import retry
+import scheduler
+import spool
+import transformer
+import streaming
+import transport
+from uploader import BatchUploader
+import lease
+import paging
+import priority
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 import os
+import time
 import base64
-from google.auth.transport.requests import AuthorizedSession
+import requests
 SCOPES = ['https://www.googleapis.com/auth/malachite-ingestion']
 
 # Environment variables
@@ -20,215 +35,611 @@ ENV_CHRONICLE_SERVICE_ACCOUNT = "CHRONICLE_SERVICE_ACCOUNT"
 ENV_CTM_KEY_ID = "CTM_KEY_ID"
 ENV_CTM_COLLECTION_ID = "CTM_COLLECTION_ID"
 ENV_CTM_NEXT = "CTM_NEXT"
+ENV_PIPELINE_QUEUE_SIZE = "PIPELINE_QUEUE_SIZE"
+ENV_CTM_STREAM_PAGES = "CTM_STREAM_PAGES"
+ENV_SECRET_CACHE_TTL = "SECRET_CACHE_TTL"
+ENV_UPLOAD_CONCURRENCY = "UPLOAD_CONCURRENCY"
+ENV_UPLOAD_MAX_ATTEMPTS = "UPLOAD_MAX_ATTEMPTS"
+ENV_UPLOAD_MAX_CONCURRENCY = "UPLOAD_MAX_CONCURRENCY"
+ENV_CTM_MAX_ATTEMPTS = "CTM_MAX_ATTEMPTS"
+ENV_CTM_URL = "CTM_URL"
+ENV_CHRONICLE_INGESTION_URL = "CHRONICLE_INGESTION_URL"
 
-start_time = (datetime.now() - timedelta(minutes=60)).isoformat() #last 60 minutes
-customer_id = utils.get_env_var(ENV_CHRONICLE_CUSTOMER_ID, is_secret=True)
-region = utils.get_env_var(ENV_CHRONICLE_REGION)
-credentials_file = utils.get_env_var(ENV_CHRONICLE_SERVICE_ACCOUNT, is_secret=True)
-credentials_file = json.loads(credentials_file)
-collection_id = utils.get_env_var(ENV_CTM_COLLECTION_ID, is_secret=True)
-secret_id = utils.get_env_var(ENV_CTM_KEY_ID, is_secret=True)
-
-credentials = service_account.Credentials.from_service_account_info(credentials_file, scopes=SCOPES)
-auth_session = AuthorizedSession(credentials)
+secret_cache_ttl = float(utils.get_env_var(ENV_SECRET_CACHE_TTL, required=False, default=3600))
+# timings of the instance startup, reported with its first invocation
+startup_metrics = []
 max_size = 1048576 #the post request can handle only 1mb
 events =[]
-timeout_function = 3000 #3600 -> 60min max 2° gen CF timeout
-start_time_function = time.time()
+url_base = utils.get_env_var(ENV_CTM_URL, required=False, default="your_url_get")
+timeout_function = float(utils.get_env_var(scheduler.ENV_TIMEOUT_FUNCTION, required=False, default=3000)) #3600 -> 60min max 2° gen CF timeout
+deadline_margin = float(utils.get_env_var(scheduler.ENV_DEADLINE_MARGIN, required=False, default=30))
+spool_path = utils.get_env_var(spool.ENV_SPOOL_PATH, required=False)
+lease_ttl = float(utils.get_env_var(lease.ENV_LEASE_TTL, required=False, default=300))
+
+
+def upload_concurrency():
+    """Initial and highest number of parallel batchCreate requests."""
+    concurrency = int(utils.get_env_var(ENV_UPLOAD_CONCURRENCY, required=False, default=4))
+    return concurrency, int(utils.get_env_var(ENV_UPLOAD_MAX_CONCURRENCY, required=False, default=2 * concurrency))
+
+
+class Instance:
+    """The secrets and clients shared by the invocations of an instance.
+
+    Attributes:
+      customer_id (str): Chronicle customer ID.
+      collections (List[str]): CTM collections ingested by every invocation.
+      credentials: Service account credentials of the Chronicle session.
+      http_transport (transport.Transport): Keep-alive sessions, refreshing
+        the Chronicle token in the background.
+      ingestion_url (str): Chronicle ingestion API base URL.
+      dedup_index (dedup.DedupIndex): Index of the entities already sent,
+        None unless DEDUP_PATH is set.
+      batch_spool (spool.Spool): Batches Chronicle did not acknowledge, None
+        unless SPOOL_PATH is set.
+      lease_store (lease.LeaseStore): Leases of the checkpoints, None when
+        LEASE_BACKEND is "none".
+    """
+
+    def __init__(self):
+        stats = metrics.Metrics()
+        with stats.timer("startup"):
+            # the startup secrets are read concurrently over a single client
+            with stats.timer("secret"):
+                secrets = utils.get_secret_env_vars(
+                    [ENV_CHRONICLE_CUSTOMER_ID, ENV_CHRONICLE_SERVICE_ACCOUNT, ENV_CTM_COLLECTION_ID, ENV_CTM_KEY_ID],
+                    cache_ttl=secret_cache_ttl)
+            self.customer_id = secrets[ENV_CHRONICLE_CUSTOMER_ID]
+            collection_id = secrets[ENV_CTM_COLLECTION_ID]
+            # a comma separated list of collections is ingested in a single invocation
+            self.collections = [collection.strip() for collection in collection_id.split(",") if collection.strip()]
+            # the regional endpoint unless another one is set, e.g. a stand-in server
+            self.ingestion_url = (utils.get_env_var(ENV_CHRONICLE_INGESTION_URL, required=False)
+                                  or utils.instance_region(utils.get_env_var(ENV_CHRONICLE_REGION)))
+
+            from google.oauth2 import service_account
+            credentials_file = json.loads(secrets[ENV_CHRONICLE_SERVICE_ACCOUNT])
+            self.credentials = service_account.Credentials.from_service_account_info(credentials_file, scopes=SCOPES)
+            # a keep-alive connection for every batchCreate request in flight
+            self.http_transport = transport.Transport.from_env(self.credentials, max_concurrency=upload_concurrency()[1])
+            # entities already sent unchanged are dropped when DEDUP_PATH is set
+            dedup_path = utils.get_env_var(dedup.ENV_DEDUP_PATH, required=False)
+            self.dedup_index = None
+            if dedup_path:
+                self.dedup_index = dedup.DedupIndex(
+                    dedup_path, max_age=float(utils.get_env_var(dedup.ENV_DEDUP_MAX_AGE_HOURS, required=False, default=168)) * 3600)
+            # batches Chronicle keeps rejecting wait on disk when SPOOL_PATH is set
+            self.batch_spool = None
+            if spool_path:
+                self.batch_spool = spool.Spool(
+                    spool_path,
+                    max_bytes=int(float(utils.get_env_var(spool.ENV_SPOOL_MAX_MB, required=False, default=256)) * 2**20),
+                    segment_bytes=int(float(utils.get_env_var(spool.ENV_SPOOL_SEGMENT_MB, required=False, default=16)) * 2**20),
+                    max_attempts=int(utils.get_env_var(spool.ENV_SPOOL_MAX_ATTEMPTS, required=False, default=3)))
+            # overlapping invocations take turns on the checkpoints
+            self.lease_store = lease.store_from_env(os.environ[ENV_CTM_NEXT])
+        startup_metrics.append(stats)
+
+
+# the secrets and clients are set up in the background while
+# functions_framework loads, the first request waits for them if needed; a
+# failure is raised by that request instead of failing the import
+instance = utils.Lazy(Instance)
+instance.prefetch("instance startup")
+# one structured summary per invocation, Cloud Logging by default
+metrics_sink = utils.Lazy(metrics.sink_from_env)
+metrics_sink.prefetch("metrics sink")
+
+
+def retry_policy(max_attempts):
+    """Builds the retry policy of the CTM and Chronicle requests."""
+    return retry.RetryPolicy(
+        max_attempts,
+        base_delay=float(utils.get_env_var(retry.ENV_RETRY_BASE_DELAY, required=False, default=1)),
+        max_delay=float(utils.get_env_var(retry.ENV_RETRY_MAX_DELAY, required=False, default=60)))
+
+
+def collection_url(collection):
+    """Objects endpoint of a collection, CTM_URL with {collection} replaced."""
+    state = instance.get()
+    if "{collection}" in url_base:
+        return url_base.replace("{collection}", collection)
+    if len(state.collections) > 1:
+        raise ValueError(f"{ENV_CTM_URL} needs a {{collection}} placeholder to ingest several collections.")
+    return url_base
+
+
+def ctm_headers():
+    """Headers of the CTM requests."""
+    # served from memory until the cache expires, so a rotated key is picked up
+    secret_id = utils.get_env_var(ENV_CTM_KEY_ID, is_secret=True, cache_ttl=secret_cache_ttl)
+    return {
+        'Authorization': f'Bearer {secret_id }'
+    }
+
+
+def invocation_metrics():
+    """Builds the metrics of an invocation, with the startup ones if first."""
+    stats = metrics.Metrics(profile=metrics.profile_from_env())
+    try:
+        stats.merge(startup_metrics.pop())
+        stats.set(cold_start=True)
+    except IndexError:
+        stats.set(cold_start=False)
+    return stats
+
+
+def spool_counters():
+    """Batches appended, evicted and quarantined by the spool of the instance.
+
+    The spool is shared by the invocations of the instance, an invocation
+    reports the difference with the counters at its start.
+    """
+    state = instance.get()
+    if state.batch_spool is None:
+        return {}
+    return {"appended": state.batch_spool.appended, "evicted": state.batch_spool.evicted,
+            "quarantined": state.batch_spool.quarantined}
+
+
+def emit_summary(stats, status, uploader, get_policy=None, spool_start=None, **fields):
+    """Writes the summary of an invocation to the metrics sink.
+
+    Args:
+      spool_start (dict): spool_counters at the start of the invocation.
+    """
+    state = instance.get()
+    if get_policy is not None:
+        fields["get"] = get_policy.stats.as_dict()
+    if state.dedup_index is not None:
+        fields["dedup"] = {"skipped": state.dedup_index.skipped, "sent": state.dedup_index.passed}
+    fields["post"] = dict(uploader.policy.stats.as_dict(),
+                          concurrency=round(uploader.limiter.limit, 1),
+                          throttled_down=uploader.limiter.decreases)
+    if state.http_transport.refresher is not None:
+        fields["token"] = state.http_transport.refresher.as_dict()
+    if state.batch_spool is not None:
+        start = spool_start or {}
+        fields["spool"] = {name: value - start.get(name, 0) for name, value in spool_counters().items()}
+        fields["spool"]["bytes"] = state.batch_spool.size()
+    metrics_sink.get().emit(stats.summary(status=status, **fields))
+
+
+def make_uploader(stats=None):
+    """Builds the batchCreate uploader of an invocation."""
+    state = instance.get()
+    url_post = f"{state.ingestion_url}/v2/entities:batchCreate"
+    concurrency, max_concurrency = upload_concurrency()
+    return BatchUploader(
+        state.http_transport, url_post,
+        concurrency=concurrency,
+        max_concurrency=max_concurrency,
+        policy=retry_policy(int(utils.get_env_var(ENV_UPLOAD_MAX_ATTEMPTS, required=False, default=5))),
+        on_sent=(lambda batch: state.dedup_index.mark(batch.keys)) if state.dedup_index is not None else None,
+        metrics=stats,
+        spool=state.batch_spool)
+
+
+def drain_spool(uploader, stats, invocation):
+    """Sends the batches spooled by previous invocations.
+
+    Raises:
+      pipeline.UploadError: If Chronicle still rejects them.
+    """
+    state = instance.get()
+    if state.batch_spool is None or not state.batch_spool.segments():
+        return
+    quarantined = state.batch_spool.quarantined
+    with stats.timer("spool"):
+        batches, entities = state.batch_spool.drain(
+            lambda batch: uploader.submit(batch, spool=False), uploader.wait,
+            window=2 * uploader.concurrency, should_stop=invocation.should_stop)
+    print(f"Sent {entities} spooled entities in {batches} batches")
+    stats.count("spool.drained", entities)
+    stats.count("spool.quarantined", state.batch_spool.quarantined - quarantined)
+
+
+def take_lease(key, stats):
+    """Takes the lease of a checkpoint for this invocation.
+
+    Args:
+      key (str): Key of the checkpoint, "" for the default one.
+      stats (metrics.Metrics): Counts the failures of the lease store.
+
+    Returns:
+      tuple: The lease.Lease taken, None when leases are disabled or the
+        store failed, and the lease.Holder of the invocation holding the
+        lease when another one does, else None.
+    """
+    state = instance.get()
+    if state.lease_store is None:
+        return None, None
+    held = lease.Lease(state.lease_store, key, ttl=lease_ttl)
+    try:
+        if not held.acquire():
+            return None, held.holder
+    except Exception as e:  # pylint: disable=broad-except
+        # e.g. the secretmanager.secrets.update permission is missing: the
+        # run goes on unleased, as before leases, rather than not at all
+        print(f"Lease of {key or 'CTM_NEXT'} not taken, running without it: {e}")
+        stats.count("lease.errors")
+        return None, None
+    return held, None
+
+
+def release_lease(held, stats):
+    """Gives up a lease taken by take_lease, None being a no-op.
+
+    A failure of the lease store is counted, the lease then expires after
+    its time to live.
+    """
+    if held is None:
+        return
+    try:
+        held.release()
+    except Exception as e:  # pylint: disable=broad-except
+        print(f"Lease of {held.key or 'CTM_NEXT'} not released, it expires in {lease_ttl:.0f}s: {e}")
+        stats.count("lease.errors")
+
+
+def run_backfill(params, invocation):
+    """Ingests a historical range with backfill.Backfill.
+
+    Args:
+      params (dict): "start" and optional "end" of the range (ISO 8601, end
+        defaults to now), "shards" (default 4), "processes" (default one
+        per shard) and "collection" (default the first one).
+      invocation (scheduler.InvocationScheduler): Budget of the request.
+    """
+    end = params.get("end") or datetime.now(timezone.utc).isoformat()
+    shards = backfill.split_range(params["start"], end, int(params.get("shards", 4)))
+    print(f"Backfill from {params['start']} to {end} in {len(shards)} shards")
+    state = instance.get()
+    stats = invocation_metrics()
+    with stats.timer("secret"):
+        headers_get = ctm_headers()
+    collection = params.get("collection") or next(iter(state.collections), "")
+    if not collection:
+        print(f"Backfill needs a collection, none in the request or in {ENV_CTM_COLLECTION_ID}")
+        return f"No CTM collection to backfill, {ENV_CTM_COLLECTION_ID} is empty", 500
+    config = backfill.FetchConfig(
+        collection_url(collection), headers_get, state.customer_id, max_size,
+        max_attempts=int(utils.get_env_var(ENV_CTM_MAX_ATTEMPTS, required=False, default=5)))
+    def checkpoint_key(key):
+        return f"{collection}_{key}" if len(state.collections) > 1 else key
+    # a shard leased by another backfill is left to it, like a collection
+    leases = {}
+    for shard in list(shards):
+        held, holder = take_lease(checkpoint_key(shard.key), stats)
+        if holder is not None:
+            print(f"Shard {shard.key} leased by {holder.owner}, skipped")
+            shards.remove(shard)
+            continue
+        leases[shard.key] = held
+    spool_start = spool_counters()
+    uploader = make_uploader(stats)
+    status = "error"
+    engine = backfill.Backfill(
+        config, uploader,
+        store_for=lambda key: lease.LeasedCheckpointStore(
+            checkpoint.store_from_env(os.environ[ENV_CTM_NEXT], key=checkpoint_key(key)), leases.get(key)),
+        processes=params.get("processes"))
+    held_leases = [held for held in leases.values() if held is not None]
+    try:
+        if not shards:
+            status = "LEASED"
+            return status
+        drain_spool(uploader, stats, invocation)
+        status = engine.run(shards, lambda: (invocation.should_stop() or uploader.spooling
+                                             or any(held.lost for held in held_leases)))
+        return status
+    except (pipeline.FetchError, pipeline.UploadError) as e:
+        status = f"error {e.status_code}"
+        # 0 stands for a connection error, answered as a bad gateway
+        return e.text, e.status_code or 502
+    finally:
+        uploader.close()
+        for held in held_leases:
+            release_lease(held, stats)
+        emit_summary(stats, status, uploader, spool_start=spool_start, backfill_shards=len(shards))
 
 
 import functions_framework
 @functions_framework.http
 def main(req): 
     print("Start Fetching IOC")
+    # the budget and the added_after window belong to this request, not to
+    # the instance, which can serve many of them
+    invocation = scheduler.InvocationScheduler(timeout_function, margin=deadline_margin)
+    # set up in the background since the import, waited for on a cold start
+    state = instance.get()
+    stats = invocation_metrics()
+    start_time = (datetime.now() - timedelta(minutes=60)).isoformat() #last 60 minutes
+    params = req.get_json(silent=True) if req is not None else None
+    if params and params.get("backfill"):
+        return run_backfill(params["backfill"], invocation)
+    if not state.collections:
+        print(f"No CTM collection in {ENV_CTM_COLLECTION_ID}, nothing to ingest")
+        return f"No CTM collection to ingest, {ENV_CTM_COLLECTION_ID} is empty", 500
     CTM_NEXT = os.environ[ENV_CTM_NEXT]
-    next_indicator=""
-    next=""
-    try:
-        next_indicator = utils.get_env_var(ENV_CTM_NEXT, is_secret=True)
-    except Exception as e:
-        print(f"Indicator secret not present, get all data from CTM360! error -> {e}")
-        if not str(e).endswith("has no versions."):
-            utils.create_secret(CTM_NEXT.split("/")[1], "CTM_NEXT")
-    
-    next=next_indicator
-
-    url_get=f"your_url_get"
-    if next == "NO MORE DATA":
-        print(f"Intermediary next indicator not present, fetching from {start_time} timestamp")
-        url_get += f"?added_after={start_time}"
-    elif next != "":
-        next=next_indicator
-        print(f"Present and intermediary next, start fetching using [{next}] next value")
-        url_get+=f"?next={next}"
-    
-
-   
-
-    url_post = f"{utils.instance_region(region)}/v2/entities:batchCreate"
-    headers_get = {
-        'Authorization': f'Bearer {secret_id }'
-    }
-    headers_post = {"Content-Type": "application/json"}
 
+    with stats.timer("secret"):
+        headers_get = ctm_headers()
 
     # HTTP GET REQ (url_get,headers_get)
-    more = True
-    while more:
-        response = requests.get(url_get, headers=headers_get)
-        events = [] #need empty for the next loop
-        #print(url_get)
-
-        if response.status_code == 200:
-            data = response.json()
-
-            # PARSING JSON
-            #print("Start converting attributes in UDM attributes")
-            for obj in data['objects']:
-                if obj['extensions']['extension-definition--ea279b3e-5c71-4632-ac08-831c66a786ba']['main_observable_type'] not in ["StixFile","Url","Domain-Name","IPv4-Addr","Hostname","Email-Addr"]:
-                    print("object not supported -> ", obj['extensions']['extension-definition--ea279b3e-5c71-4632-ac08-831c66a786ba']['main_observable_type'])
-                    continue
-                metadata = {}
-                file = {}
-                threat = {}
-                interval = {}
-                entity = {}
-                user = {}
-                additionals = {}
-
-                # >>> METADATA
-                metadata['vendor_name'] = "CTM_CUSTOM_IOC"
-                metadata['product_name'] = "CTM_CUSTOM_IOC"
-                metadata['collected_timestamp'] = utils.now()
-                metadata['product_entity_id'] = obj['id']
-
-                # metadata.threat
-                threat['confidence_details'] = str(obj['confidence'])
-                threat['first_discovered_time'] = obj['extensions']['extension-definition--ea279b3e-5c71-4632-ac08-831c66a786ba']['created_at']
-                threat['last_updated_time'] = obj['extensions']['extension-definition--ea279b3e-5c71-4632-ac08-831c66a786ba']['updated_at']
-
-                # additionals
-
-                additionals['score'] = obj['extensions']['extension-definition--ea279b3e-5c71-4632-ac08-831c66a786ba']['score']
-                try:
-                     additionals['description'] = obj['description']
-                except KeyError:
-                     pass
-                additionals['extension_type'] = obj['extensions']['extension-definition--ea279b3e-5c71-4632-ac08-831c66a786ba']['extension_type']
-                additionals['type'] = obj['extensions']['extension-definition--ea279b3e-5c71-4632-ac08-831c66a786ba']['type']
-                additionals['detection'] = str(obj['extensions']['extension-definition--ea279b3e-5c71-4632-ac08-831c66a786ba']['detection'])
-                try:
-                     additionals['labels'] = obj['labels']
-                except KeyError:
-                     pass
-                additionals['pattern'] = obj['pattern']
-                additionals['pattern_type'] = obj['pattern_type']
-                try:
-                     additionals['pattern_version'] = obj['pattern_version']
-                except KeyError:
-                     pass
-                        # >>> ENTITY
-                        # - entity.type
-                match obj['extensions']['extension-definition--ea279b3e-5c71-4632-ac08-831c66a786ba']['main_observable_type']:
-                    case "StixFile":
-                        #entity['file'] = obj['name']
-                        try:
-                            file['sha256'] = obj['name']
-                        except KeyError:
-                            pass
-                        metadata['entity_type'] = 'FILE'
-                        interval['start_time'] = obj['valid_from']
-                        interval['end_time'] = obj['valid_until']
-
-                    case "Url":
-                        entity['url'] = obj['name']
-                        metadata['entity_type'] = 'URL'
-                        interval['start_time'] = obj['valid_from']
-                        interval['end_time'] = obj['valid_until']
-
-                    case "Domain-Name":
-                        entity['hostname'] = obj['name']
-                        metadata['entity_type'] = 'DOMAIN_NAME'
-                        interval['start_time'] = obj['valid_from']
-                        interval['end_time'] = obj['valid_until']
-
-                    case "IPv4-Addr":
-                        match = re.search(r"(\d+\.\d+\.\d+\.\d+)",obj['name'])
-                        obj['name']= match.group(1)
-                        entity['ip'] = obj['name']
-                        metadata['entity_type'] = 'IP_ADDRESS'
-                        interval['start_time'] = obj['valid_from']
-                        interval['end_time'] = obj['valid_until']
-
-                    case "Hostname":
-                        entity['hostname'] = obj['name']
-                        metadata['entity_type'] = 'DOMAIN_NAME'
-                        interval['start_time'] = obj['valid_from']
-                        interval['end_time'] = obj['valid_until']
-
-                    case "Email-Addr":
-                        user["emailAddresses"] = [obj["name"]]
-                        metadata['entity_type'] = 'USER'
-                        interval['start_time'] = obj['valid_from']
-                        interval['end_time'] = obj['valid_until']
-
-                # build the top level UDM Objects
-                metadata['threat'] = [threat]
-                metadata['interval'] = interval
-                entity['file'] = file
-                entity['user'] = user
-                #create the final UDM event
-                event = {}
-
-                event['metadata'] = metadata
-                event['entity'] = entity
-                event['additional'] = additionals    
-                log = json.dumps(event)
-                events.append(json.loads((log)))
-                #print(events)
-                #print(len(events))
-            #manage the max 1mb post data for request
-            for chunk in utils.chunked_events(events, max_size):
-                post_data = {
-                "customer_id": customer_id,
-                "log_type": "STIX",
-                "entities": chunk
-                }
-            
-            
-        
-                #PERFORM HTTP POST REQUEST (url_post,post_data, headers)
-                post_response = auth_session.post(url_post, json=post_data, headers=headers_post)
-                if post_response.status_code == 200:
-                    print(f"sent {len(chunk)} data to SIEM")
-                else:
-                    print(f"POST error code: {post_response.status_code}")
-                    print(f"POST error text: {post_response.text}")
-                    return post_response.text,post_response.status_code
-
-                #print(len(events))
-                print(f"sent {len(chunk)} data to SIEM")
-                print(data['next'])
-
-                if data['more'] == True:
-                    if int(time.time() - start_time_function) >= timeout_function:
-                        print('TIMEOUT FUNCTION! updating CTM_NEXT secret..')
-                        utils.update_secret("/".join(CTM_NEXT.split("/")[:4]), data['next'])
-                        return "TIMEOUT"
-                    next = data['next']
-                    url_get=f"url_get?next={next}"
-                else:
-                    more = False
-                    print('no more data to sent')
-                    if next_indicator != "NO MORE DATA":
-                        utils.update_secret("/".join(CTM_NEXT.split("/")[:4]), "NO MORE DATA")
-                    break
-                
-            
+    stream_pages = utils.get_env_var(ENV_CTM_STREAM_PAGES, required=False, default="false").lower() == "true"
+    get_policy = retry_policy(int(utils.get_env_var(ENV_CTM_MAX_ATTEMPTS, required=False, default=5)))
+    queue_size = int(utils.get_env_var(ENV_PIPELINE_QUEUE_SIZE, required=False, default=2))
+    # small pages are held and merged into fuller batchCreate requests
+    batch_max_age = float(utils.get_env_var(pipeline.ENV_BATCH_MAX_AGE, required=False, default=30))
+    batch_max_entities = int(utils.get_env_var(pipeline.ENV_BATCH_MAX_ENTITIES, required=False, default=0))
+    # the CTM page size is tuned from the pages of the run once set, by
+    # default it is left to CTM
+    page_size = int(utils.get_env_var(paging.ENV_CTM_PAGE_SIZE, required=False, default=0))
+    page_param = utils.get_env_var(paging.ENV_CTM_PAGE_PARAM, required=False, default="limit")
+    def page_sizer(size):
+        return paging.PageSizer(
+            size,
+            minimum=int(utils.get_env_var(paging.ENV_CTM_PAGE_MIN, required=False, default=100)),
+            maximum=int(utils.get_env_var(paging.ENV_CTM_PAGE_MAX, required=False, default=5000)),
+            max_bytes=int(float(utils.get_env_var(paging.ENV_CTM_PAGE_MAX_MB, required=False, default=16)) * 2**20),
+            max_seconds=float(utils.get_env_var(paging.ENV_CTM_PAGE_MAX_SECONDS, required=False, default=10)))
+    # the entities of every page are ranked, expired ones dropped
+    priority_scheduling = utils.get_env_var(priority.ENV_PRIORITY_SCHEDULING, required=False, default="false").lower() == "true"
+    def count_bytes(chunks):
+        for chunk in chunks:
+            stats.count("get.bytes", len(chunk))
+            yield chunk
+
+    def stream_body(response):
+        """Chunks of a streamed CTM page, a read error raises FetchError."""
+        try:
+            yield from count_bytes(response.iter_content(chunk_size=65536))
+        except (requests.exceptions.ChunkedEncodingError, requests.exceptions.ConnectionError) as e:
+            response.close()
+            raise pipeline.FetchError(f"CTM page body cut short: {e}", 0) from e
+
+    def count_oversize(batches):
+        for batch in batches:
+            if batch.skipped:
+                stats.count("pack.oversize", batch.skipped)
+            yield batch
+
+    #PERFORM HTTP POST REQUEST (url_post,post_data, headers)
+    if state.dedup_index is not None:
+        state.dedup_index.reset_counters()
+    spool_start = spool_counters()
+    uploader = make_uploader(stats)
+    def transform(objects, skip, ranker=None, reference=0.0):
+        # each lazy stage is timed without the stages it consumes
+        if stream_pages:
+            objects = stats.timed("parse", objects)
+        # the offset counts sent entities, never more than their position
+        # before deduplication: a resumed page can only go over entities
+        # again, and the index drops those already sent
+        events = transformer.iter_transform(objects, utils.now())
+        if ranker is None:
+            events = stats.timed("transform", itertools.islice(events, skip, None),
+                                 nested=[objects] if stream_pages else ())
         else:
-            print(f"Error GET: {response.text}")
-            return f"response.status_code"
-    return "ok"
+            # the whole page is buffered and ranked before the first entity is packed
+            events = stats.timed("transform", events, nested=[objects] if stream_pages else ())
+            events = stats.timed("rank", ranker.rank(events, skip, reference), nested=[events])
+        if state.dedup_index is None:
+            #manage the max 1mb post data for request
+            return count_oversize(stats.timed("pack", utils.pack_entities(events, state.customer_id, max_size),
+                                              nested=[events], profile=True))
+        events = stats.timed("dedup", state.dedup_index.filter(events), nested=[events])
+        return count_oversize(stats.timed("pack", utils.pack_entities(events, state.customer_id, max_size, key=dedup.entity_key),
+                                          nested=[events], profile=True))
+
+    # every collection has its own cursor, checkpoint and page cost; they
+    # share the uploads, taking turns, and the deadline of the invocation
+    shared = len(state.collections) > 1
+    results = {}
+    def ingest(collection):
+        label = f"[{collection}] " if shared else ""
+        budget = invocation.fork() if shared else invocation
+        held = leases[collection]
+        # a checkpoint is saved as soon as its page is acknowledged, so a
+        # run killed by the platform resumes from it
+        store = lease.LeasedCheckpointStore(
+            checkpoint.store_from_env(CTM_NEXT, key=collection if shared else ""), held)
+        start = store.load()
+
+        added_after = start.added_after or start_time
+        if start.next == checkpoint.NO_MORE_DATA:
+            print(f"{label}Intermediary next indicator not present, fetching from {added_after} timestamp")
+        elif start.next != "":
+            print(f"{label}Present and intermediary next, start fetching using [{start.next}] next value")
+        if start.offset:
+            print(f"{label}Skipping the first {start.offset} entities{' by priority' if start.ranked_at else ''}, already sent")
+        # a page resumed in the middle keeps the order of the run that started it
+        ranker = priority.PriorityWindow() if priority_scheduling or start.ranked_at else None
+        def ranked_at(resumed):
+            if resumed:
+                return start.ranked_at
+            return ranker.reference if priority_scheduling else 0.0
+        def transform_page(objects, skip):
+            if ranker is None:
+                return transform(objects, skip)
+            return transform(objects, skip, ranker, ranked_at(skip > 0))
 
+        base = collection_url(collection)
+        # a run resumes with the page size reached by the previous one
+        sizer = page_sizer(start.page_size or page_size) if page_size else None
+        # cursor -> size its page was requested with
+        requested_sizes = {}
+        def page_url(cursor, size):
+            query = []
+            if cursor == checkpoint.NO_MORE_DATA:
+                query.append(f"added_after={added_after}")
+            elif cursor != "":
+                query.append(f"next={cursor}")
+            if size:
+                query.append(f"{page_param}={size}")
+            return f"{base}?{'&'.join(query)}" if query else base
 
-      
\ No newline at end of file
+        def fetch(cursor):
+            requested = sizer.size if sizer is not None else 0
+            # a page resumed in the middle is requested with its size, the
+            # offset counts entities of the page as it was fetched
+            if sizer is None and cursor == start.next and start.offset:
+                requested = start.page_size
+            requested_sizes[cursor] = requested
+            url = page_url(cursor, requested)
+            started = time.perf_counter()
+            def observe(items, size_bytes, more):
+                if sizer is not None:
+                    sizer.observe(requested, items, size_bytes, time.perf_counter() - started,
+                                  more, engine.backlog())
+            def get():
+                with stats.timer("get"):
+                    try:
+                        response = get_policy.call(lambda: state.http_transport.get(url, headers=headers_get, stream=stream_pages))
+                    except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                        # CTM unreachable after the retries, status 0 is answered as a bad gateway
+                        print(f"{label}Error GET: {e}")
+                        raise pipeline.FetchError(str(e), 0) from e
+                if response.status_code != 200:
+                    print(f"{label}Error GET: {response.text}")
+                    raise pipeline.FetchError(response.text, response.status_code)
+                return response
+            # with stream_pages only the headers are read here, the body is
+            # downloaded while it is parsed and counted in the parse stage;
+            # a body cut short is downloaded again, then ends the run
+            response = get()
+            if stream_pages:
+                return streaming.PageStream(stream_body(response),
+                                            on_end=lambda page: observe(page.count, page.bytes, page.more),
+                                            reopen=lambda: stream_body(get()), retry_on=(pipeline.FetchError,),
+                                            attempts=get_policy.max_attempts)
+            stats.count("get.bytes", len(response.content))
+            with stats.timer("parse"):
+                data = response.json()
+            stats.count("parse.items", len(data['objects']))
+            observe(len(data['objects']), len(response.content), bool(data['more']))
+            return data
+
+        # the checkpoint only moves past entities once Chronicle accepted them
+        progress = {"checkpoint": start}
+        # cursor -> position in the run of its page, for the pages reached
+        page_index = {start.next: 0}
+        def on_checkpoint(cp):
+            if cp.offset and cp.next == checkpoint.NO_MORE_DATA:
+                cp.added_after = added_after
+            if cp.offset and ranker is not None:
+                cp.ranked_at = ranked_at(cp.next == start.next and start.offset > 0)
+            if sizer is not None:
+                # the offset counts entities of the page as it was fetched
+                cp.page_size = requested_sizes.get(cp.next, sizer.size) if cp.offset else sizer.size
+            elif cp.offset:
+                cp.page_size = requested_sizes.get(cp.next, 0)
+            progress["checkpoint"] = cp
+            with stats.timer("checkpoint"):
+                store.save(cp)
+            stats.event("checkpoint", collection=collection, checkpoint=cp.dumps())
+
+        def on_page(page):
+            budget.page_done()
+            page_index[page.next] = page.index + 1
+
+        engine = pipeline.Pipeline(
+            fetch, transform_page, uploader.lane(collection) if shared else uploader,
+            queue_size=queue_size, stream=stream_pages,
+            accumulator=pipeline.BatchAccumulator(max_size, batch_max_entities, batch_max_age))
+        status = "error"
+        try:
+            # once Chronicle fails, the page in progress is spooled and the run stops
+            # a run that lost its lease stops at once, the pages are the new owner's
+            status = engine.run(start, on_checkpoint, lambda: budget.should_stop() or uploader.spooling,
+                                lambda: budget.must_stop() or (held is not None and held.lost),
+                                on_page=on_page)
+            return status
+        except pipeline.FetchError as e:
+            status = f"GET error {e.status_code}"
+            raise
+        except pipeline.UploadError as e:
+            status = f"POST error {e.status_code}"
+            raise
+        finally:
+            if held is not None and held.lost:
+                print(f"{label}Lease lost to {held.holder.owner if held.holder else 'expiry'}, checkpoint not saved")
+                status = "LEASE LOST"
+            else:
+                with stats.timer("checkpoint"):
+                    store.flush()
+            results[collection] = {"status": status, "pages": budget.pages,
+                                   "checkpoint": progress["checkpoint"].dumps()}
+            if sizer is not None:
+                results[collection]["page_size"] = sizer.as_dict()
+            if ranker is not None:
+                # the entities ranked after the cut of the page the checkpoint is in
+                if status != "ok" and progress["checkpoint"].next in page_index:
+                    ranker.defer(page_index[progress["checkpoint"].next], progress["checkpoint"].offset)
+                stats.count("priority.dropped", ranker.dropped)
+                stats.count("priority.deferred", ranker.deferred)
+                results[collection]["priority"] = ranker.as_dict()
+
+    # a collection whose checkpoint is leased by a running invocation is left
+    # to it; the lease is taken before the checkpoint is loaded
+    leases = {}
+    for collection in state.collections:
+        held, holder = take_lease(collection if shared else "", stats)
+        if holder is not None:
+            print(f"Collection {collection} leased by {holder.owner} for "
+                  f"{max(0, holder.expires - time.time()):.0f}s, skipped")
+            results[collection] = {"status": "LEASED", "pages": 0, "owner": holder.owner}
+            continue
+        leases[collection] = held
+    if not leases:
+        uploader.close()
+        emit_summary(stats, "LEASED", uploader, get_policy, spool_start, collections=results)
+        return "LEASED"
+
+    errors = []
+    try:
+        try:
+            drain_spool(uploader, stats, invocation)
+        except pipeline.UploadError as e:
+            uploader.close()
+            emit_summary(stats, f"POST error {e.status_code}", uploader, get_policy, spool_start)
+            # 0 stands for a connection error, answered as a bad gateway
+            return e.text, e.status_code or 502
+        try:
+            with ThreadPoolExecutor(max_workers=len(leases), thread_name_prefix="collection") as executor:
+                for future in [executor.submit(ingest, collection) for collection in leases]:
+                    try:
+                        future.result()
+                    except (pipeline.FetchError, pipeline.UploadError) as e:
+                        errors.append(e)
+        finally:
+            uploader.close()
+    finally:
+        for held in leases.values():
+            release_lease(held, stats)
+    statuses = [result["status"] for result in results.values()]
+    status = "ok"
+    if errors:
+        status = next((s for s in statuses if s not in ("ok", "TIMEOUT", "LEASED", "LEASE LOST")), statuses[0])
+    elif uploader.spooling:
+        status = "SPOOLED"
+    elif "TIMEOUT" in statuses:
+        status = "TIMEOUT"
+    emit_summary(stats, status, uploader, get_policy, spool_start,
+                 pages=sum(result["pages"] for result in results.values()),
+                 collections=results)
+
+    if errors:
+        # 0 stands for a connection error, answered as a bad gateway
+        return errors[0].text, errors[0].status_code or 502
+    if status == "SPOOLED":
+        appended = state.batch_spool.appended - spool_start["appended"]
+        print(f"Chronicle unavailable, {appended} batches spooled to {spool_path}")
+        return "SPOOLED"
+    if status == "TIMEOUT":
+        print(f'TIMEOUT FUNCTION after {invocation.elapsed():.0f}s, '
+              f'{sum(result["pages"] for result in results.values())} pages! updating CTM_NEXT secret..')
+        return "TIMEOUT"
+    print('no more data to sent')
+    return "ok"
@@ -0,0 +1,244 @@
+"""Declarative mapping of the CTM360 observable types to UDM entities.
+
+The mapping spec is a JSON (or YAML) document, mapping.json by default:
+
+    {
+      "observables": {
+        "Url": {"entity_type": "URL", "field": "url"},
+        "IPv4-Addr": {"entity_type": "IP_ADDRESS", "field": "ip",
+                      "extract": "(\\d+\\.\\d+\\.\\d+\\.\\d+)"},
+        "StixFile": [
+          {"length": 32, "when": "^[0-9A-Fa-f]+$", "entity_type": "FILE",
+           "field": "file.md5"},
+          {"entity_type": "FILE", "field": "file.sha256"}
+        ]
+      },
+      "additional": {"ctm_severity": "ctm.severity"}
+    }
+
+Each observable type, the main_observable_type of the CTM extension, has a
+rule or a list of rules tried in order. A rule takes:
+ - entity_type: metadata.entity_type of the entity.
+ - field: UDM path of the indicator value in the "entity" object, "[]"
+   wraps the value in a list; null for entities without a value.
+ - value: path of the value in the STIX object (default "name").
+ - extract: regular expression whose first group is the value sent.
+ - when: regular expression the value must match for the rule to apply.
+ - length: length the value must have for the rule to apply, tested
+   before when.
+Only the last rule of a list may go without when and length.
+ - additional: UDM additional attribute -> path in the STIX object, added
+   to the "additional" ones of the spec.
+
+Paths are dotted, "ctm." standing for the CTM360 extension. The spec is
+compiled once into the Python source of one handler per observable type,
+with the lookups and constants of its rules inlined, so entities are built
+without reading the spec again.
+"""
+
+import json
+import os
+import re
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import udm
+import utils
+
+# Environment variables
+ENV_UDM_MAPPING_PATH = "UDM_MAPPING_PATH"
+
+# Extension holding the CTM360 attributes of every STIX indicator.
+CTM_EXTENSION = "extension-definition--ea279b3e-5c71-4632-ac08-831c66a786ba"
+DEFAULT_SPEC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "mapping.json")
+
+# Attributes of "additional" always set by udm.UdmEntity.
+RESERVED_ADDITIONAL = (
+    "score", "description", "extension_type", "type", "detection",
+    "labels", "pattern", "pattern_type", "pattern_version",
+)
+
+_RULE_KEYS = {"entity_type", "field", "value", "extract", "when", "length", "additional"}
+_SPEC_KEYS = {"observables", "additional"}
+
+# Handlers return the entity type, the udm.FIELDS path and the indicator
+# value, and the extra additional attributes; None when the value can not be
+# extracted.
+Handler = Callable[[Dict[str, Any]], Optional[Tuple[str, Optional[str], Any, Tuple]]]
+
+
+def load_spec(path: Optional[str] = None) -> Dict[str, Any]:
+    """Reads a mapping spec.
+
+    Args:
+      path (str): JSON file, or YAML file when it ends with .yaml or .yml.
+        Defaults to mapping.json next to this module.
+
+    Returns:
+      dict: The spec.
+    """
+    path = path or DEFAULT_SPEC
+    with open(path, encoding="utf-8") as f:
+        if path.endswith((".yaml", ".yml")):
+            # imported here, the JSON specs are read without PyYAML
+            import yaml  # pylint: disable=import-outside-toplevel
+            return yaml.safe_load(f)
+        return json.load(f)
+
+
+def spec_from_env() -> Dict[str, Any]:
+    """Reads the spec at UDM_MAPPING_PATH, or the default one."""
+    return load_spec(utils.get_env_var(ENV_UDM_MAPPING_PATH, required=False))
+
+
+def _keys(path: str) -> List[str]:
+    keys = path.split(".")
+    if keys[0] == "ctm":
+        keys[0:1] = ["extensions", CTM_EXTENSION]
+    return keys
+
+
+def _getter(path: str) -> Callable[[Dict[str, Any]], Any]:
+    """Compiles a dotted path into a function returning its value or ABSENT."""
+    keys = _keys(path)
+    absent = udm.ABSENT
+
+    def get(obj):
+        for key in keys:
+            if not isinstance(obj, dict) or key not in obj:
+                return absent
+            obj = obj[key]
+        return obj
+    return get
+
+
+def _additional(attributes: Dict[str, str], where: str) -> Optional[Callable[[Dict[str, Any]], Tuple]]:
+    """Compiles the additional attributes into a function returning the pairs set."""
+    for name in attributes:
+        if name in RESERVED_ADDITIONAL:
+            raise ValueError(f"{where}: additional attribute {name} is set by every entity.")
+    if not attributes:
+        return None
+    getters = tuple((udm.intern(name), _getter(path)) for name, path in attributes.items())
+    absent = udm.ABSENT
+
+    def extra(obj):
+        pairs = []
+        for name, get in getters:
+            value = get(obj)
+            if value is not absent:
+                pairs.append((name, value))
+        return tuple(pairs)
+    return extra
+
+
+def _rule_source(rule: Dict[str, Any], index: int, last: bool, read: Optional[str],
+                 namespace: Dict[str, Any], additional: Dict[str, str],
+                 where: str) -> Tuple[List[str], Optional[str]]:
+    """Python source of a rule, adding the objects it refers to to namespace.
+
+    read is the lookup already held by ``value``, returned updated.
+    """
+    unknown = set(rule) - _RULE_KEYS
+    if unknown:
+        raise ValueError(f"{where}: unknown keys {sorted(unknown)}.")
+    if "entity_type" not in rule:
+        raise ValueError(f"{where}: entity_type is missing.")
+    guarded = "when" in rule or "length" in rule
+    if not guarded and not last:
+        raise ValueError(f"{where}: the rules after it are never applied, it has no when or length.")
+    entity_type = repr(udm.intern(rule["entity_type"]))
+    extra = _additional({**additional, **rule.get("additional", {})}, where)
+    pairs = "()"
+    if extra is not None:
+        namespace[f"extra_{index}"] = extra
+        pairs = f"extra_{index}(obj)"
+    if not rule.get("field"):
+        if guarded:
+            raise ValueError(f"{where}: when and length need a field.")
+        return [f"    return {entity_type}, None, None, {pairs}"], read
+    field = repr(udm.field(rule["field"]))
+    lookup = "".join(f"[{key!r}]" for key in _keys(rule.get("value", "name")))
+    missing = f"return {entity_type}, None, None, {pairs}"
+    if lookup == read:
+        lines = [] if guarded else ["    if value is ABSENT:", f"        {missing}"]
+    else:
+        lines = [
+            "    try:",
+            f"        value = obj{lookup}",
+            "    except (KeyError, TypeError):",
+            "        value = ABSENT" if guarded else f"        {missing}",
+        ]
+    tests = ["value is not ABSENT"]
+    if "length" in rule:
+        tests.append(f"len(value) == {int(rule['length'])}")
+    if "when" in rule:
+        namespace[f"when_{index}"] = re.compile(rule["when"]).search
+        tests.append(f"when_{index}(value)")
+    indent = "        "
+    if guarded:
+        lines.append(f"    if {' and '.join(tests)}:")
+    else:
+        indent = "    "
+    if "extract" in rule:
+        pattern = re.compile(rule["extract"])
+        if pattern.groups < 1:
+            raise ValueError(f"{where}: extract needs a group.")
+        namespace[f"extract_{index}"] = pattern.search
+        lines += [
+            f"{indent}match = extract_{index}(value)",
+            f"{indent}if match is None:",
+            f"{indent}    return None",
+            f"{indent}return {entity_type}, {field}, match.group(1), {pairs}",
+        ]
+    else:
+        lines.append(f"{indent}return {entity_type}, {field}, value, {pairs}")
+    return lines, lookup
+
+
+def _observable(observable_type: str, rules: Any, additional: Dict[str, str]) -> Handler:
+    """Compiles the rules of an observable type into its handler."""
+    if isinstance(rules, dict):
+        rules = [rules]
+    namespace: Dict[str, Any] = {"ABSENT": udm.ABSENT}
+    lines = ["def handler(obj):"]
+    read = None
+    for index, rule in enumerate(rules):
+        rule_lines, read = _rule_source(rule, index, index == len(rules) - 1, read, namespace,
+                                        additional, f"{observable_type} rule {index}")
+        lines += rule_lines
+    if not rules or "when" in rules[-1] or "length" in rules[-1]:
+        # no rule applied
+        lines.append("    return None")
+    source = "\n".join(lines)
+    # the handler is built in a function so that the objects it refers to
+    # are read from its closure, not from the globals
+    build = f"def build({', '.join(namespace)}):\n" + \
+        "\n".join("    " + line for line in lines) + "\n    return handler"
+    code: Dict[str, Any] = {}
+    exec(compile(build, f"<mapping {observable_type}>", "exec"), code)  # pylint: disable=exec-used
+    handler = code["build"](**namespace)
+    handler.source = source
+    return handler
+
+
+def compile_spec(spec: Dict[str, Any]) -> Dict[str, Handler]:
+    """Compiles a mapping spec into a handler per observable type.
+
+    Args:
+      spec (dict): The mapping spec, see the module docstring.
+
+    Returns:
+      Dict[str, Handler]: Observable type -> handler of its STIX objects,
+        its Python source in the ``source`` attribute.
+
+    Raises:
+      ValueError: If the spec is not valid.
+    """
+    unknown = set(spec) - _SPEC_KEYS
+    if unknown:
+        raise ValueError(f"Mapping spec: unknown keys {sorted(unknown)}.")
+    additional = spec.get("additional") or {}
+    return {
+        observable_type: _observable(observable_type, rules, additional)
+        for observable_type, rules in spec.get("observables", {}).items()
+    }
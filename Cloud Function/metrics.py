@@ -0,0 +1,320 @@
+"""Per stage timings and counters of an ingestion run.
+
+A Metrics instance collects, for one invocation, latency histograms of the
+stages (CTM GET, JSON parse, transform, packing, batchCreate POST, secret
+access), byte and entity counters, and a bounded buffer of structured events
+that replaces the prints once emitted per page. summary() turns them into a
+single JSON compatible document, written by a sink at the end of the run.
+"""
+
+import bisect
+import cProfile
+import io
+import json
+import pstats
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterable, Iterator, List
+
+import utils
+
+# Environment variables
+ENV_METRICS_BACKEND = "METRICS_BACKEND"
+ENV_METRICS_PATH = "METRICS_PATH"
+ENV_METRICS_PROFILE = "METRICS_PROFILE"
+
+LOGGER_NAME = "ctm360-ingestion"
+
+# Upper bounds of the histogram buckets, in seconds.
+BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5,
+           1.0, 2.0, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+# Events kept for the summary, later ones are only counted.
+MAX_EVENTS = 500
+
+# Functions listed in the profile of the summary.
+PROFILE_LINES = 25
+
+
+class Histogram:
+    """Durations of a stage, in fixed buckets."""
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = float("inf")
+        self.max = 0.0
+
+    def observe(self, seconds: float):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.min = min(self.min, seconds)
+        self.max = max(self.max, seconds)
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket holding the q quantile."""
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "count": self.count,
+            "total_seconds": round(self.total, 6),
+            "mean_seconds": round(self.total / self.count, 6) if self.count else 0,
+            "min_seconds": round(self.min, 6) if self.count else 0,
+            "max_seconds": round(self.max, 6),
+            "p50_seconds": self.quantile(0.5),
+            "p95_seconds": self.quantile(0.95),
+            "buckets": {
+                str(bound): count
+                for bound, count in zip(BUCKETS + ("inf",), self.counts) if count
+            },
+        }
+
+
+class Timed:
+    """Iterator recording the time spent producing the items of another one.
+
+    The time of the nested iterators, consumed by this one, is not counted,
+    so a chain of lazy stages is split between them. The observation is
+    recorded once the iterator is exhausted.
+
+    Attributes:
+      elapsed (float): Seconds spent in the wrapped iterator so far.
+      count (int): Items produced so far.
+    """
+
+    def __init__(self, metrics: "Metrics", stage: str, items: Iterable[Any],
+                 nested: Iterable["Timed"] = (), profile: bool = False):
+        self.metrics = metrics
+        self.stage = stage
+        self.nested = tuple(nested)
+        self.profile = profile and metrics.profiler is not None
+        self.elapsed = 0.0
+        self.count = 0
+        self._items = iter(items)
+
+    def __iter__(self) -> Iterator[Any]:
+        return self
+
+    def __next__(self) -> Any:
+        if self.profile:
+            self.metrics.profiler.enable()
+        started = time.perf_counter()
+        try:
+            item = next(self._items)
+        except StopIteration:
+            self.elapsed += time.perf_counter() - started
+            self.metrics.observe(
+                self.stage, self.elapsed - sum(n.elapsed for n in self.nested))
+            self.metrics.count(f"{self.stage}.items", self.count)
+            raise
+        finally:
+            if self.profile:
+                self.metrics.profiler.disable()
+        self.elapsed += time.perf_counter() - started
+        self.count += 1
+        return item
+
+
+class Metrics:
+    """Thread safe collector of the metrics of a run.
+
+    Args:
+      profile (bool): Profiles the iterators timed with profile=True with
+        cProfile, the slowest functions are added to the summary.
+    """
+
+    def __init__(self, profile: bool = False):
+        self.started = time.time()
+        self.histograms: Dict[str, Histogram] = {}
+        self.counters: Dict[str, float] = {}
+        self.fields: Dict[str, Any] = {}
+        self.events: List[Dict[str, Any]] = []
+        self.dropped = 0
+        self.profiler = cProfile.Profile() if profile else None
+        self._lock = threading.Lock()
+
+    def observe(self, stage: str, seconds: float):
+        """Records a duration of a stage."""
+        with self._lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = Histogram()
+            histogram.observe(seconds)
+
+    @contextmanager
+    def timer(self, stage: str):
+        """Records the duration of the with block as a stage duration."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - started)
+
+    def timed(self, stage: str, items: Iterable[Any],
+              nested: Iterable[Timed] = (), profile: bool = False) -> Timed:
+        """Wraps a lazy stage, see Timed."""
+        return Timed(self, stage, items, nested, profile)
+
+    def count(self, name: str, value: float = 1):
+        """Adds value to a counter."""
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def set(self, **fields: Any):
+        """Adds fields to the summary."""
+        with self._lock:
+            self.fields.update(fields)
+
+    def event(self, message: str, **fields: Any):
+        """Buffers a structured log entry, emitted with the summary."""
+        with self._lock:
+            if len(self.events) >= MAX_EVENTS:
+                self.dropped += 1
+                return
+            self.events.append(dict(fields, message=message,
+                                    time=round(time.time() - self.started, 3)))
+
+    def merge(self, other: "Metrics"):
+        """Adds the histograms and counters of another collector."""
+        with self._lock, other._lock:  # pylint: disable=protected-access
+            for stage, histogram in other.histograms.items():
+                mine = self.histograms.setdefault(stage, Histogram())
+                mine.counts = [a + b for a, b in zip(mine.counts, histogram.counts)]
+                mine.count += histogram.count
+                mine.total += histogram.total
+                mine.min = min(mine.min, histogram.min)
+                mine.max = max(mine.max, histogram.max)
+            for name, value in other.counters.items():
+                self.counters[name] = self.counters.get(name, 0) + value
+
+    def _profile(self) -> List[str]:
+        out = io.StringIO()
+        stats = pstats.Stats(self.profiler, stream=out)
+        stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(PROFILE_LINES)
+        return [line for line in out.getvalue().splitlines() if line.strip()]
+
+    def summary(self, **fields: Any) -> Dict[str, Any]:
+        """Returns the metrics of the run as a JSON compatible dict.
+
+        Args:
+          **fields: Added to the summary, e.g. the status of the run.
+        """
+        with self._lock:
+            summary = {
+                "message": "ingestion summary",
+                "elapsed_seconds": round(time.time() - self.started, 3),
+                **self.fields,
+                **fields,
+                "stages": {stage: histogram.summary()
+                           for stage, histogram in sorted(self.histograms.items())},
+                "counters": dict(sorted(self.counters.items())),
+                "events": list(self.events),
+                "events_dropped": self.dropped,
+            }
+        if self.profiler is not None:
+            summary["profile"] = self._profile()
+        return summary
+
+
+class Sink:
+    """Destination of the summaries."""
+
+    def emit(self, summary: Dict[str, Any]):
+        raise NotImplementedError
+
+
+class StdoutSink(Sink):
+    """Prints the summary as a JSON line, parsed by Cloud Logging as well."""
+
+    def emit(self, summary: Dict[str, Any]):
+        print(json.dumps(summary, default=str))
+
+
+class CloudLoggingSink(Sink):
+    """Writes the summary as a structured Cloud Logging entry.
+
+    Args:
+      name (str): Name of the log.
+    """
+
+    def __init__(self, name: str = LOGGER_NAME):
+        # imported here, the other sinks run without google-cloud-logging
+        import google.cloud.logging  # pylint: disable=import-outside-toplevel
+        self.logger = google.cloud.logging.Client().logger(name)
+
+    def emit(self, summary: Dict[str, Any]):
+        try:
+            self.logger.log_struct(json.loads(json.dumps(summary, default=str)),
+                                   severity="INFO")
+        except Exception as e:  # pylint: disable=broad-except
+            print(f"Cloud Logging error: {e}")
+            StdoutSink().emit(summary)
+
+
+class JsonFileSink(Sink):
+    """Appends the summary to a JSON lines file.
+
+    Args:
+      path (str): Path of the file.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def emit(self, summary: Dict[str, Any]):
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(summary, default=str) + "\n")
+
+
+class NullSink(Sink):
+    """Drops the summary."""
+
+    def emit(self, summary: Dict[str, Any]):
+        pass
+
+
+def sink_from_env(default: str = "cloud_logging") -> Sink:
+    """Builds the sink selected by METRICS_BACKEND.
+
+    Args:
+      default (str): Backend used when METRICS_BACKEND is not set.
+
+    Returns:
+      Sink: "cloud_logging", "file" (appending to METRICS_PATH), "stdout" or
+        "none". Cloud Logging falls back to stdout when its client can not
+        be created.
+
+    Raises:
+      ValueError: If the backend is unknown.
+    """
+    backend = utils.get_env_var(ENV_METRICS_BACKEND, required=False, default=default)
+    if backend == "cloud_logging":
+        try:
+            return CloudLoggingSink()
+        except Exception as e:  # pylint: disable=broad-except
+            print(f"Cloud Logging unavailable, metrics printed instead: {e}")
+            return StdoutSink()
+    if backend == "file":
+        return JsonFileSink(utils.get_env_var(ENV_METRICS_PATH, required=False,
+                                              default="metrics.jsonl"))
+    if backend == "stdout":
+        return StdoutSink()
+    if backend == "none":
+        return NullSink()
+    raise ValueError(f"Invalid metrics backend {backend}.")
+
+
+def profile_from_env() -> bool:
+    """True when METRICS_PROFILE enables the cProfile hook."""
+    return utils.get_env_var(ENV_METRICS_PROFILE, required=False,
+                             default="false").lower() == "true"
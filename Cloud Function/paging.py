@@ -0,0 +1,106 @@
+"""Size of the CTM pages, tuned while the feed is walked.
+
+Small pages spend most of their time on the per request overhead of the CTM
+API, large ones hold a lot of memory and delay the first upload of a run.
+The CTM requests carry a page size parameter whose value PageSizer adjusts
+after every page from the GET latency, the response size and the backlog
+of the pipeline stage after the fetch:
+ - a page over the byte or latency bound shrinks the next ones in
+   proportion;
+ - while the stage after the fetch waits for pages, the size doubles, as
+   far as the bytes and seconds per indicator measured so far allow;
+ - while pages wait for that stage, the fetch is not what limits the run
+   and the size stays.
+A page shorter than requested while the feed goes on reveals the largest
+page the server serves, which becomes the upper bound. The size reached is
+saved with the checkpoint, so the next invocation starts from it.
+"""
+
+from typing import Optional
+
+# Environment variables
+ENV_CTM_PAGE_SIZE = "CTM_PAGE_SIZE"
+ENV_CTM_PAGE_MIN = "CTM_PAGE_MIN"
+ENV_CTM_PAGE_MAX = "CTM_PAGE_MAX"
+ENV_CTM_PAGE_MAX_MB = "CTM_PAGE_MAX_MB"
+ENV_CTM_PAGE_MAX_SECONDS = "CTM_PAGE_MAX_SECONDS"
+ENV_CTM_PAGE_PARAM = "CTM_PAGE_PARAM"
+
+
+class PageSizer:
+    """Picks the number of indicators requested per CTM page.
+
+    Args:
+      size (int): Size of the first page, clamped to the bounds.
+      minimum (int): Smallest size requested.
+      maximum (int): Largest size requested.
+      max_bytes (int): Response size a page should stay under.
+      max_seconds (float): GET latency a page should stay under.
+      alpha (float): Weight of the last page in the per indicator averages.
+
+    Attributes:
+      size (int): Size of the next page.
+      cap (int): Largest page served by the server, as observed; None until
+        a short page is seen.
+      adjustments (int): Times the size changed.
+    """
+
+    def __init__(self, size: int = 1000, minimum: int = 100, maximum: int = 5000,
+                 max_bytes: int = 16 << 20, max_seconds: float = 10, alpha: float = 0.3):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.alpha = alpha
+        self.cap: Optional[int] = None
+        self.adjustments = 0
+        self.size = self._clamp(size)
+        self._bytes_per_item: Optional[float] = None
+        self._seconds_per_item: Optional[float] = None
+
+    def _average(self, current: Optional[float], value: float) -> float:
+        if current is None:
+            return value
+        return self.alpha * value + (1 - self.alpha) * current
+
+    def _clamp(self, size: float) -> int:
+        upper = self.maximum if self.cap is None else min(self.maximum, self.cap)
+        return int(max(self.minimum, min(upper, size)))
+
+    def observe(self, requested: int, items: int, size_bytes: int, seconds: float,
+                more: bool, backlog: float) -> int:
+        """Updates the size from a page, returning the size of the next one.
+
+        Args:
+          requested (int): Size the page was requested with.
+          items (int): Indicators it held.
+          size_bytes (int): Bytes of the response body.
+          seconds (float): Time from the request to the end of the body.
+          more (bool): Value of the CTM ``more`` flag.
+          backlog (float): Share of the queue after the fetch stage in use,
+            0 when that stage waits for pages, 1 when it is full.
+        """
+        if not more or items <= 0:
+            # the last page of the feed is as long as what was left
+            return self.size
+        if items < requested:
+            self.cap = items
+        self._bytes_per_item = self._average(self._bytes_per_item, size_bytes / items)
+        self._seconds_per_item = self._average(self._seconds_per_item, seconds / items)
+        size = self.size
+        if size_bytes > self.max_bytes or seconds > self.max_seconds:
+            size = items * min(self.max_bytes / max(size_bytes, 1), self.max_seconds / max(seconds, 1e-9))
+        elif backlog < 0.5:
+            # the latency per indicator includes the request overhead, so the
+            # bound on seconds is conservative for a larger page
+            size = min(2 * size,
+                       self.max_bytes / self._bytes_per_item,
+                       self.max_seconds / max(self._seconds_per_item, 1e-9))
+        size = self._clamp(size)
+        if size != self.size:
+            self.adjustments += 1
+            self.size = size
+        return size
+
+    def as_dict(self):
+        return {"size": self.size, "cap": self.cap, "adjustments": self.adjustments}
@@ -0,0 +1,431 @@
+"""Staged fetch -> transform -> post pipeline for the CTM360 ingestion loop.
+
+Every stage runs in its own thread and hands work to the next one through a
+bounded queue: the next CTM page is downloaded while the current one is
+converted and sent to Chronicle, and no more than ``queue_size`` pages wait
+between two stages. The batches of consecutive pages are coalesced by a
+BatchAccumulator before they are posted.
+"""
+
+import queue
+import threading
+import time
+from concurrent import futures
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+import utils
+from checkpoint import Checkpoint, NO_MORE_DATA
+from utils import Batch
+
+# Environment variables
+ENV_BATCH_MAX_AGE = "BATCH_MAX_AGE"
+ENV_BATCH_MAX_ENTITIES = "BATCH_MAX_ENTITIES"
+
+# Marks the end of the stream in a stage queue.
+_DONE = object()
+
+
+@dataclass
+class Page:
+    """A CTM page travelling through the pipeline.
+
+    Attributes:
+      index (int): Position of the page in the current run, starting at 0.
+      cursor (str): Cursor used to fetch the page.
+      more (bool): Value of the CTM ``more`` flag.
+      next (str): Value of the CTM ``next`` cursor.
+      skip (int): Leading entities of the page acknowledged in a previous
+        run, which are not sent again.
+      objects (list): STIX objects of the page, dropped once transformed.
+      batches (list): batchCreate request bodies built from ``objects``,
+        empty in stream mode where batches travel on their own.
+    """
+    index: int
+    cursor: str
+    more: bool
+    next: str
+    skip: int = 0
+    objects: Optional[List[Dict[str, Any]]] = None
+    batches: Optional[List[Any]] = None
+
+
+def _put(q: queue.Queue, item: Any, stop: threading.Event) -> bool:
+    """Puts item in a bounded queue, giving up when the pipeline is stopped."""
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _get(q: queue.Queue, stop: threading.Event) -> Any:
+    """Gets the next item of a queue, returning _DONE when stopped."""
+    while not stop.is_set():
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            continue
+    return _DONE
+
+
+class FetchError(Exception):
+    """Raised when a CTM page can not be downloaded."""
+
+    def __init__(self, text: str, status_code: int):
+        # both arguments are kept in args so the error can be pickled back
+        # from a worker process
+        super().__init__(text, status_code)
+        self.text = text
+        self.status_code = status_code
+
+    def __str__(self):
+        return f"GET failed with status {self.status_code}: {self.text}"
+
+
+class UploadError(Exception):
+    """Raised when Chronicle rejects a batchCreate request."""
+
+    def __init__(self, text: str, status_code: int):
+        super().__init__(text, status_code)
+        self.text = text
+        self.status_code = status_code
+
+    def __str__(self):
+        return f"POST failed with status {self.status_code}: {self.text}"
+
+
+def acked_position(inflight: List[Tuple[futures.Future, Checkpoint]]) -> Optional[Checkpoint]:
+    """Position in the feed after the leading batches that were all acknowledged."""
+    position = None
+    for future, end in inflight:
+        if not future.done() or future.exception() is not None:
+            break
+        position = end
+    return position
+
+
+class BatchAccumulator:
+    """Coalesces the batches of consecutive pages into fuller requests.
+
+    Incremental runs fetch pages of a few dozen indicators, each of which
+    would otherwise be posted as a small batchCreate request of its own. The
+    accumulator holds the last batch and merges the next ones into it until
+    the next one does not fit in max_size bytes or max_entities entities,
+    or until the held batch is max_age seconds old. It remembers where its
+    first entity is in the feed, the checkpoint does not move past it.
+
+    Args:
+      max_size (int): Largest request body, in bytes.
+      max_entities (int): Most entities in a request, 0 for no limit.
+      max_age (float): Seconds a batch is held waiting for more entities; 0
+        posts it at the end of its page.
+      clock (Callable[[], float]): Monotonic time source.
+
+    Attributes:
+      start (Checkpoint): Position of the first entity held, None when
+        nothing is held.
+    """
+
+    def __init__(self, max_size: int = 1048576, max_entities: int = 0,
+                 max_age: float = 0, clock: Callable[[], float] = time.monotonic):
+        self.max_size = max_size
+        self.max_entities = max_entities
+        self.max_age = max_age
+        self.clock = clock
+        self.start: Optional[Checkpoint] = None
+        self._batches: List[Batch] = []
+        self._end: Optional[Checkpoint] = None
+        self._size = 0
+        self._count = 0
+        self._since = 0.0
+
+    def _fits(self, batch: Batch) -> bool:
+        if self.max_entities and self._count + batch.count > self.max_entities:
+            return False
+        return self._size + len(batch.body) - utils.batch_overhead(batch) + 1 <= self.max_size
+
+    def add(self, batch: Batch, start: Checkpoint, end: Checkpoint) -> List[Tuple[Batch, Checkpoint]]:
+        """Adds a batch, returning the requests to post now.
+
+        Args:
+          batch (Batch): The next batch of the feed.
+          start (Checkpoint): Position of its first entity.
+          end (Checkpoint): Position after its last entity.
+
+        Returns:
+          List[Tuple[Batch, Checkpoint]]: Requests to post, with the position
+            reached once each is acknowledged.
+        """
+        ready = []
+        if self._batches and not self._fits(batch):
+            ready.append(self.flush())
+        if not self._batches:
+            self.start = start
+            self._size = len(batch.body)
+            self._since = self.clock()
+        else:
+            self._size += len(batch.body) - utils.batch_overhead(batch) + 1
+        self._batches.append(batch)
+        self._count += batch.count
+        self._end = end
+        if self.max_entities and self._count >= self.max_entities:
+            ready.append(self.flush())
+        return ready
+
+    def remaining(self) -> float:
+        """Seconds until the held batch is due, 0 when due or nothing is held."""
+        if not self._batches:
+            return float("inf")
+        return max(0.0, self._since + self.max_age - self.clock())
+
+    def due(self) -> bool:
+        """Whether a batch is held for max_age seconds or longer."""
+        return bool(self._batches) and self.remaining() <= 0
+
+    def flush(self) -> Optional[Tuple[Batch, Checkpoint]]:
+        """Returns the held entities as one request and their end position."""
+        if not self._batches:
+            return None
+        taken = (utils.join_batches(self._batches), self._end)
+        self._batches = []
+        self._size = self._count = 0
+        self.start = self._end = None
+        return taken
+
+
+class Pipeline:
+    """Runs the fetch, transform and post stages concurrently.
+
+    In page mode the fetch stage decodes a whole CTM page before handing it
+    to the transform stage. In stream mode the objects are transformed and
+    packed while the page is downloaded and every batch is handed to the
+    uploader as soon as it is full, so memory does not grow with page size.
+
+    Args:
+      fetch (Callable[[str], Any]): Downloads the CTM page of a cursor.
+        Returns the decoded JSON in page mode and a streaming.PageStream in
+        stream mode. Raises on errors.
+      transform (Callable[[Iterable, int], Iterable]): Converts the STIX
+        objects of a page into batchCreate request bodies, leaving out the
+        given number of leading entities.
+      uploader (BatchUploader): Sends the batches to Chronicle.
+      queue_size (int): Maximum number of pages (batches in stream mode)
+        waiting between two stages.
+      stream (bool): Enables stream mode.
+      accumulator (BatchAccumulator): Coalesces the batches across pages,
+        by default the batches of a page are posted before its end.
+    """
+
+    def __init__(
+        self,
+        fetch: Callable[[str], Any],
+        transform: Callable[[Iterable[Dict[str, Any]], int], Iterable[Any]],
+        uploader: Any,
+        queue_size: int = 2,
+        stream: bool = False,
+        accumulator: Optional[BatchAccumulator] = None,
+    ):
+        self.fetch = fetch
+        self.transform = transform
+        self.uploader = uploader
+        self.queue_size = max(1, queue_size)
+        self.stream = stream
+        self.accumulator = accumulator or BatchAccumulator()
+        # queue fed by the fetch stage of the current run
+        self._fed: Optional[queue.Queue] = None
+
+    def backlog(self) -> float:
+        """Share of the queue after the fetch stage in use, from 0 to 1.
+
+        0 when the next stage waits for pages, 1 when pages wait for it.
+        """
+        if self._fed is None:
+            return 0.0
+        return self._fed.qsize() / self.queue_size
+
+    def _fetch_stage(self, start: Checkpoint, out: queue.Queue,
+                     stop: threading.Event):
+        cursor, skip, index = start.next, start.offset, 0
+        try:
+            while not stop.is_set():
+                data = self.fetch(cursor)
+                page = Page(index, cursor, bool(data['more']), data.get('next', ""),
+                            skip=skip, objects=data['objects'])
+                if not _put(out, page, stop) or not page.more:
+                    break
+                cursor, skip, index = page.next, 0, index + 1
+        except Exception as e:  # pylint: disable=broad-except
+            _put(out, e, stop)
+        _put(out, _DONE, stop)
+
+    def _transform_stage(self, inp: queue.Queue, out: queue.Queue,
+                         stop: threading.Event):
+        while True:
+            page = _get(inp, stop)
+            if page is _DONE or isinstance(page, Exception):
+                _put(out, page, stop)
+                if page is _DONE:
+                    return
+                continue
+            try:
+                page.batches = list(self.transform(page.objects, page.skip))
+            except Exception as e:  # pylint: disable=broad-except
+                _put(out, e, stop)
+                continue
+            page.objects = None
+            _put(out, page, stop)
+
+    def _stream_stage(self, start: Checkpoint, out: queue.Queue,
+                      stop: threading.Event):
+        """Fetches and transforms pages, emitting batches followed by their page."""
+        cursor, skip, index = start.next, start.offset, 0
+        try:
+            while not stop.is_set():
+                objects = self.fetch(cursor)
+                for batch in self.transform(objects, skip):
+                    if not _put(out, batch, stop):
+                        return
+                page = Page(index, cursor, objects.more, objects.next, skip=skip)
+                if not _put(out, page, stop) or not page.more:
+                    break
+                cursor, skip, index = page.next, 0, index + 1
+        except Exception as e:  # pylint: disable=broad-except
+            _put(out, e, stop)
+        _put(out, _DONE, stop)
+
+    def run(
+        self,
+        start: Checkpoint,
+        on_checkpoint: Callable[[Checkpoint], None],
+        should_stop: Callable[[], bool],
+        must_stop: Optional[Callable[[], bool]] = None,
+        on_page: Optional[Callable[[Page], None]] = None,
+    ) -> str:
+        """Runs the pipeline from a checkpoint.
+
+        The post stage runs in the calling thread. At the end of every page,
+        once the batches posted so far are acknowledged, on_checkpoint is
+        called with the new position in the feed: the next page, or the
+        first entity still held by the accumulator. When the run stops in
+        the middle of a page it is called with the end of the acknowledged
+        batches.
+
+        Args:
+          start (Checkpoint): Where to start, the entities before its offset
+            are not sent again.
+          on_checkpoint (Callable[[Checkpoint], None]): Receives the progress.
+          should_stop (Callable[[], bool]): Checked after each page; a True
+            value posts the held batch and stops the run before the next
+            page is posted.
+          must_stop (Callable[[], bool]): Checked before each batch; a True
+            value stops the run in the middle of a page, once the uploads in
+            flight are over.
+          on_page (Callable[[Page], None]): Called once the batches of a page
+            are acknowledged or held, e.g. to measure the cost of a page.
+
+        Returns:
+          str: "ok" when the feed has been exhausted, "TIMEOUT" when the run
+            was stopped by should_stop or must_stop.
+
+        Raises:
+          Exception: The first error raised by any of the stages.
+        """
+        must_stop = must_stop or (lambda: False)
+        stop = threading.Event()
+        transformed = queue.Queue(maxsize=self.queue_size)
+        if self.stream:
+            threads = [
+                threading.Thread(target=self._stream_stage,
+                                 args=(start, transformed, stop), daemon=True),
+            ]
+            self._fed = transformed
+        else:
+            fetched = queue.Queue(maxsize=self.queue_size)
+            self._fed = fetched
+            threads = [
+                threading.Thread(target=self._fetch_stage,
+                                 args=(start, fetched, stop), daemon=True),
+                threading.Thread(target=self._transform_stage,
+                                 args=(fetched, transformed, stop), daemon=True),
+            ]
+        for thread in threads:
+            thread.start()
+        # at most two rounds of uploads are queued in the uploader at a time
+        max_inflight = 2 * self.uploader.concurrency
+        accumulator = self.accumulator
+        accumulator.flush()
+        # position of the next entity: page cursor, offset of the page start
+        # and entities of the page handed to the accumulator
+        cursor, skip, done = start.next, start.offset, 0
+        saved = start
+        # uploads with the position reached once they are acknowledged
+        inflight: List[Tuple[futures.Future, Checkpoint]] = []
+
+        def submit(batch, end):
+            while sum(not f.done() for f, _ in inflight) >= max_inflight:
+                futures.wait([f for f, _ in inflight], return_when=futures.FIRST_COMPLETED)
+            inflight.append((self.uploader.submit(batch), end))
+
+        def flush():
+            taken = accumulator.flush()
+            if taken is not None:
+                submit(*taken)
+
+        def save_partial():
+            futures.wait([f for f, _ in inflight])
+            position = acked_position(inflight)
+            if position is not None:
+                on_checkpoint(position)
+
+        try:
+            while True:
+                try:
+                    item = transformed.get(timeout=min(1.0, max(0.05, accumulator.remaining())))
+                except queue.Empty:
+                    if must_stop():
+                        save_partial()
+                        return "TIMEOUT"
+                    if accumulator.due():
+                        flush()
+                    continue
+                if item is _DONE:
+                    return "ok"
+                if isinstance(item, Exception):
+                    raise item
+                batches = [item] if not isinstance(item, Page) else item.batches or ()
+                for batch in batches:
+                    if must_stop():
+                        save_partial()
+                        return "TIMEOUT"
+                    begin = Checkpoint(cursor, skip + done)
+                    # the oversize entities dropped by pack_entities are passed too
+                    done += batch.skipped + batch.count
+                    for ready in accumulator.add(batch, begin, Checkpoint(cursor, skip + done)):
+                        submit(*ready)
+                if not isinstance(item, Page):
+                    continue
+                stopping = should_stop()
+                if not item.more or stopping or accumulator.due() or not accumulator.max_age:
+                    flush()
+                self.uploader.wait([f for f, _ in inflight])
+                inflight = []
+                if on_page is not None:
+                    on_page(item)
+                if not item.more:
+                    on_checkpoint(Checkpoint(NO_MORE_DATA))
+                    return "ok"
+                cursor, skip, done = item.next, 0, 0
+                position = accumulator.start or Checkpoint(cursor)
+                if position != saved:
+                    on_checkpoint(position)
+                    saved = position
+                if stopping:
+                    return "TIMEOUT"
+        except UploadError:
+            save_partial()
+            raise
+        finally:
+            stop.set()
@@ -0,0 +1,202 @@
+"""Retries and client side rate control for the CTM360 and Chronicle APIs."""
+
+import email.utils
+import random
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Any, Callable, Optional
+
+import requests
+
+# Environment variables
+ENV_RETRY_BASE_DELAY = "RETRY_BASE_DELAY"
+ENV_RETRY_MAX_DELAY = "RETRY_MAX_DELAY"
+
+# Status codes worth retrying: throttling and transient server errors.
+RETRY_STATUSES = frozenset((408, 429, 500, 502, 503, 504))
+
+
+@dataclass
+class RetryStats:
+    """Counters of a RetryPolicy, for reporting.
+
+    Attributes:
+      requests (int): Requests sent, retries included.
+      retries (int): Requests sent again after a retryable failure.
+      throttled (int): 429 responses received.
+      gave_up (int): Calls that still failed after the last attempt.
+    """
+    requests: int = 0
+    retries: int = 0
+    throttled: int = 0
+    gave_up: int = 0
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False,
+                                  compare=False)
+
+    def as_dict(self) -> dict:
+        """Returns the counters, for the metrics summary."""
+        return {"requests": self.requests, "retries": self.retries,
+                "throttled": self.throttled, "gave_up": self.gave_up}
+
+    def add(self, **counts: int):
+        """Increments the given counters."""
+        with self._lock:
+            for name, count in counts.items():
+                setattr(self, name, getattr(self, name) + count)
+
+
+def retry_after(response: Any) -> Optional[float]:
+    """Returns the delay requested by the Retry-After header, in seconds."""
+    value = response.headers.get("Retry-After") if response is not None else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, date.timestamp() - time.time())
+
+
+class RetryPolicy:
+    """Exponential backoff with full jitter, honouring Retry-After.
+
+    Args:
+      max_attempts (int): Requests sent before giving up.
+      base_delay (float): Backoff of the first retry, in seconds.
+      max_delay (float): Upper bound of a single backoff, in seconds.
+      retry_statuses (frozenset): Status codes that are retried, any other
+        response is returned right away.
+      sleep (Callable[[float], None]): Waits between attempts.
+    """
+
+    def __init__(
+        self,
+        max_attempts: int = 5,
+        base_delay: float = 1.0,
+        max_delay: float = 60.0,
+        retry_statuses: frozenset = RETRY_STATUSES,
+        sleep: Callable[[float], None] = time.sleep,
+    ):
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retry_statuses = retry_statuses
+        self.sleep = sleep
+        self.stats = RetryStats()
+
+    def delay(self, attempt: int, response: Any = None) -> float:
+        """Seconds to wait before retrying after the given failed attempt."""
+        requested = retry_after(response)
+        if requested is not None:
+            return min(requested, self.max_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def call(self, send: Callable[[], Any]) -> Any:
+        """Sends a request until it succeeds or can not be retried.
+
+        Args:
+          send (Callable[[], Response]): Sends the request.
+
+        Returns:
+          Response: The first response with a status that is not retried, or
+            the last response.
+
+        Raises:
+          requests.ConnectionError, requests.Timeout: If the last attempt
+            could not reach the server.
+        """
+        for attempt in range(self.max_attempts):
+            last = attempt == self.max_attempts - 1
+            self.stats.add(requests=1)
+            try:
+                response = send()
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if last:
+                    self.stats.add(gave_up=1)
+                    raise
+                print(f"Request failed: {e}, retrying")
+                self.stats.add(retries=1)
+                self.sleep(self.delay(attempt))
+                continue
+            if response.status_code == 429:
+                self.stats.add(throttled=1)
+            if response.status_code not in self.retry_statuses:
+                return response
+            if last:
+                self.stats.add(gave_up=1)
+                return response
+            self.stats.add(retries=1)
+            delay = self.delay(attempt, response)
+            # hands the connection of a stream=True response back to the pool
+            response.close()
+            self.sleep(delay)
+        return response
+
+
+class AdaptiveLimiter:
+    """Bounds concurrent requests with additive increase, multiplicative decrease.
+
+    Every accepted request raises the limit by 1/limit, so it grows by one
+    after a full round of successes; a 429 halves it. Uploads settle just
+    under the ingestion quota instead of running into it.
+
+    Args:
+      initial (int): Starting number of concurrent requests.
+      minimum (int): Lowest limit.
+      maximum (int): Highest limit.
+
+    Attributes:
+      decreases (int): Times the limit was halved.
+    """
+
+    def __init__(self, initial: int, minimum: int = 1,
+                 maximum: Optional[int] = None):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum or initial)
+        self.limit = float(min(max(initial, self.minimum), self.maximum))
+        self.decreases = 0
+        self._active = 0
+        self._epoch = 0
+        self._cond = threading.Condition()
+
+    def acquire(self) -> int:
+        """Waits for a free slot.
+
+        Returns:
+          int: Token to pass to on_throttle if the request is throttled.
+        """
+        with self._cond:
+            while self._active >= int(self.limit):
+                self._cond.wait()
+            self._active += 1
+            return self._epoch
+
+    def release(self):
+        """Frees the slot taken by acquire."""
+        with self._cond:
+            self._active -= 1
+            self._cond.notify()
+
+    def on_success(self):
+        """Records an accepted request."""
+        with self._cond:
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self._cond.notify()
+
+    def on_throttle(self, token: int):
+        """Records a 429 response.
+
+        Requests sent before the last decrease are ignored, so a burst of
+        429s from a single round halves the limit only once.
+        """
+        with self._cond:
+            if token != self._epoch:
+                return
+            self._epoch += 1
+            self.limit = max(self.minimum, self.limit / 2)
+            self.decreases += 1
@@ -0,0 +1,81 @@
+"""Time budget of a single Cloud Function invocation."""
+
+import time
+from typing import Callable, Optional
+
+# Environment variables
+ENV_TIMEOUT_FUNCTION = "TIMEOUT_FUNCTION"
+ENV_DEADLINE_MARGIN = "DEADLINE_MARGIN"
+
+
+class InvocationScheduler:
+    """Decides whether the next CTM page still fits in the invocation budget.
+
+    The cost of a page is the time between two consecutive page completions,
+    which with the pipeline running covers GET, transform and POST as they
+    overlap. It is smoothed with an exponentially weighted moving average and
+    the next page is only started when the predicted cost fits in the budget
+    left, keeping margin seconds to wait for the uploads in flight and save
+    the checkpoint.
+
+    Args:
+      budget (float): Seconds available to the invocation, from now.
+      margin (float): Seconds kept free at the end of the budget.
+      alpha (float): Weight of the latest page in the moving average.
+      clock (Callable[[], float]): Monotonic clock, in seconds.
+    """
+
+    def __init__(
+        self,
+        budget: float,
+        margin: float = 30,
+        alpha: float = 0.3,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.clock = clock
+        self.margin = margin
+        self.alpha = alpha
+        self.started = clock()
+        self.deadline = self.started + budget
+        self.page_cost: Optional[float] = None
+        self.pages = 0
+        self._last = self.started
+
+    def fork(self) -> "InvocationScheduler":
+        """Returns a scheduler with the same deadline and its own page cost.
+
+        Used for feeds ingested concurrently, whose pages complete
+        interleaved and each take longer than the interval between two
+        completions of the invocation.
+        """
+        child = InvocationScheduler(0, self.margin, self.alpha, self.clock)
+        child.started = self.started
+        child.deadline = self.deadline
+        return child
+
+    def elapsed(self) -> float:
+        """Seconds since the invocation started."""
+        return self.clock() - self.started
+
+    def remaining(self) -> float:
+        """Seconds left before the margin is reached."""
+        return self.deadline - self.margin - self.clock()
+
+    def page_done(self):
+        """Records the completion of a page and updates the page cost."""
+        now = self.clock()
+        cost = now - self._last
+        self._last = now
+        self.pages += 1
+        if self.page_cost is None:
+            self.page_cost = cost
+        else:
+            self.page_cost = self.alpha * cost + (1 - self.alpha) * self.page_cost
+
+    def should_stop(self) -> bool:
+        """True when the next page is not expected to finish in time."""
+        return self.remaining() < (self.page_cost or 0)
+
+    def must_stop(self) -> bool:
+        """True once the margin is reached, even in the middle of a page."""
+        return self.remaining() <= 0
@@ -0,0 +1,296 @@
+"""Local write-ahead spool of the batches Chronicle did not acknowledge.
+
+When batchCreate keeps failing, the batches already fetched and transformed
+are appended to the spool instead of being dropped, and the checkpoint moves
+past them. The next invocation sends the spooled batches first, through the
+normal upload path, before it fetches new CTM pages.
+
+The spool is a directory of append-only segment files. A record is a header
+(body length, keys length, entity count, CRC32 of body and keys) followed by
+the batchCreate body and the dedup keys as JSON. Segments are replayed with
+memory-mapped reads; a record cut short by a crash ends its segment. The
+number of records of a segment already sent is kept in a ``.ack`` file next
+to it, with the failed drains of the record after them. Beyond max_bytes the
+oldest segments are evicted.
+
+A batch Chronicle rejects with a status that is not retried, or that failed
+max_attempts drains, is moved to the ``quarantine.dlq`` file of the spool,
+in the same record format, so it no longer blocks the batches after it.
+A segment is flocked by the invocation appending to it or draining it, the
+other invocations sharing the directory leave it alone.
+"""
+
+import itertools
+import json
+import mmap
+import os
+import struct
+import threading
+import zlib
+from concurrent import futures
+from typing import Any, Callable, Iterator, List, Tuple
+
+from pipeline import UploadError
+from retry import RETRY_STATUSES
+from utils import Batch
+
+# Environment variables
+ENV_SPOOL_PATH = "SPOOL_PATH"
+ENV_SPOOL_MAX_MB = "SPOOL_MAX_MB"
+ENV_SPOOL_SEGMENT_MB = "SPOOL_SEGMENT_MB"
+ENV_SPOOL_MAX_ATTEMPTS = "SPOOL_MAX_ATTEMPTS"
+
+_HEADER = struct.Struct("<IIII")
+_SUFFIX = ".seg"
+QUARANTINE = "quarantine.dlq"
+
+
+class Spool:
+    """Append-only spool of batches, split in segment files.
+
+    Args:
+      path (str): Directory of the segments, created if missing.
+      max_bytes (int): Size of the spool above which the oldest segments
+        are deleted, with the batches they hold.
+      segment_bytes (int): Size above which appends go to a new segment.
+      max_attempts (int): Drains a batch may fail before it is quarantined.
+
+    Attributes:
+      appended (int): Batches appended by this process.
+      evicted (int): Batches deleted to honour max_bytes.
+      quarantined (int): Batches moved to the quarantine file by this
+        process.
+    """
+
+    def __init__(self, path: str, max_bytes: int = 256 << 20,
+                 segment_bytes: int = 16 << 20, max_attempts: int = 3):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+        self.max_attempts = max_attempts
+        self.appended = 0
+        self.evicted = 0
+        self.quarantined = 0
+        self._lock = threading.Lock()
+        self._file = None
+        os.makedirs(path, exist_ok=True)
+
+    def segments(self) -> List[str]:
+        """Paths of the segments, oldest first."""
+        names = sorted(name for name in os.listdir(self.path) if name.endswith(_SUFFIX))
+        return [os.path.join(self.path, name) for name in names]
+
+    def size(self) -> int:
+        """Bytes held by the segments."""
+        return sum(os.path.getsize(segment) for segment in self.segments())
+
+    def _open(self):
+        # always a new segment: the last one may end with a torn record
+        segments = self.segments()
+        last = int(os.path.basename(segments[-1])[:-len(_SUFFIX)]) if segments else 0
+        self._file = open(os.path.join(self.path, f"{last + 1:012d}{_SUFFIX}"), "ab")
+        # imported here, the module is only available on POSIX systems
+        import fcntl  # pylint: disable=import-outside-toplevel
+        # held until the segment is closed, drains skip the segment meanwhile
+        fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+
+    def append(self, batch: Batch):
+        """Writes a batch to disk before returning.
+
+        Args:
+          batch (Batch): The batch to keep until it is sent.
+        """
+        record = self._record(batch)
+        with self._lock:
+            if self._file is None or self._file.tell() >= self.segment_bytes:
+                self.close()
+                self._open()
+            self._file.write(record)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self.appended += 1
+            self._evict()
+
+    @staticmethod
+    def _record(batch: Batch) -> bytes:
+        keys = json.dumps(batch.keys, separators=(",", ":")).encode("utf-8")
+        crc = zlib.crc32(keys, zlib.crc32(batch.body))
+        return _HEADER.pack(len(batch.body), len(keys), batch.count, crc) + batch.body + keys
+
+    def _evict(self):
+        segments = self.segments()
+        total = sum(os.path.getsize(segment) for segment in segments)
+        current = self._file.name if self._file is not None else None
+        for segment in segments:
+            if total <= self.max_bytes or segment == current:
+                break
+            total -= os.path.getsize(segment)
+            evicted = sum(1 for _ in self._records(segment)) - self._acked(segment)
+            self._remove(segment)
+            self.evicted += evicted
+            print(f"Spool over {self.max_bytes} bytes, {evicted} batches evicted")
+
+    @staticmethod
+    def _records(segment: str) -> Iterator[Batch]:
+        """Reads the records of a segment through a memory map."""
+        with open(segment, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                pos = 0
+                while pos + _HEADER.size <= len(data):
+                    body_size, keys_size, count, crc = _HEADER.unpack_from(data, pos)
+                    start = pos + _HEADER.size
+                    end = start + body_size + keys_size
+                    if end > len(data):
+                        break
+                    body = data[start:start + body_size]
+                    keys = data[start + body_size:end]
+                    if zlib.crc32(keys, zlib.crc32(body)) != crc:
+                        break
+                    yield Batch(body, count, tuple(tuple(key) for key in json.loads(keys)))
+                    pos = end
+
+    @staticmethod
+    def _acked(segment: str) -> int:
+        return Spool._ack_state(segment)[0]
+
+    @staticmethod
+    def _ack_state(segment: str) -> Tuple[int, int]:
+        """Records of a segment sent, and failed drains of the next one."""
+        try:
+            with open(segment + ".ack", encoding="utf-8") as f:
+                fields = f.read().split()
+        except FileNotFoundError:
+            return 0, 0
+        return int(fields[0]) if fields else 0, int(fields[1]) if len(fields) > 1 else 0
+
+    @staticmethod
+    def _write_ack(segment: str, acked: int, failures: int):
+        with open(segment + ".ack", "w", encoding="utf-8") as f:
+            f.write(f"{acked} {failures}")
+
+    def _quarantine(self, segment: str, index: int, error: Exception):
+        """Appends record index of segment to the quarantine file."""
+        batch = next(itertools.islice(self._records(segment), index, None))
+        with open(os.path.join(self.path, QUARANTINE), "ab") as f:
+            f.write(self._record(batch))
+            f.flush()
+            os.fsync(f.fileno())
+        self.quarantined += 1
+        print(f"Spooled batch {index} of {segment} quarantined, {batch.count} entities: {error}")
+
+    @staticmethod
+    def _remove(segment: str):
+        os.remove(segment)
+        if os.path.exists(segment + ".ack"):
+            os.remove(segment + ".ack")
+
+    def drain(self, submit: Callable[[Batch], futures.Future],
+              wait: Callable[[List[futures.Future]], Any], window: int = 8,
+              should_stop: Callable[[], bool] = lambda: False) -> Tuple[int, int]:
+        """Sends the spooled batches, oldest first.
+
+        A segment is deleted once all its batches are acknowledged; when a
+        batch fails, the acknowledged part of its segment is recorded and
+        the error is raised, unless the batch is quarantined: then the
+        drain goes on with the batches after it. Segments flocked by
+        another invocation are skipped.
+
+        Args:
+          submit (Callable[[Batch], Future]): Starts the upload of a batch,
+            e.g. BatchUploader.submit without spooling.
+          wait (Callable[[List[Future]], Any]): Waits for uploads, raising
+            UploadError if any failed.
+          window (int): Uploads in flight at most.
+          should_stop (Callable[[], bool]): Checked between segments.
+
+        Returns:
+          Tuple[int, int]: Batches and entities sent.
+
+        Raises:
+          UploadError: If a batch could not be sent and is not quarantined.
+        """
+        import fcntl  # pylint: disable=import-outside-toplevel
+        with self._lock:
+            self.close()
+        sent_batches = sent_entities = 0
+        for segment in self.segments():
+            if should_stop():
+                break
+            try:
+                lock = open(segment, "rb")
+            except FileNotFoundError:
+                continue
+            with lock:
+                try:
+                    fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    print(f"Spool segment {segment} in use by another invocation, skipped")
+                    continue
+                # drained and deleted by another invocation since listed
+                if not os.path.exists(segment):
+                    continue
+                batches, entities = self._drain_segment(segment, submit, wait, window)
+                sent_batches += batches
+                sent_entities += entities
+        return sent_batches, sent_entities
+
+    def _drain_segment(self, segment: str, submit: Callable[[Batch], futures.Future],
+                       wait: Callable[[List[futures.Future]], Any],
+                       window: int) -> Tuple[int, int]:
+        """Sends the batches of a segment not acknowledged yet, then deletes it."""
+        sent_batches = sent_entities = 0
+        while True:
+            acked, failures = self._ack_state(segment)
+            inflight: List[futures.Future] = []
+            try:
+                for index, batch in enumerate(self._records(segment)):
+                    if index < acked:
+                        continue
+                    while sum(not f.done() for f in inflight) >= window:
+                        futures.wait(inflight, return_when=futures.FIRST_COMPLETED)
+                    # the batches after a failed one would be sent again
+                    if any(f.done() and f.exception() is not None for f in inflight):
+                        break
+                    inflight.append(submit(batch))
+                wait(inflight)
+            except UploadError as e:
+                futures.wait(inflight)
+                done = self._prefix_batches(inflight)
+                sent_batches += done
+                sent_entities += sum(f.result() for f in inflight[:done])
+                error = inflight[done].exception() if done < len(inflight) else e
+                # the failed drains are those of the same batch in a row
+                failures = failures + 1 if done == 0 else 1
+                if (error.status_code not in RETRY_STATUSES and error.status_code != 0
+                        or failures >= self.max_attempts):
+                    self._quarantine(segment, acked + done, error)
+                    after = self._prefix_batches(inflight[done + 1:])
+                    sent_batches += after
+                    sent_entities += sum(f.result() for f in inflight[done + 1:done + 1 + after])
+                    self._write_ack(segment, acked + done + 1 + after, 0)
+                    continue
+                self._write_ack(segment, acked + done, failures)
+                print(f"Spool drain stopped after {done} batches of {segment}")
+                raise
+            sent_batches += len(inflight)
+            sent_entities += sum(f.result() for f in inflight)
+            self._remove(segment)
+            return sent_batches, sent_entities
+
+    @staticmethod
+    def _prefix_batches(inflight: List[futures.Future]) -> int:
+        """Leading uploads that succeeded."""
+        count = 0
+        for future in inflight:
+            if not future.done() or future.exception() is not None:
+                break
+            count += 1
+        return count
+
+    def close(self):
+        """Closes the segment open for appends."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
@@ -0,0 +1,177 @@
+"""Incremental parsing of CTM pages.
+
+PageStream yields the entries of the ``objects`` array while the response
+body is still being downloaded, so only the object being decoded is kept in
+memory. The other top level fields (``more``, ``next``) are available once
+the stream has been consumed, wherever they appear in the body. A body cut
+short by a read error can be downloaded again, the objects already yielded
+are then skipped.
+"""
+
+import codecs
+import json
+from typing import Any, Callable, Dict, Iterable, Iterator, Optional, Tuple, Type
+
+_WHITESPACE = " \t\n\r"
+# characters a JSON number may continue with
+_NUMBER = frozenset("0123456789+-.eE")
+
+
+class PageStream:
+    """Iterates over the objects of a CTM page body.
+
+    Args:
+      chunks (Iterable[bytes]): Body of the response, e.g.
+        ``response.iter_content(chunk_size=65536)``.
+      key (str): Name of the top level array to stream.
+      on_end (Callable[[PageStream], None]): Called once the body has been
+        parsed, e.g. to record the size and duration of the page.
+      reopen (Callable[[], Iterable[bytes]]): Downloads the body again, after
+        chunks raised one of retry_on.
+      retry_on (Tuple[Type[Exception], ...]): Read errors the body is
+        downloaded again for, any other error is raised.
+      attempts (int): Downloads of the body at most; the last read error is
+        raised.
+
+    Attributes:
+      count (int): Objects yielded so far.
+      bytes (int): Bytes of the body read so far, by the last download.
+    """
+
+    def __init__(self, chunks: Iterable[bytes], key: str = "objects",
+                 on_end: Optional[Callable[["PageStream"], None]] = None,
+                 reopen: Optional[Callable[[], Iterable[bytes]]] = None,
+                 retry_on: Tuple[Type[Exception], ...] = (),
+                 attempts: int = 1):
+        self.key = key
+        self.on_end = on_end
+        self.reopen = reopen
+        self.retry_on = retry_on
+        self.attempts = attempts
+        self.count = 0
+        self._decoder = json.JSONDecoder()
+        self._restart(chunks)
+
+    def _restart(self, chunks: Iterable[bytes]):
+        """Parses the body from the start, read from chunks."""
+        self.bytes = 0
+        self.fields: Dict[str, Any] = {}
+        self._chunks = iter(chunks)
+        self._text = codecs.getincrementaldecoder("utf-8")()
+        self._buf = ""
+        self._pos = 0
+        self._eof = False
+
+    @property
+    def more(self) -> bool:
+        """Value of the CTM ``more`` flag, read after the stream is consumed."""
+        return bool(self.fields.get('more', False))
+
+    @property
+    def next(self) -> str:
+        """Value of the CTM ``next`` cursor, read after the stream is consumed."""
+        return self.fields.get('next', "")
+
+    def _fill(self) -> bool:
+        """Reads the next chunk, dropping the part of the buffer already parsed."""
+        if self._eof:
+            return False
+        self._buf = self._buf[self._pos:]
+        self._pos = 0
+        for chunk in self._chunks:
+            self.bytes += len(chunk)
+            text = self._text.decode(chunk)
+            if text:
+                self._buf += text
+                return True
+        self._buf += self._text.decode(b"", final=True)
+        self._eof = True
+        return False
+
+    def _peek(self) -> str:
+        """Returns the next non whitespace character without consuming it."""
+        while True:
+            while self._pos < len(self._buf) and self._buf[self._pos] in _WHITESPACE:
+                self._pos += 1
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if not self._fill():
+                raise ValueError("Unexpected end of CTM page body")
+
+    def _expect(self, char: str):
+        if self._peek() != char:
+            raise ValueError(
+                f"Expected {char!r} at offset {self._pos} of CTM page body")
+        self._pos += 1
+
+    def _value(self) -> Any:
+        """Decodes the JSON value starting at the current position."""
+        self._peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buf, self._pos)
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise
+                continue
+            # a number running to the end of the buffer may continue in the
+            # next chunk, e.g. "1." of "1.5" decodes as 1
+            stop = end
+            while stop < len(self._buf) and self._buf[stop] in _NUMBER:
+                stop += 1
+            if stop == len(self._buf) and self._fill():
+                continue
+            self._pos = end
+            return value
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        downloads = 1
+        while True:
+            skip = self.count
+            try:
+                for obj in self._objects():
+                    if skip:
+                        skip -= 1
+                        continue
+                    self.count += 1
+                    yield obj
+                break
+            except self.retry_on as e:
+                if self.reopen is None or downloads >= self.attempts:
+                    raise
+                print(f"CTM page body cut short after {self.count} objects: {e}, downloading it again")
+                downloads += 1
+                self._restart(self.reopen())
+        if self.on_end is not None:
+            self.on_end(self)
+
+    def _objects(self) -> Iterator[Dict[str, Any]]:
+        self._expect('{')
+        if self._peek() == '}':
+            self._pos += 1
+            return
+        while True:
+            key = self._value()
+            self._expect(':')
+            if key == self.key:
+                self._expect('[')
+                if self._peek() == ']':
+                    self._pos += 1
+                else:
+                    while True:
+                        yield self._value()
+                        char = self._peek()
+                        self._pos += 1
+                        if char == ']':
+                            break
+                        if char != ',':
+                            raise ValueError(
+                                f"Malformed {self.key} array in CTM page body")
+            else:
+                self.fields[key] = self._value()
+            char = self._peek()
+            self._pos += 1
+            if char == '}':
+                return
+            if char != ',':
+                raise ValueError("Malformed CTM page body")
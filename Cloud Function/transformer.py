@@ -0,0 +1,99 @@
+"""Conversion of CTM360 STIX indicators into UDM entities."""
+
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+import mapping
+import udm
+
+CTM_EXTENSION = mapping.CTM_EXTENSION
+VENDOR_NAME = udm.VENDOR_NAME
+PRODUCT_NAME = udm.PRODUCT_NAME
+
+# Observable type -> handler compiled from the mapping spec, see mapping.py.
+HANDLERS: Dict[str, mapping.Handler] = mapping.compile_spec(mapping.spec_from_env())
+
+
+def transform_object(
+    obj: Dict[str, Any], collected_timestamp: str
+) -> Optional[udm.UdmEntity]:
+    """Converts a STIX indicator into a UDM entity.
+
+    Args:
+      obj (dict): STIX indicator returned by CTM360.
+      collected_timestamp (str): Value of metadata.collected_timestamp.
+
+    Returns:
+      udm.UdmEntity: The UDM entity, or None if the observable type is not
+        supported or its value can not be extracted.
+    """
+    ext = obj['extensions'][CTM_EXTENSION]
+    observable_type = ext['main_observable_type']
+    handler = HANDLERS.get(observable_type)
+    if handler is None:
+        print("object not supported -> ", observable_type)
+        return None
+
+    mapped = handler(obj)
+    if mapped is None:
+        print("value not found -> ", observable_type, obj['id'])
+        return None
+    entity_type, field, value, extra = mapped
+    intern = udm.intern
+    return udm.UdmEntity(
+        collected_timestamp,
+        obj['id'],
+        entity_type,
+        str(obj['confidence']),
+        ext['created_at'],
+        ext['updated_at'],
+        obj['valid_from'],
+        obj['valid_until'],
+        field,
+        value,
+        ext['score'],
+        obj.get('description', udm.ABSENT),
+        intern(ext['extension_type']),
+        intern(ext['type']),
+        intern(str(ext['detection'])),
+        obj.get('labels', udm.ABSENT),
+        obj['pattern'],
+        intern(obj['pattern_type']),
+        intern(obj.get('pattern_version', udm.ABSENT)),
+        extra,
+    )
+
+
+def iter_transform(
+    objects: Iterable[Dict[str, Any]], collected_timestamp: str
+) -> Iterator[udm.UdmEntity]:
+    """Lazily converts STIX objects into UDM entities.
+
+    Args:
+      objects (Iterable[dict]): The ``objects`` of a CTM page, possibly
+        streamed while the page is downloaded.
+      collected_timestamp (str): Value of metadata.collected_timestamp, shared
+        by all the entities of the page.
+
+    Yields:
+      udm.UdmEntity: UDM entities of the supported objects, in page order.
+    """
+    for obj in objects:
+        event = transform_object(obj, collected_timestamp)
+        if event is not None:
+            yield event
+
+
+def transform_objects(
+    objects: Iterable[Dict[str, Any]], collected_timestamp: str
+) -> List[udm.UdmEntity]:
+    """Converts the STIX objects of a CTM page into UDM entities.
+
+    Args:
+      objects (Iterable[dict]): The ``objects`` list of a CTM page.
+      collected_timestamp (str): Value of metadata.collected_timestamp, shared
+        by all the entities of the page.
+
+    Returns:
+      list: udm.UdmEntity of the supported objects, in page order.
+    """
+    return list(iter_transform(objects, collected_timestamp))
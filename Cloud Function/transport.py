@@ -0,0 +1,200 @@
+"""Pooled HTTP transport shared by the CTM360 fetcher and the uploader."""
+
+import gzip
+import threading
+from datetime import datetime, timezone
+from typing import Any, Dict, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import utils
+
+# Environment variables
+ENV_HTTP_POOL_CONNECTIONS = "HTTP_POOL_CONNECTIONS"
+ENV_HTTP_POOL_MAXSIZE = "HTTP_POOL_MAXSIZE"
+ENV_HTTP_CONNECT_TIMEOUT = "HTTP_CONNECT_TIMEOUT"
+ENV_HTTP_READ_TIMEOUT = "HTTP_READ_TIMEOUT"
+ENV_CHRONICLE_GZIP_LEVEL = "CHRONICLE_GZIP_LEVEL"
+ENV_TOKEN_REFRESH_MARGIN = "TOKEN_REFRESH_MARGIN"
+
+
+def _mount_pool(session: requests.Session, pool_connections: int,
+                pool_maxsize: int):
+    """Replaces the default adapters of session with a larger keep-alive pool."""
+    adapter = HTTPAdapter(pool_connections=pool_connections,
+                          pool_maxsize=pool_maxsize)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+
+
+class TokenRefresher:
+    """Refreshes Google credentials in a daemon thread before they expire.
+
+    The first token is fetched as soon as the thread starts, so requests
+    find a valid token instead of fetching it themselves. The session still
+    refreshes an expired token on its own, e.g. when the thread did not get
+    CPU between invocations.
+
+    Args:
+      credentials: google.auth credentials, refreshed in place.
+      margin (float): Seconds before expiry at which the token is refreshed.
+      retry_delay (float): Seconds between attempts when a refresh fails.
+
+    Attributes:
+      refreshes (int): Tokens fetched.
+      failures (int): Refreshes that failed.
+    """
+
+    def __init__(self, credentials: Any, margin: float = 300, retry_delay: float = 10):
+        self.credentials = credentials
+        self.margin = margin
+        self.retry_delay = retry_delay
+        self.refreshes = 0
+        self.failures = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="token-refresh", daemon=True)
+
+    def start(self) -> "TokenRefresher":
+        self._thread.start()
+        return self
+
+    def _due(self) -> Optional[float]:
+        """Seconds until the next refresh, None for a token that does not expire."""
+        if not self.credentials.token:
+            return 0
+        if self.credentials.expiry is None:
+            return None
+        # google-auth keeps the expiry as naive UTC
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        return (self.credentials.expiry - now).total_seconds() - self.margin
+
+    def _run(self):
+        from google.auth.transport.requests import Request  # pylint: disable=import-outside-toplevel
+        request = Request()
+        while True:
+            due = self._due()
+            if due is None or self._stop.wait(max(0, due)):
+                return
+            try:
+                self.credentials.refresh(request)
+                self.refreshes += 1
+            except Exception as e:  # pylint: disable=broad-except
+                self.failures += 1
+                print(f"Token refresh failed, retrying in {self.retry_delay}s: {e}")
+                if self._stop.wait(self.retry_delay):
+                    return
+
+    def stop(self):
+        """Stops the thread, at the latest after the refresh in progress."""
+        self._stop.set()
+
+    def as_dict(self) -> Dict[str, int]:
+        return {"refreshes": self.refreshes, "failures": self.failures}
+
+
+class Transport:
+    """Keep-alive sessions for the CTM360 API and the Chronicle ingestion API.
+
+    Args:
+      credentials: Google credentials used for the Chronicle session. The
+        Chronicle session is not created when None.
+      pool_connections (int): Number of hosts kept in each connection pool.
+      pool_maxsize (int): Connections kept alive per host, should be at
+        least the upload concurrency.
+      connect_timeout (float): Seconds to wait for a connection.
+      read_timeout (float): Seconds to wait for data from the server.
+      gzip_level (int): gzip level of the batchCreate bodies, 0 sends them
+        uncompressed.
+      refresh_margin (float): Seconds before expiry at which the token of
+        the credentials is refreshed in the background, 0 leaves it to the
+        Chronicle session.
+
+    Attributes:
+      refresher (TokenRefresher): The background refresh, None when off.
+    """
+
+    def __init__(
+        self,
+        credentials: Any = None,
+        pool_connections: int = 4,
+        pool_maxsize: int = 10,
+        connect_timeout: float = 10,
+        read_timeout: float = 120,
+        gzip_level: int = 0,
+        refresh_margin: float = 300,
+    ):
+        self.timeout = (connect_timeout, read_timeout)
+        self.gzip_level = gzip_level
+        self.ctm = requests.Session()
+        self.ctm.headers["Accept-Encoding"] = "gzip, deflate"
+        _mount_pool(self.ctm, pool_connections, pool_maxsize)
+        self.chronicle = None
+        self.refresher = None
+        if credentials is not None:
+            # imported here so the CTM side can be used without google-auth
+            from google.auth.transport.requests import AuthorizedSession
+            self.chronicle = AuthorizedSession(credentials)
+            _mount_pool(self.chronicle, pool_connections, pool_maxsize)
+            if refresh_margin:
+                self.refresher = TokenRefresher(credentials, refresh_margin).start()
+
+    @classmethod
+    def from_env(cls, credentials: Any = None, max_concurrency: int = 10) -> "Transport":
+        """Builds a Transport configured through the HTTP_* environment variables.
+
+        Args:
+          credentials: See Transport.
+          max_concurrency (int): Highest number of requests sent at the same
+            time, the default of HTTP_POOL_MAXSIZE.
+        """
+        return cls(
+            credentials,
+            pool_connections=int(utils.get_env_var(
+                ENV_HTTP_POOL_CONNECTIONS, required=False, default=4)),
+            pool_maxsize=int(utils.get_env_var(
+                ENV_HTTP_POOL_MAXSIZE, required=False, default=max(1, max_concurrency))),
+            connect_timeout=float(utils.get_env_var(
+                ENV_HTTP_CONNECT_TIMEOUT, required=False, default=10)),
+            read_timeout=float(utils.get_env_var(
+                ENV_HTTP_READ_TIMEOUT, required=False, default=120)),
+            gzip_level=int(utils.get_env_var(
+                ENV_CHRONICLE_GZIP_LEVEL, required=False, default=0)),
+            refresh_margin=float(utils.get_env_var(
+                ENV_TOKEN_REFRESH_MARGIN, required=False, default=300)),
+        )
+
+    def get(
+        self,
+        url: str,
+        headers: Optional[Dict[str, str]] = None,
+        stream: bool = False,
+    ) -> requests.Response:
+        """Sends a GET request to the CTM360 API."""
+        return self.ctm.get(url, headers=headers, stream=stream,
+                            timeout=self.timeout)
+
+    def post(
+        self,
+        url: str,
+        data: bytes,
+        headers: Optional[Dict[str, str]] = None,
+    ) -> requests.Response:
+        """Sends a request body to the Chronicle ingestion API.
+
+        The body is gzip compressed when gzip_level is set.
+        """
+        headers = dict(headers or {})
+        if self.gzip_level:
+            data = gzip.compress(data, compresslevel=self.gzip_level)
+            headers["Content-Encoding"] = "gzip"
+        return self.chronicle.post(url, data=data, headers=headers,
+                                   timeout=self.timeout)
+
+    def close(self):
+        """Closes the pooled connections and stops the token refresh."""
+        if self.refresher is not None:
+            self.refresher.stop()
+        self.ctm.close()
+        if self.chronicle is not None:
+            self.chronicle.close()
@@ -0,0 +1,194 @@
+"""Compact representation of the UDM entities waiting to be sent.
+
+A UDM entity built as nested dicts takes seven dicts per indicator and
+repeats the vendor and product names and the empty sub-objects in every one
+of them. UdmEntity keeps the values of an indicator in slots, shares the
+strings repeated across a page and encodes itself straight to the JSON body
+of the batchCreate request, leaving out the empty sub-objects.
+"""
+
+import json
+import sys
+from typing import Any, Dict, Tuple
+
+VENDOR_NAME = "CTM_CUSTOM_IOC"
+PRODUCT_NAME = "CTM_CUSTOM_IOC"
+
+# Marks the optional STIX attributes missing from an indicator.
+ABSENT = object()
+
+_string = json.encoder.encode_basestring  # pylint: disable=no-member
+_compact = json.JSONEncoder(ensure_ascii=False, separators=(",", ":")).encode
+
+# UDM path of the indicator value, e.g. "file.sha256" or
+# "user.emailAddresses[]" for a list -> JSON of the "entity" object before and
+# after the value. Paths are added by field().
+FIELDS: Dict[str, Tuple[str, str]] = {}
+
+_HEADER = ('{"metadata":{"vendor_name":%s,"product_name":%s,"collected_timestamp":'
+           % (_string(VENDOR_NAME), _string(PRODUCT_NAME)))
+
+
+def _json(value: Any) -> str:
+    if value.__class__ is str:
+        return _string(value)
+    return _compact(value)
+
+
+def field(path: str) -> str:
+    """Registers the UDM path of an indicator value in FIELDS.
+
+    Args:
+      path (str): Dotted path in the "entity" object, ending with "[]" when
+        the value is the only item of a list.
+
+    Returns:
+      str: The path, to be used as UdmEntity.field.
+    """
+    if path not in FIELDS:
+        names = path[:-2].split(".") if path.endswith("[]") else path.split(".")
+        before = "".join('{%s:' % _string(name) for name in names)
+        after = "}" * len(names)
+        if path.endswith("[]"):
+            before, after = before + "[", "]" + after
+        FIELDS[path] = (before, after)
+    return path
+
+
+def _nest(path: str, value: Any) -> Dict[str, Any]:
+    if path.endswith("[]"):
+        path, value = path[:-2], [value]
+    names = path.split(".")
+    for name in reversed(names[1:]):
+        value = {name: value}
+    return {names[0]: value}
+
+
+def intern(value: Any) -> Any:
+    """Shares the strings repeated across indicators, e.g. enumerations."""
+    return sys.intern(value) if value.__class__ is str else value
+
+
+class UdmEntity:
+    """A UDM entity built from a CTM360 indicator.
+
+    Attributes are the values of the UDM fields, the optional ones hold
+    ABSENT when the indicator does not have them. field is the FIELDS path
+    of the indicator value, or None when the indicator has no value. extra
+    holds the (name, value) pairs of the additional attributes set by the
+    mapping spec.
+    """
+
+    __slots__ = (
+        "collected_timestamp", "product_entity_id", "entity_type",
+        "confidence_details", "first_discovered_time", "last_updated_time",
+        "start_time", "end_time", "field", "value",
+        "score", "description", "extension_type", "type", "detection",
+        "labels", "pattern", "pattern_type", "pattern_version", "extra",
+    )
+
+    def __init__(self, collected_timestamp, product_entity_id, entity_type,
+                 confidence_details, first_discovered_time, last_updated_time,
+                 start_time, end_time, field, value, score, description,
+                 extension_type, type, detection, labels, pattern,  # pylint: disable=redefined-builtin
+                 pattern_type, pattern_version, extra=()):
+        self.collected_timestamp = collected_timestamp
+        self.product_entity_id = product_entity_id
+        self.entity_type = entity_type
+        self.confidence_details = confidence_details
+        self.first_discovered_time = first_discovered_time
+        self.last_updated_time = last_updated_time
+        self.start_time = start_time
+        self.end_time = end_time
+        self.field = field
+        self.value = value
+        self.score = score
+        self.description = description
+        self.extension_type = extension_type
+        self.type = type
+        self.detection = detection
+        self.labels = labels
+        self.pattern = pattern
+        self.pattern_type = pattern_type
+        self.pattern_version = pattern_version
+        self.extra = extra
+
+    def to_json(self) -> bytes:
+        """Encodes the entity as compact JSON, UTF-8 and not ASCII escaped.
+
+        The result is the same as json.dumps of to_dict with
+        ``separators=(",", ":")`` and ``ensure_ascii=False``.
+        """
+        parts = [
+            _HEADER, _json(self.collected_timestamp),
+            ',"product_entity_id":', _json(self.product_entity_id),
+            ',"entity_type":', _json(self.entity_type),
+            ',"threat":[{"confidence_details":', _json(self.confidence_details),
+            ',"first_discovered_time":', _json(self.first_discovered_time),
+            ',"last_updated_time":', _json(self.last_updated_time),
+            '}],"interval":{"start_time":', _json(self.start_time),
+            ',"end_time":', _json(self.end_time),
+            '}},"entity":',
+        ]
+        if self.field is None:
+            parts.append('{}')
+        else:
+            before, after = FIELDS[self.field]
+            parts += (before, _json(self.value), after)
+        parts += (',"additional":{"score":', _json(self.score))
+        if self.description is not ABSENT:
+            parts += (',"description":', _json(self.description))
+        parts += (
+            ',"extension_type":', _json(self.extension_type),
+            ',"type":', _json(self.type),
+            ',"detection":', _json(self.detection),
+        )
+        if self.labels is not ABSENT:
+            parts += (',"labels":', _json(self.labels))
+        parts += (
+            ',"pattern":', _json(self.pattern),
+            ',"pattern_type":', _json(self.pattern_type),
+        )
+        if self.pattern_version is not ABSENT:
+            parts += (',"pattern_version":', _json(self.pattern_version))
+        for name, value in self.extra:
+            parts += (',', _string(name), ':', _json(value))
+        parts.append('}}')
+        return "".join(parts).encode("utf-8")
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Returns the entity as the nested dicts of the UDM JSON."""
+        entity = _nest(self.field, self.value) if self.field is not None else {}
+        additional = {"score": self.score}
+        if self.description is not ABSENT:
+            additional["description"] = self.description
+        additional["extension_type"] = self.extension_type
+        additional["type"] = self.type
+        additional["detection"] = self.detection
+        if self.labels is not ABSENT:
+            additional["labels"] = self.labels
+        additional["pattern"] = self.pattern
+        additional["pattern_type"] = self.pattern_type
+        if self.pattern_version is not ABSENT:
+            additional["pattern_version"] = self.pattern_version
+        additional.update(self.extra)
+        return {
+            "metadata": {
+                "vendor_name": VENDOR_NAME,
+                "product_name": PRODUCT_NAME,
+                "collected_timestamp": self.collected_timestamp,
+                "product_entity_id": self.product_entity_id,
+                "entity_type": self.entity_type,
+                "threat": [{
+                    "confidence_details": self.confidence_details,
+                    "first_discovered_time": self.first_discovered_time,
+                    "last_updated_time": self.last_updated_time,
+                }],
+                "interval": {
+                    "start_time": self.start_time,
+                    "end_time": self.end_time,
+                },
+            },
+            "entity": entity,
+            "additional": additional,
+        }
@@ -0,0 +1,227 @@
+"""Concurrent batchCreate uploads over a shared keep-alive session."""
+
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Deque, Dict, Iterable, Optional, Tuple
+
+from pipeline import UploadError
+from retry import AdaptiveLimiter, RetryPolicy
+from utils import Batch
+
+
+class BatchUploader:
+    """Posts the batches of a page to Chronicle with a pool of workers.
+
+    Batches that fail are retried on their own, so a partial failure does not
+    resend what Chronicle has already accepted. Throttling and transient
+    errors are retried with backoff, and the number of concurrent requests
+    adapts to 429 responses between 1 and max_concurrency.
+
+    Args:
+      session: Object with a ``post(url, data, headers)`` method shared by
+        all the workers, usually a transport.Transport.
+      url (str): batchCreate endpoint.
+      concurrency (int): Initial number of batches posted at the same time.
+      max_attempts (int): Attempts made for every batch before giving up,
+        used when no policy is given.
+      policy (retry.RetryPolicy): Retry policy of the POST requests.
+      max_concurrency (int): Highest number of batches posted at the same
+        time, defaults to concurrency.
+      on_sent (Callable[[Batch], None]): Called from the worker thread
+        after Chronicle acknowledged a batch.
+      metrics (metrics.Metrics): Receives the POST latencies and counters.
+      spool (spool.Spool): Keeps the batches still failing after the last
+        attempt with a retryable error, which then count as sent. Once a
+        batch is spooled the following ones are spooled without being sent.
+
+    Attributes:
+      spooling (bool): True once a batch has been spooled.
+    """
+
+    def __init__(
+        self,
+        session: Any,
+        url: str,
+        concurrency: int = 4,
+        max_attempts: int = 3,
+        on_sent: Optional[Callable[[Batch], None]] = None,
+        policy: Optional[RetryPolicy] = None,
+        max_concurrency: Optional[int] = None,
+        metrics: Optional[Any] = None,
+        spool: Optional[Any] = None,
+    ):
+        self.session = session
+        self.url = url
+        self.concurrency = max(1, concurrency, max_concurrency or 0)
+        self.policy = policy or RetryPolicy(max_attempts=max_attempts)
+        self.limiter = AdaptiveLimiter(concurrency, maximum=self.concurrency)
+        self.on_sent = on_sent
+        self.metrics = metrics
+        self.spool = spool
+        self.spooling = False
+        self.headers = {"Content-Type": "application/json"}
+        self._executor = ThreadPoolExecutor(max_workers=self.concurrency,
+                                            thread_name_prefix="upload")
+        # batches of the lanes waiting for a worker, lanes in turn order
+        self._lanes: Dict[str, Deque[Tuple[Batch, Future]]] = {}
+        self._dispatched = 0
+        self._lock = threading.Lock()
+
+    def _post(self, batch: Batch):
+        token = self.limiter.acquire()
+        started = time.perf_counter()
+        try:
+            response = self.session.post(self.url, data=batch.body,
+                                         headers=self.headers)
+        finally:
+            self.limiter.release()
+            if self.metrics is not None:
+                self.metrics.observe("post", time.perf_counter() - started)
+                self.metrics.count("post.requests")
+                self.metrics.count("post.bytes", len(batch.body))
+        if response.status_code == 429:
+            self.limiter.on_throttle(token)
+        elif response.status_code == 200:
+            self.limiter.on_success()
+        return response
+
+    def _spool(self, batch: Batch) -> int:
+        self.spool.append(batch)
+        self.spooling = True
+        if self.metrics is not None:
+            self.metrics.count("spool.batches")
+            self.metrics.count("spool.entities", batch.count)
+        return batch.count
+
+    def _send(self, batch: Batch, spool: bool = True) -> int:
+        """Posts a batch, retrying it as allowed by the policy."""
+        spool = spool and self.spool is not None
+        if spool and self.spooling:
+            # Chronicle is failing, keep the batch for the next invocation
+            return self._spool(batch)
+        try:
+            response = self.policy.call(lambda: self._post(batch))
+        except Exception as e:  # pylint: disable=broad-except
+            print(f"POST error: {e}")
+            if spool:
+                return self._spool(batch)
+            raise UploadError(str(e), 0) from e
+        if response.status_code != 200:
+            print(f"POST error code: {response.status_code}")
+            print(f"POST error text: {response.text}")
+            if spool and response.status_code in self.policy.retry_statuses:
+                return self._spool(batch)
+            raise UploadError(response.text, response.status_code)
+        if self.on_sent is not None:
+            self.on_sent(batch)
+        if self.metrics is not None:
+            self.metrics.count("post.entities", batch.count)
+        return batch.count
+
+    def submit(self, batch: Batch, spool: bool = True) -> Future:
+        """Schedules the upload of a batch.
+
+        Args:
+          batch (Batch): The batch to send.
+          spool (bool): Spools the batch if it can not be sent, when the
+            uploader has a spool.
+
+        Returns:
+          Future: Resolves to the number of entities sent, or raises
+            UploadError if the batch is still rejected after the last attempt.
+        """
+        return self._executor.submit(self._send, batch, spool)
+
+    def lane(self, name: str) -> "UploadLane":
+        """Returns a view of the uploader whose batches take turns with other lanes."""
+        return UploadLane(self, name)
+
+    def _enqueue(self, lane: str, batch: Batch) -> Future:
+        future = Future()
+        with self._lock:
+            self._lanes.setdefault(lane, deque()).append((batch, future))
+        self._dispatch()
+        return future
+
+    def _dispatch(self):
+        """Hands queued batches to the workers, one lane after the other."""
+        with self._lock:
+            while self._dispatched < self.concurrency and self._lanes:
+                lane = next(iter(self._lanes))
+                queue = self._lanes.pop(lane)
+                batch, future = queue.popleft()
+                if queue:
+                    # back to the end of the turn order
+                    self._lanes[lane] = queue
+                self._dispatched += 1
+                self._executor.submit(self._run, batch, future)
+
+    def _run(self, batch: Batch, future: Future):
+        try:
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(self._send(batch))
+                except Exception as e:  # pylint: disable=broad-except
+                    future.set_exception(e)
+        finally:
+            with self._lock:
+                self._dispatched -= 1
+            self._dispatch()
+
+    def wait(self, futures: Iterable[Future]) -> int:
+        """Waits for submitted batches.
+
+        Returns:
+          int: Number of entities sent.
+
+        Raises:
+          UploadError: If any of the batches could not be sent.
+        """
+        sent = 0
+        error = None
+        for future in futures:
+            try:
+                sent += future.result()
+            except UploadError as e:
+                error = e
+        if error is not None:
+            raise error
+        if self.metrics is not None:
+            self.metrics.event("sent to SIEM", entities=sent)
+        else:
+            print(f"sent {sent} data to SIEM")
+        return sent
+
+    def close(self):
+        """Waits for running uploads and releases the worker threads."""
+        self._executor.shutdown(wait=True)
+
+
+class UploadLane:
+    """Batches of one feed, posted by a shared BatchUploader.
+
+    The uploader serves its lanes round robin, so a feed with large pages
+    does not delay the others. Lanes have the interface of the uploader
+    used by pipeline.Pipeline.
+
+    Args:
+      uploader (BatchUploader): Uploader posting the batches.
+      name (str): Name of the lane, e.g. the collection ID.
+    """
+
+    def __init__(self, uploader: BatchUploader, name: str):
+        self.uploader = uploader
+        self.name = name
+
+    @property
+    def concurrency(self) -> int:
+        return self.uploader.concurrency
+
+    def submit(self, batch: Batch) -> Future:
+        """Queues a batch behind the other lanes, see BatchUploader.submit."""
+        return self.uploader._enqueue(self.name, batch)  # pylint: disable=protected-access
+
+    def wait(self, futures: Iterable[Future]) -> int:
+        return self.uploader.wait(futures)
@@ -3,9 +3,20 @@
 import datetime
 import json
 import os
-import sys
-from typing import Dict, Any
-from google.cloud import secretmanager
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, Callable, Iterable, Iterator, List, NamedTuple, Optional
+
+# Secret Manager client shared by the whole process.
+_client = None
+_client_lock = threading.Lock()
+# resource path -> (expiry time, payload) of the cached secret versions.
+_secret_cache: Dict[str, Any] = {}
+# secret path -> payload and name of its latest version, as last read or
+# written.
+_latest_values: Dict[str, str] = {}
+_latest_versions: Dict[str, str] = {}
 
 def now():
   """
@@ -18,23 +29,96 @@ def now():
   formatted_time = current_time.strftime('%Y-%m-%dT%H:%M:%S.%fZ')
   return formatted_time
   
-def get_value_from_secret_manager(resource_path: str) -> str:
+def get_secret_client() -> "secretmanager.SecretManagerServiceClient":
+  """Returns the Secret Manager client, creating it on first use.
+
+  The client and its gRPC channel are shared by all the threads of the
+  process, so it is only set up once per instance. The package is imported
+  here too, it is one of the slowest imports of a cold start.
+  """
+  global _client
+  if _client is None:
+    with _client_lock:
+      if _client is None:
+        from google.cloud import secretmanager
+        _client = secretmanager.SecretManagerServiceClient()
+  return _client
+
+
+class Lazy:
+  """A value built on first use and kept for the life of the instance.
+
+  The value is built once even when several threads ask for it at the same
+  time. A failed build is not kept: the error is raised to the caller and
+  the next call builds the value again.
+
+  Args:
+    factory (Callable[[], Any]): Builds the value.
+  """
+
+  def __init__(self, factory: Callable[[], Any]):
+    self._factory = factory
+    self._lock = threading.Lock()
+    self._value = None
+    self._built = False
+
+  def get(self) -> Any:
+    """Returns the value, building it or waiting for it if needed."""
+    if not self._built:
+      with self._lock:
+        if not self._built:
+          self._value = self._factory()
+          self._built = True
+    return self._value
+
+  def prefetch(self, name: str = "prefetch") -> threading.Thread:
+    """Starts building the value in a daemon thread.
+
+    An error is printed and left to the next get().
+    """
+    def build():
+      try:
+        self.get()
+      except Exception as e:  # pylint: disable=broad-except
+        print(f"{name} failed, retried on first use: {e}")
+    thread = threading.Thread(target=build, name=name, daemon=True)
+    thread.start()
+    return thread
+
+
+def _secret_path(resource_path: str) -> str:
+  """Strips the version from a secret version path."""
+  return "/".join(resource_path.split("/")[:4])
+
+
+def get_value_from_secret_manager(resource_path: str,
+                                  cache_ttl: float = 0) -> str:
   """Retrieve the value of the secret from the Google Cloud Secret Manager.
 
   Args:
     resource_path (str): Path of the secret with version included. Ex.:
       "projects/<project_id>/secrets/<secret_name>/versions/1",
       "projects/<project_id>/secrets/<secret_name>/versions/latest"
+    cache_ttl (float): Seconds the value is served from memory before it is
+      read again. 0 always reads it from Secret Manager.
 
   Returns:
     str: Payload for secret.
   """
-  # Create the Secret Manager client.
-  client = secretmanager.SecretManagerServiceClient()
+  if cache_ttl:
+    cached = _secret_cache.get(resource_path)
+    if cached is not None and cached[0] > time.monotonic():
+      return cached[1]
 
   # Access the secret version.
-  response = client.access_secret_version(name=resource_path)
-  return response.payload.data.decode("UTF-8")
+  response = get_secret_client().access_secret_version(name=resource_path)
+  value = response.payload.data.decode("UTF-8")
+  if cache_ttl:
+    _secret_cache[resource_path] = (time.monotonic() + cache_ttl, value)
+  if resource_path.endswith("/versions/latest"):
+    _latest_values[_secret_path(resource_path)] = value
+    _latest_versions[_secret_path(resource_path)] = response.name
+  return value
 
 
 def get_env_var(
@@ -42,6 +126,7 @@ def get_env_var(
     required: bool = True,
     default: Any = None,
     is_secret: bool = False,
+    cache_ttl: float = 0,
 ) -> Any:
   """Gets an environment variable.
 
@@ -53,6 +138,8 @@ def get_env_var(
       not set. Defaults to None.
     is_secret (bool): Script will get data from Google Cloud Secret Manager in
       case it is set to true.
+    cache_ttl (float): Seconds a secret is served from memory, see
+      get_value_from_secret_manager.
 
   Returns:
     Any: Value of the environment variable.
@@ -63,12 +150,37 @@ def get_env_var(
   if name not in os.environ and required:
     raise RuntimeError(f"Environment variable {name} is required.")
   if is_secret:
-    return get_value_from_secret_manager(os.environ[name])
+    return get_value_from_secret_manager(os.environ[name], cache_ttl)
   if name not in os.environ or (name in os.environ and
                                 not os.environ[name].strip()):
     return default
   return os.environ[name]
 
+def get_secret_env_vars(names: List[str],
+                        cache_ttl: float = 0) -> Dict[str, str]:
+  """Reads the secrets referenced by several environment variables at once.
+
+  The secrets are fetched concurrently over the shared client.
+
+  Args:
+    names (List[str]): Names of the required environment variables.
+    cache_ttl (float): Seconds the secrets are served from memory, see
+      get_value_from_secret_manager.
+
+  Returns:
+    Dict[str, str]: Payload of each secret, keyed by environment variable.
+
+  Raises:
+    RuntimeError: Raises when a name is not in environment variable.
+  """
+  with ThreadPoolExecutor(max_workers=max(1, len(names))) as executor:
+    futures = {
+        name: executor.submit(get_env_var, name, is_secret=True,
+                              cache_ttl=cache_ttl)
+        for name in names
+    }
+    return {name: future.result() for name, future in futures.items()}
+
 def instance_region(region):
   """
   Retrieves the URL of the Malachite ingestion endpoint for the specified region.
@@ -109,20 +221,119 @@ def generate_epoch_timestamp(offset_minutes):
   from time import time
   return int(time() - offset_minutes * 60)
 
-def chunked_events(events, max_size):
-    """Divide la lista events in sottoliste di dimensione massima."""
-    chunk = []
-    size = 0
-    for event in events:
-        event_size = sys.getsizeof(json.dumps(event))
-        if size + event_size > max_size:
-            yield chunk
-            chunk = []
-            size = 0
-        chunk.append(event)
-        size += event_size
-    if chunk:
-        yield chunk
+class Batch(NamedTuple):
+  """A serialized batchCreate request body.
+
+  skipped counts the entities too large for any request that were dropped
+  among or before the ones of the body, since the previous body; the
+  position in the feed after the body is count + skipped entities further.
+  """
+  body: bytes
+  count: int
+  keys: tuple = ()
+  skipped: int = 0
+
+
+def encode_entity(entity: Any) -> bytes:
+  """Serializes an entity as compact UTF-8 JSON.
+
+  Args:
+    entity: A udm.UdmEntity, or a dict.
+  """
+  to_json = getattr(entity, "to_json", None)
+  if to_json is not None:
+    return to_json()
+  return json.dumps(entity, ensure_ascii=False,
+                    separators=(",", ":")).encode("utf-8")
+
+
+def pack_entities(
+    entities: Iterable[Any],
+    customer_id: str,
+    max_size: int,
+    log_type: str = "STIX",
+    key: Optional[Callable[[Any], Any]] = None,
+) -> Iterator[Batch]:
+  """Packs entities into batchCreate bodies no larger than max_size bytes.
+
+  Every entity is serialized once and the size of the request envelope is
+  taken into account, so the bodies can be sent as they are. An entity
+  larger than a request on its own is dropped and counted in Batch.skipped;
+  the ones after the last body are not counted.
+
+  Args:
+    entities (Iterable): UDM entities, see encode_entity.
+    customer_id (str): Chronicle customer ID.
+    max_size (int): Maximum size of a request body, in bytes.
+    log_type (str): Log type of the entities.
+    key (Optional[Callable]): Computes a key for every entity, the keys of
+      the entities of a batch are kept in Batch.keys.
+
+  Yields:
+    Batch: Request body, number of entities it contains, their keys and the
+      entities skipped.
+  """
+  prefix = ('{"customer_id":%s,"log_type":%s,"entities":[' % (
+      json.dumps(customer_id), json.dumps(log_type))).encode("utf-8")
+  suffix = b"]}"
+  overhead = len(prefix) + len(suffix)
+  parts = []
+  keys = []
+  skipped = 0
+  size = overhead
+  for entity in entities:
+    data = encode_entity(entity)
+    if overhead + len(data) > max_size:
+      print(f"entity of {len(data)} bytes does not fit in a request, skipped")
+      skipped += 1
+      continue
+    # entities after the first one also need a separating comma
+    extra = len(data) + 1 if parts else len(data)
+    if size + extra > max_size:
+      yield Batch(prefix + b",".join(parts) + suffix, len(parts), tuple(keys), skipped)
+      parts = []
+      keys = []
+      skipped = 0
+      size = overhead
+      extra = len(data)
+    parts.append(data)
+    if key is not None:
+      keys.append(key(entity))
+    size += extra
+  if parts:
+    yield Batch(prefix + b",".join(parts) + suffix, len(parts), tuple(keys), skipped)
+
+
+# Key of the entities in a batchCreate body; a quote inside the customer ID
+# or the log type is escaped, so the first match ends the envelope prefix.
+_ENTITIES_KEY = b'"entities":['
+
+
+def batch_overhead(batch: Batch) -> int:
+  """Bytes of the envelope of a batchCreate body, around its entities."""
+  return batch.body.index(_ENTITIES_KEY) + len(_ENTITIES_KEY) + 2
+
+
+def join_batches(batches: List[Batch]) -> Batch:
+  """Joins batchCreate bodies of the same customer and log type into one.
+
+  The body is as long as the bodies together, less all the envelopes but
+  one, plus a separating comma per joined body.
+
+  Args:
+    batches (List[Batch]): Bodies built by pack_entities, in order.
+
+  Returns:
+    Batch: The entities and keys of all the batches, in order.
+  """
+  if len(batches) == 1:
+    return batches[0]
+  parts = [batches[0].body[:-2]]
+  for batch in batches[1:]:
+    parts.append(batch.body[batch.body.index(_ENTITIES_KEY) + len(_ENTITIES_KEY):-2])
+  return Batch(b",".join(parts) + b"]}", sum(batch.count for batch in batches),
+               tuple(key for batch in batches for key in batch.keys),
+               sum(batch.skipped for batch in batches))
 
 
 
@@ -137,8 +348,7 @@ def create_secret(
     """
 
 
-    # Create the Secret Manager client.
-    client = secretmanager.SecretManagerServiceClient()
+    client = get_secret_client()
 
     # Build the resource name of the parent project.
     parent = f"projects/{project_id}"
@@ -155,12 +365,25 @@ def create_secret(
     print(f"Created secret: {response.name}")
 
 def update_secret(
-    resource_path: str, text: str
+    resource_path: str, text: str, destroy_previous: bool = False
 ):
-    client = secretmanager.SecretManagerServiceClient()
+    """
+    Adds a new version to the secret, unless its latest version, as last
+    read or written by this process, already holds text. With
+    destroy_previous the version it replaces is destroyed.
+    """
+    if _latest_values.get(resource_path) == text:
+        print(f"Secret {resource_path} unchanged, no new version added")
+        return
+    client = get_secret_client()
     #text = text.encode('UTF-8')
     version = client.add_secret_version(
         request={"parent": resource_path, "payload": {"data": bytes(text, "UTF-8")}}
     )
+    _latest_values[resource_path] = text
+    previous = _latest_versions.get(resource_path)
+    _latest_versions[resource_path] = version.name
+    if destroy_previous and previous:
+        client.destroy_secret_version(request={"name": previous})
 
     print(f"Updated secret {resource_path}!")
\ No newline at end of file
@@ -0,0 +1,97 @@
+"""Ingests STIX export files into Chronicle, without the CTM360 API.
+
+Usage:
+  python bulk_ingest.py FILE [FILE ...] --customer-id ID [--region REGION]
+      [--credentials credentials.json] [--processes N] [--format auto|json|jsonl]
+  python bulk_ingest.py FILE [FILE ...] --dry-run DIR
+
+Files are JSON (a STIX bundle, a CTM page or an array of objects) or JSON
+lines, gzipped or not, see bulk.py. With --dry-run the batchCreate bodies
+are written to DIR instead of being posted, no credentials are needed.
+"""
+
+import argparse
+import json
+import os
+import sys
+
+# the ingestion modules are shared with the Cloud Function
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Cloud Function"))
+import bulk
+import metrics
+import retry
+import transport
+import utils
+from uploader import BatchUploader
+
+SCOPES = ['https://www.googleapis.com/auth/malachite-ingestion']
+
+# Environment variables
+ENV_CHRONICLE_CUSTOMER_ID = "CHRONICLE_CUSTOMER_ID"
+ENV_CHRONICLE_INGESTION_URL = "CHRONICLE_INGESTION_URL"
+
+
+def make_uploader(args, stats):
+    """The uploader of the run, a BatchWriter for a dry run."""
+    if args.dry_run:
+        return bulk.BatchWriter(args.dry_run)
+    # imported here, a dry run needs no Google packages
+    from google.oauth2 import service_account  # pylint: disable=import-outside-toplevel
+    credentials = service_account.Credentials.from_service_account_file(args.credentials, scopes=SCOPES)
+    ingestion_url = args.ingestion_url or utils.instance_region(args.region)
+    return BatchUploader(
+        transport.Transport.from_env(credentials, max_concurrency=2 * args.concurrency),
+        f"{ingestion_url}/v2/entities:batchCreate",
+        concurrency=args.concurrency, max_concurrency=2 * args.concurrency,
+        policy=retry.RetryPolicy(args.max_attempts), metrics=stats)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("files", nargs="+", help="JSON or JSON lines files, .gz for gzipped ones")
+    parser.add_argument("--customer-id", default=os.environ.get(ENV_CHRONICLE_CUSTOMER_ID),
+                        help="Chronicle customer ID (default $CHRONICLE_CUSTOMER_ID)")
+    parser.add_argument("--region", default="europe", help="Chronicle instance region")
+    parser.add_argument("--ingestion-url", default=os.environ.get(ENV_CHRONICLE_INGESTION_URL),
+                        help="ingestion API base URL, replacing the one of --region")
+    parser.add_argument("--credentials", default="credentials.json", help="service account file")
+    parser.add_argument("--dry-run", metavar="DIR", help="write the batches to DIR instead of posting them")
+    parser.add_argument("--processes", type=int, default=None, help="worker processes (default: CPUs)")
+    parser.add_argument("--format", choices=("auto", "json", "jsonl"), default="auto",
+                        help="file format, auto tells it from the file names")
+    parser.add_argument("--concurrency", type=int, default=4, help="batchCreate requests sent in parallel")
+    parser.add_argument("--max-attempts", type=int, default=5, help="attempts made for a batch")
+    parser.add_argument("--max-size", type=int, default=1048576, help="largest batchCreate body, in bytes")
+    parser.add_argument("--chunk-mb", type=float, default=8, help="MB of JSON lines per worker task")
+    parser.add_argument("--chunk-objects", type=int, default=5000, help="objects of a JSON file per worker task")
+    args = parser.parse_args()
+    if not args.customer_id:
+        if not args.dry_run:
+            parser.error("--customer-id or CHRONICLE_CUSTOMER_ID is required")
+        args.customer_id = "customer_id"
+
+    stats = metrics.Metrics()
+    uploader = make_uploader(args, stats)
+    engine = bulk.BulkIngest(
+        args.customer_id, uploader, processes=args.processes, max_size=args.max_size,
+        fmt=args.format, chunk_bytes=int(args.chunk_mb * 2**20),
+        chunk_objects=args.chunk_objects, metrics=stats)
+    status = "error"
+    report = {}
+    try:
+        report = engine.run(args.files)
+        status = "ok"
+    finally:
+        uploader.close()
+        summary = stats.summary(status=status, **report)
+        if args.dry_run:
+            summary["dry_run"] = {"directory": args.dry_run, "batches": uploader.batches,
+                                  "bytes": uploader.bytes}
+        else:
+            summary["post"] = uploader.policy.stats.as_dict()
+        print(json.dumps(summary))
+
+
+# the worker processes import this script again on platforms without fork
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,252 @@
+"""End-to-end benchmark of the Cloud Function against stand-in servers.
+
+Runs main() of the Cloud Function, unchanged, against the CTM360 and
+Chronicle servers of fake_servers.py started in a separate process, and
+prints entities/sec, peak RSS of the function process, batchCreate requests
+and bytes on the wire. Secret Manager is replaced in process by a client
+serving generated secrets, so no Google Cloud project or credentials are
+needed; the packages of "Cloud Function/requirements.txt" are. With
+--secret-checkpoints the checkpoints and leases are kept in that client, as
+with the default backend of the function, instead of in files.
+
+Usage:
+  python benchmarks/bench_e2e.py [--objects N] [--page-size N] [--quota-rps R]
+      [--collections N] [--overlap N] [--max-invocations N] [--secret-checkpoints]
+      [--env NAME=VALUE ...] [--json]
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import fake_servers
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "Cloud Function"))
+
+import utils  # pylint: disable=wrong-import-position
+
+SECRET_PREFIX = "projects/bench/secrets/"
+
+
+class _Version:
+    def __init__(self, name, value):
+        self.name = name
+        self.payload = type("Payload", (), {"data": value.encode("utf-8")})
+
+
+class _Secret:
+    def __init__(self, name, annotations, etag):
+        self.name = name
+        self.annotations = annotations
+        self.etag = etag
+
+
+class FakeSecretClient:
+    """In process stand-in for the Secret Manager client.
+
+    Secrets have a latest version and annotations updated with an etag,
+    like the real service; a secret created without a version has no
+    payload until one is added.
+
+    Args:
+      values (dict): Payload of each secret, keyed by secret name.
+    """
+
+    def __init__(self, values):
+        self.values = dict(values)
+        self.versions = 0
+        self.annotations = {}
+        self.etags = {}
+        self.lock = threading.Lock()
+
+    def access_secret_version(self, name=None, request=None):
+        from google.api_core import exceptions  # pylint: disable=import-outside-toplevel
+        name = name or request["name"]
+        secret = name.split("/")[3]
+        with self.lock:
+            if self.values.get(secret) is None:
+                raise exceptions.NotFound(f"Secret [{SECRET_PREFIX}{secret}] not found or has no versions.")
+            return _Version(f"{SECRET_PREFIX}{secret}/versions/{self.versions}",
+                            self.values[secret])
+
+    def add_secret_version(self, request):
+        secret = request["parent"].split("/")[3]
+        with self.lock:
+            self.versions += 1
+            self.values[secret] = request["payload"]["data"].decode("utf-8")
+            return _Version(f"{request['parent']}/versions/{self.versions}",
+                            self.values[secret])
+
+    def create_secret(self, request):
+        from google.api_core import exceptions  # pylint: disable=import-outside-toplevel
+        secret = request["secret_id"]
+        with self.lock:
+            if secret in self.values:
+                raise exceptions.AlreadyExists(f"Secret [{SECRET_PREFIX}{secret}] already exists.")
+            self.values[secret] = None
+            return _Version(f"{request['parent']}/secrets/{secret}", "")
+
+    def destroy_secret_version(self, request):
+        pass
+
+    def get_secret(self, request):
+        from google.api_core import exceptions  # pylint: disable=import-outside-toplevel
+        secret = request["name"].split("/")[3]
+        with self.lock:
+            if secret not in self.values:
+                raise exceptions.NotFound(f"Secret [{request['name']}] not found.")
+            return _Secret(request["name"], dict(self.annotations.get(secret, {})),
+                           self.etags.get(secret, "0"))
+
+    def update_secret(self, request):
+        from google.api_core import exceptions  # pylint: disable=import-outside-toplevel
+        name = request["secret"]["name"]
+        secret = name.split("/")[3]
+        with self.lock:
+            if secret not in self.values:
+                raise exceptions.NotFound(f"Secret [{name}] not found.")
+            if request["secret"].get("etag") not in (None, self.etags.get(secret, "0")):
+                raise exceptions.Aborted(f"The etag of secret [{name}] does not match.")
+            self.annotations[secret] = dict(request["secret"]["annotations"])
+            self.etags[secret] = str(int(self.etags.get(secret, "0")) + 1)
+            return _Secret(name, dict(self.annotations[secret]), self.etags[secret])
+
+
+class _Request:
+    """The part of the Flask request read by main()."""
+
+    def get_json(self, silent=False):  # pylint: disable=unused-argument
+        return None
+
+
+def service_account(token_uri):
+    """Service account info with a fresh key, its tokens come from token_uri."""
+    import rsa  # pylint: disable=import-outside-toplevel
+    _, private_key = rsa.newkeys(2048)
+    return {
+        "type": "service_account",
+        "project_id": "bench",
+        "private_key_id": "bench",
+        "private_key": private_key.save_pkcs1().decode("ascii"),
+        "client_email": "bench@bench.iam.gserviceaccount.com",
+        "client_id": "0",
+        "token_uri": token_uri,
+    }
+
+
+def _environment(ctm_url, chronicle_url, workdir, overrides):
+    env = {
+        "CHRONICLE_CUSTOMER_ID": SECRET_PREFIX + "customer/versions/latest",
+        "CHRONICLE_SERVICE_ACCOUNT": SECRET_PREFIX + "service_account/versions/latest",
+        "CTM_COLLECTION_ID": SECRET_PREFIX + "collection/versions/latest",
+        "CTM_KEY_ID": SECRET_PREFIX + "ctm_key/versions/latest",
+        "CTM_NEXT": SECRET_PREFIX + "CTM_NEXT/versions/latest",
+        "CHRONICLE_REGION": "europe",
+        "CTM_URL": ctm_url,
+        "CHRONICLE_INGESTION_URL": chronicle_url,
+        "CHECKPOINT_BACKEND": "file",
+        "CHECKPOINT_PATH": os.path.join(workdir, "checkpoint"),
+        "METRICS_BACKEND": "file",
+        "METRICS_PATH": os.path.join(workdir, "metrics.jsonl"),
+        "RETRY_BASE_DELAY": "0.05",
+        "RETRY_MAX_DELAY": "2",
+    }
+    for override in overrides:
+        name, _, value = override.partition("=")
+        env[name] = value
+    return env
+
+
+def run(config, overrides, collections=1, max_invocations=100, overlap=1,
+        secret_checkpoints=False):
+    """Ingests the fake collection with main() and returns the report.
+
+    With overlap, every round starts that many invocations at the same time,
+    like triggers firing while the previous run is still going. With
+    secret_checkpoints the checkpoints and leases use the secret backends.
+    """
+    if secret_checkpoints:
+        overrides = ["CHECKPOINT_BACKEND=secret", *overrides]
+    ready = multiprocessing.get_context("spawn").Queue()
+    servers = multiprocessing.get_context("spawn").Process(
+        target=fake_servers.serve, args=(config, ready), daemon=True)
+    servers.start()
+    try:
+        ctm_url, chronicle_url = ready.get(timeout=120)
+        with tempfile.TemporaryDirectory() as workdir:
+            os.environ.update(_environment(ctm_url, chronicle_url, workdir, overrides))
+            utils._client = secrets = FakeSecretClient({  # pylint: disable=protected-access
+                "customer": "bench-customer",
+                "service_account": json.dumps(service_account(f"{chronicle_url}/token")),
+                "collection": ",".join(f"bench{i}" for i in range(collections)),
+                "ctm_key": "bench-key",
+            })
+            started = time.perf_counter()
+            import main as function  # pylint: disable=import-outside-toplevel
+            cold_start = time.perf_counter() - started
+            statuses = []
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=overlap) as executor:
+                while len(statuses) < max_invocations:
+                    statuses += executor.map(lambda _: function.main(_Request()), range(overlap))
+                    if "TIMEOUT" not in statuses[-overlap:]:
+                        break
+            elapsed = time.perf_counter() - started
+            function.instance.get().http_transport.close()
+            with urllib.request.urlopen(f"{chronicle_url}/stats") as response:
+                stats = json.load(response)
+    finally:
+        servers.terminate()
+    return {
+        "status": "ok" if "ok" in statuses[-overlap:] else statuses[-1],
+        "invocations": len(statuses),
+        "cold_start_seconds": round(cold_start, 3),
+        "seconds": round(elapsed, 3),
+        "entities_per_sec": round(stats["entities"] / elapsed, 1) if elapsed else 0,
+        "mean_score": round(stats["score_total"] / stats["entities"], 1) if stats["entities"] else 0,
+        # ru_maxrss is in KiB on Linux
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "secret_versions": secrets.versions,
+        **stats,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    fake_servers.add_arguments(parser)
+    parser.add_argument("--collections", type=int, default=1,
+                        help="collections ingested by each invocation")
+    parser.add_argument("--overlap", type=int, default=1,
+                        help="invocations started at the same time")
+    parser.add_argument("--secret-checkpoints", action="store_true",
+                        help="keep the checkpoints and leases in the stand-in Secret Manager")
+    parser.add_argument("--max-invocations", type=int, default=100,
+                        help="invocations run at most, while the previous one times out")
+    parser.add_argument("--env", action="append", default=[], metavar="NAME=VALUE",
+                        help="environment variable of the function, e.g. UPLOAD_CONCURRENCY=8")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args()
+
+    report = run(fake_servers.config_from_args(args), args.env, args.collections,
+                 max_invocations=args.max_invocations, overlap=args.overlap,
+                 secret_checkpoints=args.secret_checkpoints)
+    if args.json:
+        print(json.dumps(report))
+        return
+    for name, value in report.items():
+        print(f"{name:<20} {value:>14,}" if isinstance(value, (int, float))
+              else f"{name:<20} {str(value):>14}")
+    if report["duplicates"]:
+        print(f"warning: {report['duplicates']} entities were received more than once")
+
+
+if __name__ == "__main__":
+    main()
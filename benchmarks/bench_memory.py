@@ -0,0 +1,74 @@
+"""Memory and encoding cost of the UDM entities of a CTM page.
+
+Compares the nested dicts built by the original loop of main() with the
+udm.UdmEntity objects built by transformer.py: bytes allocated per entity
+while a page of entities is held in memory, and entities/sec encoded to the
+JSON of the batchCreate body.
+
+Usage:
+  python benchmarks/bench_memory.py [--objects N] [--rounds R]
+"""
+
+import argparse
+import gc
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "Cloud Function"))
+
+import transformer  # pylint: disable=wrong-import-position
+from bench_transform import legacy_transform, make_objects, now  # pylint: disable=wrong-import-position
+
+
+def allocated(build, objects):
+    """Bytes allocated by build(objects) and still held by its result."""
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = build(objects)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+    return after - before
+
+
+def encode_dict(entity):
+    return json.dumps(entity, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def encoding_rate(encode, entities, rounds):
+    best = float("inf")
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for entity in entities:
+            encode(entity)
+        best = min(best, time.perf_counter() - start)
+    return len(entities) / best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--objects", type=int, default=20000)
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    objects = make_objects(args.objects)
+    dicts = allocated(legacy_transform, objects)
+    slotted = allocated(lambda o: transformer.transform_objects(o, now()), objects)
+    print(f"{'':<10} {'bytes/entity':>14} {'encoded/sec':>14} {'json bytes':>12}")
+    legacy = legacy_transform(objects)
+    entities = transformer.transform_objects(objects, now())
+    for name, size, encode, page in (
+            ("dicts", dicts, encode_dict, legacy),
+            ("UdmEntity", slotted, lambda entity: entity.to_json(), entities)):
+        rate = encoding_rate(encode, page, args.rounds)
+        body = sum(len(encode(entity)) for entity in page) / len(page)
+        print(f"{name:<10} {size / len(page):>14,.0f} {rate:>14,.0f} {body:>12,.0f}")
+    print(f"memory     {dicts / slotted:>14.2f}x smaller")
+
+
+if __name__ == "__main__":
+    main()
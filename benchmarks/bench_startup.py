@@ -0,0 +1,144 @@
+"""Cold start of the Cloud Function, from process start to first response.
+
+Starts the function in a new process with functions-framework, the way
+Cloud Functions loads it, against the stand-in servers of fake_servers.py,
+and measures the seconds from the process start until it accepts requests,
+until the response of its first request and the duration of a second, warm,
+request. Secret Manager is replaced by an in process client answering after
+--secret-latency seconds; it imports the Secret Manager package on first
+use, like the real client, so that its import is counted.
+
+Usage:
+  python benchmarks/bench_startup.py [--objects N] [--runs N]
+      [--secret-latency S] [--env NAME=VALUE ...] [--json]
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+CLOUD_FUNCTION = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Cloud Function")
+
+
+def child(config):
+    """Serves the function in this process, writing its port to config["port_file"]."""
+    sys.path.insert(0, CLOUD_FUNCTION)
+    import bench_e2e  # pylint: disable=import-outside-toplevel
+    import utils  # pylint: disable=import-outside-toplevel
+
+    class SlowSecretClient(bench_e2e.FakeSecretClient):
+        def access_secret_version(self, name=None, request=None):
+            # the real client comes with the Secret Manager package
+            import google.cloud.secretmanager  # pylint: disable=import-outside-toplevel,unused-import
+            time.sleep(config["secret_latency"])
+            return super().access_secret_version(name, request)
+
+    utils._client = SlowSecretClient(config["secrets"])  # pylint: disable=protected-access
+    import functions_framework  # pylint: disable=import-outside-toplevel
+    from werkzeug.serving import make_server  # pylint: disable=import-outside-toplevel
+    app = functions_framework.create_app("main", os.path.join(CLOUD_FUNCTION, "main.py"))
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    with open(config["port_file"] + ".tmp", "w", encoding="utf-8") as f:
+        f.write(str(server.server_port))
+    os.replace(config["port_file"] + ".tmp", config["port_file"])
+    server.serve_forever()
+
+
+def _request(port):
+    """Seconds until the status line and headers of a request are received."""
+    started = time.perf_counter()
+    request = urllib.request.Request(f"http://127.0.0.1:{port}/", data=b"{}",
+                                     headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(request, timeout=600) as response:
+        seconds = time.perf_counter() - started
+        body = response.read().decode("utf-8")
+    return seconds, body
+
+
+def measure(ctm_url, chronicle_url, secrets, overrides, secret_latency):
+    """Starts the function once and returns its startup timings."""
+    import bench_e2e  # pylint: disable=import-outside-toplevel
+    with tempfile.TemporaryDirectory() as workdir:
+        port_file = os.path.join(workdir, "port")
+        config = {"secrets": secrets, "secret_latency": secret_latency, "port_file": port_file}
+        env = dict(os.environ, **bench_e2e._environment(  # pylint: disable=protected-access
+            ctm_url, chronicle_url, workdir, overrides))
+        env["PYTHONPATH"] = os.pathsep.join([os.path.dirname(os.path.abspath(__file__)), CLOUD_FUNCTION])
+        started = time.perf_counter()
+        process = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), "--child", json.dumps(config)],
+            env=env, stdout=subprocess.DEVNULL)
+        try:
+            while not os.path.exists(port_file):
+                if process.poll() is not None:
+                    sys.exit(f"the function exited with {process.returncode} before serving")
+                time.sleep(0.002)
+            ready = time.perf_counter() - started
+            with open(port_file, encoding="utf-8") as f:
+                port = int(f.read())
+            first, status = _request(port)
+            first_byte = time.perf_counter() - started
+            second, _ = _request(port)
+        finally:
+            process.terminate()
+            process.wait()
+    return {"ready_seconds": ready, "first_request_seconds": first,
+            "import_to_first_byte_seconds": first_byte,
+            "warm_request_seconds": second, "status": status}
+
+
+def main():
+    # imported here, the child process times its own imports
+    import bench_e2e  # pylint: disable=import-outside-toplevel
+    import fake_servers  # pylint: disable=import-outside-toplevel
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    fake_servers.add_arguments(parser)
+    parser.set_defaults(objects=100)
+    parser.add_argument("--runs", type=int, default=5, help="function processes started")
+    parser.add_argument("--secret-latency", type=float, default=0.05,
+                        help="seconds taken by each Secret Manager read")
+    parser.add_argument("--env", action="append", default=[], metavar="NAME=VALUE",
+                        help="environment variable of the function")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args()
+
+    ready_queue = multiprocessing.get_context("spawn").Queue()
+    servers = multiprocessing.get_context("spawn").Process(
+        target=fake_servers.serve, args=(fake_servers.config_from_args(args), ready_queue), daemon=True)
+    servers.start()
+    try:
+        ctm_url, chronicle_url = ready_queue.get(timeout=120)
+        secrets = {
+            "customer": "bench-customer",
+            "service_account": json.dumps(bench_e2e.service_account(f"{chronicle_url}/token")),
+            "collection": "bench0",
+            "ctm_key": "bench-key",
+        }
+        runs = [measure(ctm_url, chronicle_url, secrets, args.env, args.secret_latency)
+                for _ in range(args.runs)]
+    finally:
+        servers.terminate()
+    report = {name: round(statistics.median(run[name] for run in runs), 3)
+              for name in runs[0] if name != "status"}
+    report["status"] = runs[-1]["status"]
+    report["runs"] = len(runs)
+    if args.json:
+        print(json.dumps(report))
+        return
+    for name, value in report.items():
+        print(f"{name:<30} {value:>10}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 3 and sys.argv[1] == "--child":
+        child(json.loads(sys.argv[2]))
+    else:
+        main()
@@ -0,0 +1,237 @@
+"""Micro-benchmark of the STIX to UDM transformation.
+
+Compares the original per-object loop of main() with transformer.py on a
+synthetic CTM page and prints objects/sec for both. Both sides are timed up
+to the same point: every entity serialized by utils.encode_entity, the bytes
+utils.pack_entities joins into batchCreate bodies.
+
+Usage:
+  python benchmarks/bench_transform.py [--objects N] [--rounds R]
+"""
+
+import argparse
+import datetime
+import json
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "Cloud Function"))
+
+import transformer  # pylint: disable=wrong-import-position
+import utils  # pylint: disable=wrong-import-position
+
+OBSERVABLES = [
+    ("StixFile", "{:064x}"),
+    ("Url", "http://bad-{}.example.com/login"),
+    ("Domain-Name", "bad-{}.example.com"),
+    ("IPv4-Addr", "[ipv4-addr:value = '10.0.{}.1']"),
+    ("Hostname", "host-{}.example.net"),
+    ("Email-Addr", "phish-{}@example.org"),
+]
+
+
+def make_objects(count):
+    """Builds count CTM indicators cycling over the supported observables."""
+    objects = []
+    for i in range(count):
+        observable_type, name = OBSERVABLES[i % len(OBSERVABLES)]
+        objects.append({
+            "id": f"indicator--{i:08d}",
+            "name": name.format(i % 256 if observable_type == "IPv4-Addr" else i),
+            "confidence": 80,
+            "description": "Indicator observed in a phishing campaign",
+            "labels": ["phishing", "malicious-activity"],
+            "pattern": f"[x:value = '{i}']",
+            "pattern_type": "stix",
+            "pattern_version": "2.1",
+            "valid_from": "2024-01-01T00:00:00Z",
+            "valid_until": "2024-07-01T00:00:00Z",
+            "extensions": {
+                transformer.CTM_EXTENSION: {
+                    "main_observable_type": observable_type,
+                    "created_at": "2024-01-01T00:00:00Z",
+                    "updated_at": "2024-01-02T00:00:00Z",
+                    "score": 75,
+                    "extension_type": "property-extension",
+                    "type": "indicator",
+                    "detection": True,
+                }
+            },
+        })
+    return objects
+
+
+def now():
+    return datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+
+def legacy_transform(objects):
+    """The transformation loop of main() before transformer.py."""
+    events = []
+    for obj in objects:
+        if obj['extensions']['extension-definition--ea279b3e-5c71-4632-ac08-831c66a786ba']['main_observable_type'] not in ["StixFile","Url","Domain-Name","IPv4-Addr","Hostname","Email-Addr"]:
+            print("object not supported -> ", obj['extensions']['extension-definition--ea279b3e-5c71-4632-ac08-831c66a786ba']['main_observable_type'])
+            continue
+        metadata = {}
+        file = {}
+        threat = {}
+        interval = {}
+        entity = {}
+        user = {}
+        additionals = {}
+
+        # >>> METADATA
+        metadata['vendor_name'] = "CTM_CUSTOM_IOC"
+        metadata['product_name'] = "CTM_CUSTOM_IOC"
+        metadata['collected_timestamp'] = now()
+        metadata['product_entity_id'] = obj['id']
+
+        # metadata.threat
+        threat['confidence_details'] = str(obj['confidence'])
+        threat['first_discovered_time'] = obj['extensions']['extension-definition--ea279b3e-5c71-4632-ac08-831c66a786ba']['created_at']
+        threat['last_updated_time'] = obj['extensions']['extension-definition--ea279b3e-5c71-4632-ac08-831c66a786ba']['updated_at']
+
+        # additionals
+
+        additionals['score'] = obj['extensions']['extension-definition--ea279b3e-5c71-4632-ac08-831c66a786ba']['score']
+        try:
+             additionals['description'] = obj['description']
+        except KeyError:
+             pass
+        additionals['extension_type'] = obj['extensions']['extension-definition--ea279b3e-5c71-4632-ac08-831c66a786ba']['extension_type']
+        additionals['type'] = obj['extensions']['extension-definition--ea279b3e-5c71-4632-ac08-831c66a786ba']['type']
+        additionals['detection'] = str(obj['extensions']['extension-definition--ea279b3e-5c71-4632-ac08-831c66a786ba']['detection'])
+        try:
+             additionals['labels'] = obj['labels']
+        except KeyError:
+             pass
+        additionals['pattern'] = obj['pattern']
+        additionals['pattern_type'] = obj['pattern_type']
+        try:
+             additionals['pattern_version'] = obj['pattern_version']
+        except KeyError:
+             pass
+                # >>> ENTITY
+                # - entity.type
+        match obj['extensions']['extension-definition--ea279b3e-5c71-4632-ac08-831c66a786ba']['main_observable_type']:
+            case "StixFile":
+                #entity['file'] = obj['name']
+                try:
+                    file['sha256'] = obj['name']
+                except KeyError:
+                    pass
+                metadata['entity_type'] = 'FILE'
+                interval['start_time'] = obj['valid_from']
+                interval['end_time'] = obj['valid_until']
+
+            case "Url":
+                entity['url'] = obj['name']
+                metadata['entity_type'] = 'URL'
+                interval['start_time'] = obj['valid_from']
+                interval['end_time'] = obj['valid_until']
+
+            case "Domain-Name":
+                entity['hostname'] = obj['name']
+                metadata['entity_type'] = 'DOMAIN_NAME'
+                interval['start_time'] = obj['valid_from']
+                interval['end_time'] = obj['valid_until']
+
+            case "IPv4-Addr":
+                match = re.search(r"(\d+\.\d+\.\d+\.\d+)",obj['name'])
+                obj['name']= match.group(1)
+                entity['ip'] = obj['name']
+                metadata['entity_type'] = 'IP_ADDRESS'
+                interval['start_time'] = obj['valid_from']
+                interval['end_time'] = obj['valid_until']
+
+            case "Hostname":
+                entity['hostname'] = obj['name']
+                metadata['entity_type'] = 'DOMAIN_NAME'
+                interval['start_time'] = obj['valid_from']
+                interval['end_time'] = obj['valid_until']
+
+            case "Email-Addr":
+                user["emailAddresses"] = [obj["name"]]
+                metadata['entity_type'] = 'USER'
+                interval['start_time'] = obj['valid_from']
+                interval['end_time'] = obj['valid_until']
+
+        # build the top level UDM Objects
+        metadata['threat'] = [threat]
+        metadata['interval'] = interval
+        entity['file'] = file
+        entity['user'] = user
+        #create the final UDM event
+        event = {}
+
+        event['metadata'] = metadata
+        event['entity'] = entity
+        event['additional'] = additionals
+        log = json.dumps(event)
+        events.append(json.loads((log)))
+
+    return events
+
+
+def legacy_encoded(objects):
+    """The legacy loop, up to the bytes of every entity."""
+    return [utils.encode_entity(event) for event in legacy_transform(objects)]
+
+
+def transformer_encoded(objects):
+    """transformer.py, up to the bytes of every entity."""
+    return [utils.encode_entity(entity) for entity in transformer.transform_objects(objects, now())]
+
+
+def _strip_timestamps(events):
+    for event in events:
+        event["metadata"].pop("collected_timestamp")
+    return events
+
+
+def _strip_empty(events):
+    """Drops the empty file and user objects, left out by udm.UdmEntity."""
+    for event in events:
+        for name in ("file", "user"):
+            if not event["entity"][name]:
+                del event["entity"][name]
+    return events
+
+
+def bench(name, func, objects, rounds):
+    best = float("inf")
+    for _ in range(rounds):
+        start = time.perf_counter()
+        func(objects)
+        best = min(best, time.perf_counter() - start)
+    rate = len(objects) / best
+    print(f"{name:<12} {rate:>12,.0f} objects/sec")
+    return rate
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--objects", type=int, default=20000)
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    objects = make_objects(args.objects)
+    expected = _strip_empty(_strip_timestamps(legacy_transform(make_objects(args.objects))))
+    entities = transformer.transform_objects(objects, now())
+    actual = _strip_timestamps([entity.to_dict() for entity in entities])
+    if json.dumps(expected, sort_keys=True) != json.dumps(actual, sort_keys=True):
+        sys.exit("transformer.py output differs from the legacy loop")
+    for entity in entities:
+        if entity.to_json() != json.dumps(entity.to_dict(), ensure_ascii=False,
+                                          separators=(",", ":")).encode("utf-8"):
+            sys.exit("UdmEntity.to_json differs from json.dumps")
+
+    before = bench("legacy", legacy_encoded, make_objects(args.objects), args.rounds)
+    after = bench("transformer", transformer_encoded, objects, args.rounds)
+    print(f"speedup      {after / before:>12.2f}x")
+
+
+if __name__ == "__main__":
+    main()
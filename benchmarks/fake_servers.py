@@ -0,0 +1,428 @@
+"""Stand-in CTM360 and Chronicle servers for offline benchmarks.
+
+The CTM360 server serves synthetic collections, any name in
+``/collections/<name>/objects``, in pages linked by the
+``more``/``next`` fields, with a configurable page size, overridden by the
+``limit`` parameter up to a maximum, mix of observable types, share of
+expired indicators, latency and error rate. The Chronicle server accepts
+``v2/entities:batchCreate`` requests, rejects bodies over 1 MB like the real
+endpoint, answers 429 above a request rate quota and counts what it
+receives. It also serves the OAuth token endpoint of the service account.
+Counters are read from ``GET /stats`` of the Chronicle server.
+
+Usage:
+  python benchmarks/fake_servers.py [--objects N] [--page-size N] [--mix Url=3,IPv4-Addr=1]
+"""
+
+import argparse
+import gzip
+import json
+import os
+import random
+import sys
+import threading
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional
+from urllib.parse import parse_qs, urlparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "Cloud Function"))
+
+import transformer  # pylint: disable=wrong-import-position
+from bench_transform import OBSERVABLES  # pylint: disable=wrong-import-position
+
+# Largest batchCreate body accepted by Chronicle, in bytes.
+MAX_BODY = 1048576
+
+# Values of the observable types mapped by mapping.json only.
+EXTRA_OBSERVABLES = [
+    ("IPv6-Addr", "[ipv6-addr:value = '2001:db8::{:x}']"),
+]
+
+DEFAULT_MIX = ",".join(f"{observable}=1" for observable, _ in OBSERVABLES)
+
+
+def parse_mix(value: str) -> Dict[str, float]:
+    """Parses "Type=weight,..." into a dict, unknown types are not supported."""
+    mix = {}
+    for part in value.split(","):
+        name, _, weight = part.partition("=")
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+
+def make_objects(count: int, mix: Dict[str, float], seed: int = 0,
+                 collection: str = "bench", expired: float = 0.0,
+                 now: Optional[datetime] = None) -> List[Dict[str, Any]]:
+    """Builds count CTM indicators drawing their observable type from mix.
+
+    The indicator IDs include the collection, so collections do not overlap.
+    A share expired of the indicators has a valid_until up to 30 days before
+    now, the others up to a year after.
+
+    Types missing from bench_transform.OBSERVABLES and EXTRA_OBSERVABLES get
+    a generic value, which the Cloud Function skips as not supported.
+    """
+    rng = random.Random(seed)
+    names = dict(OBSERVABLES + EXTRA_OBSERVABLES)
+    types = list(mix)
+    weights = [mix[name] for name in types]
+    created = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    now = now or datetime.now(timezone.utc)
+    objects = []
+    for i, observable_type in enumerate(rng.choices(types, weights, k=count)):
+        name = names.get(observable_type, "value-{}")
+        days = -rng.uniform(1, 30) if rng.random() < expired else rng.uniform(1, 365)
+        objects.append({
+            "id": f"indicator--{collection}-{i:08d}",
+            "name": name.format(i % 256 if observable_type == "IPv4-Addr" else i),
+            "confidence": rng.randint(0, 100),
+            "description": "Indicator observed in a phishing campaign",
+            "labels": ["phishing", "malicious-activity"],
+            "pattern": f"[x:value = '{i}']",
+            "pattern_type": "stix",
+            "pattern_version": "2.1",
+            "valid_from": "2024-01-01T00:00:00Z",
+            "valid_until": (now + timedelta(days=days)).strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "extensions": {
+                transformer.CTM_EXTENSION: {
+                    "main_observable_type": observable_type,
+                    "created_at": (created + timedelta(seconds=i)).isoformat(),
+                    "updated_at": "2024-01-02T00:00:00Z",
+                    "score": rng.randint(0, 100),
+                    "extension_type": "property-extension",
+                    "type": "indicator",
+                    "detection": True,
+                }
+            },
+        })
+    return objects
+
+
+@dataclass
+class ServerConfig:
+    """Behaviour of the stand-in servers.
+
+    Attributes:
+      objects (int): Indicators in each CTM collection.
+      page_size (int): Indicators per CTM page without ``limit``.
+      max_limit (int): Largest ``limit`` honoured, larger ones are capped;
+        0 for no cap.
+      mix (str): Observable types and weights, e.g. "Url=3,IPv4-Addr=1".
+      expired (float): Share of indicators whose valid_until has passed.
+      ctm_latency (float): Seconds before a CTM page is served.
+      ctm_error_rate (float): Share of CTM requests answered with 503.
+      ctm_cut_rate (float): Share of CTM pages whose body is cut short, the
+        connection is closed half way through.
+      ctm_gzip (bool): Serves the CTM pages gzip encoded when accepted.
+      post_latency (float): Seconds before a batchCreate request is answered.
+      post_error_rate (float): Share of batchCreate requests answered with 503.
+      quota_rps (float): batchCreate requests accepted per second, more are
+        answered with 429; 0 disables the quota.
+      retry_after (str): Retry-After header of the 429 responses, if any.
+      seed (int): Seed of the collection and of the injected errors.
+    """
+    objects: int = 10000
+    page_size: int = 1000
+    max_limit: int = 0
+    mix: str = DEFAULT_MIX
+    expired: float = 0.0
+    ctm_latency: float = 0.0
+    ctm_error_rate: float = 0.0
+    ctm_cut_rate: float = 0.0
+    ctm_gzip: bool = True
+    post_latency: float = 0.0
+    post_error_rate: float = 0.0
+    quota_rps: float = 0.0
+    retry_after: Optional[str] = None
+    seed: int = 0
+
+
+@dataclass
+class Stats:
+    """What the stand-in servers received."""
+    ctm_requests: int = 0
+    ctm_errors: int = 0
+    ctm_cuts: int = 0
+    ctm_pages: int = 0
+    ctm_bytes: int = 0
+    post_requests: int = 0
+    post_accepted: int = 0
+    post_throttled: int = 0
+    post_errors: int = 0
+    post_too_large: int = 0
+    post_wire_bytes: int = 0
+    post_body_bytes: int = 0
+    entities: int = 0
+    duplicates: int = 0
+    expired_entities: int = 0
+    score_total: int = 0
+    token_requests: int = 0
+    _seen: set = field(default_factory=set, repr=False)
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def add(self, **counts: int):
+        with self._lock:
+            for name, count in counts.items():
+                setattr(self, name, getattr(self, name) + count)
+
+    def received(self, ids: List[str], body_bytes: int, scores: int = 0, expired: int = 0):
+        """Records an accepted batch, counting the entities already received.
+
+        scores is the sum of the CTM scores of its entities, expired the
+        number of them whose valid_until had passed.
+        """
+        with self._lock:
+            self.duplicates += sum(1 for i in ids if i in self._seen)
+            self._seen.update(ids)
+            self.score_total += scores
+            self.expired_entities += expired
+            self.post_accepted += 1
+            self.post_body_bytes += body_bytes
+            self.entities += len(ids)
+
+    def as_dict(self) -> Dict[str, int]:
+        with self._lock:
+            return {name: getattr(self, name) for name in self.__dataclass_fields__
+                    if not name.startswith("_")}
+
+
+class _TokenBucket:
+    """Admits rate requests per second, with bursts of the same size."""
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def admit(self) -> bool:
+        if not self.rate:
+            return True
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+    def _reply(self, status: int, body: bytes, headers: Optional[Dict[str, str]] = None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _json(self, status: int, value: Any, headers: Optional[Dict[str, str]] = None):
+        self._reply(status, json.dumps(value).encode("utf-8"),
+                    dict(headers or {}, **{"Content-Type": "application/json"}))
+
+    def _fails(self, rate: float) -> bool:
+        with self.server.lock:
+            return self.server.rng.random() < rate
+
+
+class CTMHandler(_Handler):
+    """Serves the pages of the synthetic collections, ``?next=`` is an object index."""
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        config, stats = self.server.config, self.server.stats
+        stats.add(ctm_requests=1)
+        time.sleep(config.ctm_latency)
+        if self._fails(config.ctm_error_rate):
+            stats.add(ctm_errors=1)
+            self._json(503, {"error": "injected error"})
+            return
+        url = urlparse(self.path)
+        parts = url.path.strip("/").split("/")
+        if len(parts) < 3 or parts[-3] != "collections":
+            self._json(404, {"error": "not found"})
+            return
+        query = parse_qs(url.query)
+        offset = int(query.get("next", ["0"])[0])
+        size = int(query.get("limit", [config.page_size])[0])
+        if config.max_limit:
+            size = min(size, config.max_limit)
+        with self.server.lock:
+            if parts[-2] not in self.server.collections:
+                self.server.collections[parts[-2]] = make_objects(
+                    config.objects, parse_mix(config.mix), config.seed, parts[-2], config.expired)
+            objects = self.server.collections[parts[-2]]
+            key = (parts[-2], offset, size)
+            if key not in self.server.pages and (offset < len(objects) or offset == 0):
+                self.server.pages[key] = _page(config, objects, offset, size)
+            page = self.server.pages.get(key)
+        if page is None:
+            self._json(400, {"error": "invalid next"})
+            return
+        plain, compressed = page
+        headers = {"Content-Type": "application/json"}
+        body = plain
+        if compressed is not None and "gzip" in self.headers.get("Accept-Encoding", ""):
+            body = compressed
+            headers["Content-Encoding"] = "gzip"
+        if self._fails(config.ctm_cut_rate):
+            stats.add(ctm_cuts=1)
+            self.send_response(200)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body[:len(body) // 2])
+            self.close_connection = True
+            return
+        stats.add(ctm_pages=1, ctm_bytes=len(body))
+        self._reply(200, body, headers)
+
+
+class ChronicleHandler(_Handler):
+    """batchCreate, OAuth token and stats endpoints."""
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        if self.path == "/stats":
+            self._json(200, self.server.stats.as_dict())
+        else:
+            self._json(404, {"error": "not found"})
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        config, stats = self.server.config, self.server.stats
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.path == "/token":
+            stats.add(token_requests=1)
+            self._json(200, {"access_token": "bench", "expires_in": 3600,
+                             "token_type": "Bearer"})
+            return
+        if not self.path.endswith("/v2/entities:batchCreate"):
+            self._json(404, {"error": "not found"})
+            return
+        stats.add(post_requests=1, post_wire_bytes=len(body))
+        time.sleep(config.post_latency)
+        if self.headers.get("Content-Encoding") == "gzip":
+            body = gzip.decompress(body)
+        if len(body) > MAX_BODY:
+            stats.add(post_too_large=1)
+            self._json(400, {"error": {"code": 400, "message": "Request payload size exceeds the limit"}})
+            return
+        if not self.server.bucket.admit():
+            stats.add(post_throttled=1)
+            headers = {"Retry-After": config.retry_after} if config.retry_after else None
+            self._json(429, {"error": {"code": 429, "status": "RESOURCE_EXHAUSTED"}}, headers)
+            return
+        if self._fails(config.post_error_rate):
+            stats.add(post_errors=1)
+            self._json(503, {"error": {"code": 503, "status": "UNAVAILABLE"}})
+            return
+        entities = json.loads(body)["entities"]
+        now = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+        stats.received([entity["metadata"]["product_entity_id"] for entity in entities],
+                       len(body), sum(entity["additional"]["score"] for entity in entities),
+                       sum(entity["metadata"]["interval"]["end_time"] <= now for entity in entities))
+        self._json(200, {})
+
+
+def _server(handler, config: ServerConfig, stats: Stats) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    server.config = config
+    server.stats = stats
+    server.rng = random.Random(config.seed)
+    server.lock = threading.Lock()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def _page(config: ServerConfig, objects: List[Dict[str, Any]], offset: int, size: int):
+    """Encodes the page of a collection starting at offset, plain and gzip compressed."""
+    size = max(1, size)
+    more = offset + size < len(objects)
+    page = {"more": more, "objects": objects[offset:offset + size]}
+    if more:
+        page["next"] = str(offset + size)
+    plain = json.dumps(page).encode("utf-8")
+    return plain, gzip.compress(plain, 6) if config.ctm_gzip else None
+
+
+def start(config: ServerConfig):
+    """Starts both servers in background threads.
+
+    Returns:
+      tuple: CTM objects URL, with a {collection} placeholder, Chronicle base
+        URL and the shared Stats.
+    """
+    stats = Stats()
+    ctm = _server(CTMHandler, config, stats)
+    ctm.collections = {}
+    # encoded pages by collection, offset and size
+    ctm.pages = {}
+    chronicle = _server(ChronicleHandler, config, stats)
+    chronicle.bucket = _TokenBucket(config.quota_rps)
+    return (f"http://127.0.0.1:{ctm.server_port}/collections/{{collection}}/objects",
+            f"http://127.0.0.1:{chronicle.server_port}", stats)
+
+
+def serve(config: ServerConfig, ready):
+    """Runs the servers until the process is terminated.
+
+    Args:
+      config (ServerConfig): Behaviour of the servers.
+      ready: Queue receiving the CTM and Chronicle URLs once they listen.
+    """
+    ctm_url, chronicle_url, _ = start(config)
+    ready.put((ctm_url, chronicle_url))
+    threading.Event().wait()
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    """Adds the ServerConfig options to a command line parser."""
+    defaults = ServerConfig()
+    parser.add_argument("--objects", type=int, default=defaults.objects)
+    parser.add_argument("--page-size", type=int, default=defaults.page_size)
+    parser.add_argument("--max-limit", type=int, default=defaults.max_limit)
+    parser.add_argument("--mix", default=defaults.mix,
+                        help="observable types and weights, e.g. Url=3,IPv4-Addr=1")
+    parser.add_argument("--expired", type=float, default=defaults.expired,
+                        help="share of indicators whose valid_until has passed")
+    parser.add_argument("--ctm-latency", type=float, default=defaults.ctm_latency)
+    parser.add_argument("--ctm-error-rate", type=float, default=defaults.ctm_error_rate)
+    parser.add_argument("--ctm-cut-rate", type=float, default=defaults.ctm_cut_rate)
+    parser.add_argument("--no-ctm-gzip", dest="ctm_gzip", action="store_false")
+    parser.add_argument("--post-latency", type=float, default=defaults.post_latency)
+    parser.add_argument("--post-error-rate", type=float, default=defaults.post_error_rate)
+    parser.add_argument("--quota-rps", type=float, default=defaults.quota_rps)
+    parser.add_argument("--retry-after", default=defaults.retry_after)
+    parser.add_argument("--seed", type=int, default=defaults.seed)
+
+
+def config_from_args(args: argparse.Namespace) -> ServerConfig:
+    return ServerConfig(**{name: getattr(args, name)
+                           for name in ServerConfig.__dataclass_fields__})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    add_arguments(parser)
+    config = config_from_args(parser.parse_args())
+    ctm_url, chronicle_url, _ = start(config)
+    print(f"CTM_URL={ctm_url}")
+    print(f"CHRONICLE_INGESTION_URL={chronicle_url}")
+    print(f"stats: {chronicle_url}/stats")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,7 @@
+"""The Cloud Function modules are imported flat, as they are when deployed."""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                "Cloud Function"))
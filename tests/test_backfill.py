@@ -0,0 +1,109 @@
+import json
+import threading
+import time
+from concurrent import futures
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+import backfill
+import transformer
+from checkpoint import Checkpoint, CheckpointStore, NO_MORE_DATA
+from pipeline import FetchError
+
+SHARDS = backfill.split_range("2024-01-01T00:00:00+00:00", "2024-01-04T00:00:00+00:00", 3)
+
+
+def _object(created_at):
+    return {
+        "id": f"indicator--{created_at}",
+        "name": "bad.example.com",
+        "confidence": 80,
+        "pattern": "[domain-name:value = 'bad.example.com']",
+        "pattern_type": "stix",
+        "valid_from": created_at,
+        "valid_until": "2025-01-01T00:00:00Z",
+        "extensions": {transformer.CTM_EXTENSION: {
+            "main_observable_type": "Domain-Name",
+            "created_at": created_at,
+            "updated_at": created_at,
+            "score": 75,
+            "extension_type": "property-extension",
+            "type": "indicator",
+            "detection": True,
+        }},
+    }
+
+
+def _server(failure):
+    """A CTM stand-in serving one page per shard, the last shard fails."""
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_GET(self):  # pylint: disable=invalid-name
+            start = parse_qs(urlparse(self.path).query)["added_after"][0]
+            if start == SHARDS[-1].start:
+                # after the pages of the other shards
+                time.sleep(0.3)
+                if failure == "closed":
+                    self.close_connection = True
+                    return
+                page = {"objects": [{"id": "indicator--1"}], "more": False, "next": ""}
+            else:
+                created = backfill.parse_time(start).isoformat()
+                page = {"objects": [_object(created)] * 3, "more": False, "next": ""}
+            body = json.dumps(page).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):  # pylint: disable=arguments-differ
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class _Store(CheckpointStore):
+
+    def __init__(self):
+        self.saved = []
+
+    def load(self):
+        return Checkpoint()
+
+    def save(self, cp):
+        self.saved.append(cp)
+
+
+class _Uploader:
+    """Acknowledges every batch at once."""
+
+    @staticmethod
+    def submit(batch):
+        future = futures.Future()
+        future.set_result(batch.count)
+        return future
+
+    @staticmethod
+    def wait(inflight):
+        return sum(future.result() for future in inflight)
+
+
+@pytest.mark.parametrize("failure", ["closed", "malformed"])
+def test_failing_shard_raises_fetch_error_after_saving_the_others(failure):
+    server = _server(failure)
+    try:
+        stores = {shard.key: _Store() for shard in SHARDS}
+        config = backfill.FetchConfig(f"http://127.0.0.1:{server.server_port}/objects", {}, "customer",
+                                      1 << 20, max_attempts=1)
+        engine = backfill.Backfill(config, _Uploader(), stores.__getitem__)
+        with pytest.raises(FetchError):
+            engine.run(SHARDS)
+    finally:
+        server.shutdown()
+    assert [stores[shard.key].saved for shard in SHARDS[:-1]] == [[Checkpoint(NO_MORE_DATA)]] * 2
+    assert stores[SHARDS[-1].key].saved == []
@@ -0,0 +1,82 @@
+import gzip
+import json
+
+import pytest
+
+import bulk
+
+OBJECTS = [{"type": "indicator", "id": f"indicator--{i}", "name": "é" * (i % 3)} for i in range(25)]
+
+
+def _write(path, data):
+    opener = gzip.open if str(path).endswith(".gz") else open
+    with opener(path, "wb") as f:
+        f.write(data)
+    return str(path)
+
+
+def _objects(chunks):
+    """The objects of the chunks, decoded as a worker process does."""
+    objects = []
+    for chunk in chunks:
+        if chunk.objects is not None:
+            objects.extend(chunk.objects)
+        elif chunk.lines is not None:
+            objects.extend(bulk._parse_lines(chunk.lines))  # pylint: disable=protected-access
+        else:
+            with open(chunk.path, "rb") as f:
+                data = f.read()[chunk.start:chunk.end]
+            # the files of these tests end with a newline
+            assert data.endswith(b"\n")
+            objects.extend(bulk._parse_lines(data))  # pylint: disable=protected-access
+    return objects
+
+
+@pytest.mark.parametrize("name", ["export.json", "export.json.gz"])
+@pytest.mark.parametrize("document", [
+    {"type": "bundle", "id": "bundle--1", "objects": OBJECTS},
+    {"more": False, "objects": OBJECTS, "next": ""},
+    OBJECTS,
+])
+def test_json_documents_are_cut_in_object_chunks(tmp_path, name, document):
+    path = _write(tmp_path / name, json.dumps(document).encode("utf-8"))
+    chunks = list(bulk.read_chunks(path, chunk_objects=10))
+    assert [len(chunk.objects) for chunk in chunks] == [10, 10, 5]
+    assert _objects(chunks) == OBJECTS
+
+
+def _lines(objects):
+    return b"".join(json.dumps(obj).encode("utf-8") + b"\n" for obj in objects)
+
+
+@pytest.mark.parametrize("chunk_bytes", [1, 100, 1000, 1 << 20])
+def test_json_lines_are_cut_on_line_boundaries(tmp_path, chunk_bytes):
+    path = _write(tmp_path / "export.jsonl", _lines(OBJECTS))
+    chunks = list(bulk.read_chunks(path, chunk_bytes=chunk_bytes))
+    assert all(chunk.objects is None and chunk.lines is None for chunk in chunks)
+    assert [chunk.start for chunk in chunks[1:]] == [chunk.end for chunk in chunks[:-1]]
+    assert _objects(chunks) == OBJECTS
+
+
+@pytest.mark.parametrize("chunk_bytes", [1, 100, 1 << 20])
+def test_gzipped_json_lines_are_read_in_blocks_of_lines(tmp_path, chunk_bytes):
+    path = _write(tmp_path / "export.ndjson.gz", _lines(OBJECTS))
+    chunks = list(bulk.read_chunks(path, chunk_bytes=chunk_bytes))
+    assert all(chunk.lines is not None for chunk in chunks)
+    assert _objects(chunks) == OBJECTS
+
+
+def test_blank_lines_are_skipped_and_bundles_expanded(tmp_path):
+    data = _lines(OBJECTS[:2]) + b"\n  \n" + json.dumps({"objects": OBJECTS[2:5]}).encode("utf-8") + b"\n"
+    path = _write(tmp_path / "export.jsonl", data)
+    assert _objects(bulk.read_chunks(path)) == OBJECTS[:5]
+
+
+def test_format_is_forced_over_the_file_name(tmp_path):
+    path = _write(tmp_path / "export.txt", _lines(OBJECTS))
+    assert bulk.file_format(path) == "json"
+    assert _objects(bulk.read_chunks(path, fmt="jsonl")) == OBJECTS
+
+
+def test_empty_file_has_no_chunks(tmp_path):
+    assert list(bulk.read_chunks(_write(tmp_path / "export.json", b""))) == []
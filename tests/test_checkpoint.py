@@ -0,0 +1,106 @@
+import json
+
+import pytest
+
+import checkpoint
+from checkpoint import NO_MORE_DATA, Checkpoint
+
+
+@pytest.mark.parametrize("cp", [
+    Checkpoint(),
+    Checkpoint("cursor"),
+    Checkpoint(NO_MORE_DATA),
+    Checkpoint("cursor", offset=12),
+    Checkpoint(NO_MORE_DATA, offset=3, added_after="2024-01-01T00:00:00Z"),
+    Checkpoint("cursor", page_size=250),
+    Checkpoint("cursor", offset=7, page_size=250, ranked_at=1700000000.5),
+])
+def test_dumps_loads_round_trip(cp):
+    assert Checkpoint.loads(cp.dumps()) == cp
+
+
+def test_page_boundary_is_saved_as_bare_cursor():
+    assert Checkpoint("cursor").dumps() == "cursor"
+    assert Checkpoint(NO_MORE_DATA).dumps() == NO_MORE_DATA
+
+
+def test_loads_legacy_bare_cursor():
+    assert Checkpoint.loads("eyJvZmZzZXQiOjEwMDB9") == Checkpoint("eyJvZmZzZXQiOjEwMDB9")
+    assert Checkpoint.loads("") == Checkpoint()
+
+
+def test_dumps_with_offset_is_json():
+    assert json.loads(Checkpoint("cursor", offset=5).dumps())["offset"] == 5
+
+
+@pytest.mark.parametrize("make", [
+    lambda tmp_path, key: checkpoint.FileCheckpointStore(str(tmp_path / f"checkpoint.{key}")),
+    lambda tmp_path, key: checkpoint.SQLiteCheckpointStore(str(tmp_path / "checkpoints.db"), key=key),
+])
+def test_local_stores_keep_one_checkpoint_per_key(tmp_path, make):
+    first, second = make(tmp_path, "a"), make(tmp_path, "b")
+    assert first.load() == Checkpoint()
+    first.save(Checkpoint("cursor", offset=3))
+    second.save(Checkpoint(NO_MORE_DATA))
+    assert make(tmp_path, "a").load() == Checkpoint("cursor", offset=3)
+    assert make(tmp_path, "b").load() == Checkpoint(NO_MORE_DATA)
+
+
+class _Recorder(checkpoint.CheckpointStore):
+
+    def __init__(self):
+        self.saved = []
+
+    def load(self):
+        return self.saved[-1] if self.saved else Checkpoint()
+
+    def save(self, cp):
+        self.saved.append(cp)
+
+
+def test_throttled_store_writes_every_pages():
+    store = _Recorder()
+    throttled = checkpoint.ThrottledCheckpointStore(store, pages=3, clock=lambda: 0.0)
+    for page in range(7):
+        throttled.save(Checkpoint(str(page)))
+    assert [cp.next for cp in store.saved] == ["2", "5"]
+    throttled.flush()
+    throttled.flush()
+    assert [cp.next for cp in store.saved] == ["2", "5", "6"]
+
+
+def test_throttled_store_writes_after_seconds():
+    now = [0.0]
+    store = _Recorder()
+    throttled = checkpoint.ThrottledCheckpointStore(store, pages=100, seconds=30,
+                                                    clock=lambda: now[0])
+    throttled.save(Checkpoint("a"))
+    now[0] = 29
+    throttled.save(Checkpoint("b"))
+    assert not store.saved
+    now[0] = 30
+    throttled.save(Checkpoint("c"))
+    assert [cp.next for cp in store.saved] == ["c"]
+
+
+def test_store_from_env_throttles_only_the_secret_backend(monkeypatch, tmp_path):
+    monkeypatch.setenv(checkpoint.ENV_CHECKPOINT_BACKEND, "secret")
+    monkeypatch.setenv(checkpoint.ENV_CHECKPOINT_SAVE_PAGES, "4")
+    store = checkpoint.store_from_env("projects/p/secrets/CTM_NEXT/versions/latest", key="shard")
+    assert isinstance(store, checkpoint.ThrottledCheckpointStore)
+    assert store.pages == 4
+    assert store.store.secret_path == "projects/p/secrets/CTM_NEXT_shard"
+    monkeypatch.setenv(checkpoint.ENV_CHECKPOINT_BACKEND, "file")
+    monkeypatch.setenv(checkpoint.ENV_CHECKPOINT_PATH, str(tmp_path / "checkpoint"))
+    assert isinstance(checkpoint.store_from_env("unused"), checkpoint.FileCheckpointStore)
+
+
+def test_store_from_env_selects_the_backend(monkeypatch, tmp_path):
+    monkeypatch.setenv(checkpoint.ENV_CHECKPOINT_PATH, str(tmp_path / "checkpoint"))
+    monkeypatch.setenv(checkpoint.ENV_CHECKPOINT_BACKEND, "file")
+    assert isinstance(checkpoint.store_from_env("unused"), checkpoint.FileCheckpointStore)
+    monkeypatch.setenv(checkpoint.ENV_CHECKPOINT_BACKEND, "sqlite")
+    assert isinstance(checkpoint.store_from_env("unused"), checkpoint.SQLiteCheckpointStore)
+    monkeypatch.setenv(checkpoint.ENV_CHECKPOINT_BACKEND, "redis")
+    with pytest.raises(ValueError):
+        checkpoint.store_from_env("unused")
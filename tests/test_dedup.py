@@ -0,0 +1,73 @@
+import json
+from types import SimpleNamespace
+
+import pytest
+
+import dedup
+from pipeline import UploadError
+from uploader import BatchUploader
+from utils import pack_entities
+
+
+def _entity(stix_id, updated="2024-01-01T00:00:00Z", end="2024-02-01T00:00:00Z"):
+    return {"metadata": {"product_entity_id": stix_id,
+                         "threat": [{"last_updated_time": updated}],
+                         "interval": {"end_time": end}}}
+
+
+def _ids(entities):
+    return [entity["metadata"]["product_entity_id"] for entity in entities]
+
+
+def test_filter_drops_only_entities_sent_unchanged():
+    index = dedup.DedupIndex(":memory:")
+    index.mark([dedup.entity_key(_entity("a")), dedup.entity_key(_entity("b"))])
+    entities = [
+        _entity("a"),
+        _entity("b", updated="2024-01-02T00:00:00Z"),
+        _entity("c"),
+        _entity("a", end="2024-03-01T00:00:00Z"),
+    ]
+    assert _ids(index.filter(entities)) == ["b", "c", "a"]
+    assert (index.skipped, index.passed) == (1, 3)
+    index.reset_counters()
+    assert (index.skipped, index.passed) == (0, 0)
+
+
+def test_filter_keeps_the_order_across_lookups(monkeypatch):
+    monkeypatch.setattr(dedup, "_LOOKUP_SIZE", 3)
+    index = dedup.DedupIndex(":memory:")
+    index.mark([dedup.entity_key(_entity(str(i))) for i in range(0, 10, 2)])
+    assert _ids(index.filter(_entity(str(i)) for i in range(10))) == ["1", "3", "5", "7", "9"]
+
+
+def test_old_entries_are_evicted(tmp_path):
+    path = str(tmp_path / "dedup.db")
+    dedup.DedupIndex(path).mark([dedup.entity_key(_entity("a"))])
+    assert _ids(dedup.DedupIndex(path).filter([_entity("a")])) == []
+    assert _ids(dedup.DedupIndex(path, max_age=-1).filter([_entity("a")])) == ["a"]
+
+
+class _Session:
+    """Accepts the bodies containing accepted ids, rejects the others with a 400."""
+
+    def __init__(self, accepted):
+        self.accepted = accepted
+
+    def post(self, url, data, headers):
+        ids = _ids(json.loads(data)["entities"])
+        status = 200 if set(ids) <= self.accepted else 400
+        return SimpleNamespace(status_code=status, text="", close=lambda: None)
+
+
+def test_only_acknowledged_batches_are_marked():
+    index = dedup.DedupIndex(":memory:")
+    uploader = BatchUploader(_Session({"a"}), "url", max_attempts=1,
+                             on_sent=lambda batch: index.mark(batch.keys))
+    first, second = pack_entities([_entity("a"), _entity("b")], "customer", 250,
+                                  key=dedup.entity_key)
+    assert uploader.submit(first).result() == 1
+    with pytest.raises(UploadError):
+        uploader.submit(second).result()
+    uploader.close()
+    assert _ids(index.filter([_entity("a"), _entity("b")])) == ["b"]
@@ -0,0 +1,160 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import pytest
+from google.api_core import exceptions
+
+import lease
+import utils
+from checkpoint import Checkpoint, CheckpointStore
+
+SECRET = "projects/p/secrets/CTM_NEXT"
+
+
+class _Clock:
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class _SecretClient:
+    """Secret annotations updated with an etag, like Secret Manager.
+
+    before_update, when set, runs once before the next update, e.g. to let
+    another invocation update the secret first.
+    """
+
+    def __init__(self):
+        self.secrets = {}
+        self.lock = threading.Lock()
+        self.before_update = None
+
+    def create_secret(self, request):
+        name = f"{request['parent']}/secrets/{request['secret_id']}"
+        with self.lock:
+            if name in self.secrets:
+                raise exceptions.AlreadyExists(name)
+            self.secrets[name] = ({}, 0)
+        return SimpleNamespace(name=name)
+
+    def get_secret(self, request):
+        with self.lock:
+            if request["name"] not in self.secrets:
+                raise exceptions.NotFound(request["name"])
+            annotations, etag = self.secrets[request["name"]]
+        return SimpleNamespace(name=request["name"], annotations=dict(annotations), etag=str(etag))
+
+    def update_secret(self, request):
+        hook, self.before_update = self.before_update, None
+        if hook is not None:
+            hook()
+        secret = request["secret"]
+        with self.lock:
+            _, etag = self.secrets[secret["name"]]
+            if secret["etag"] != str(etag):
+                raise exceptions.Aborted("etag mismatch")
+            self.secrets[secret["name"]] = (dict(secret["annotations"]), etag + 1)
+
+
+@pytest.fixture
+def clock():
+    return _Clock()
+
+
+@pytest.fixture
+def secret_client(monkeypatch):
+    client = _SecretClient()
+    monkeypatch.setattr(utils, "_client", client)
+    return client
+
+
+@pytest.fixture(params=["secret", "file", "sqlite"])
+def make_store(request, tmp_path, clock):
+    if request.param == "secret":
+        request.getfixturevalue("secret_client")
+        return lambda: lease.SecretManagerLeaseStore(SECRET + "/versions/latest", clock=clock)
+    if request.param == "file":
+        return lambda: lease.FileLeaseStore(str(tmp_path / "checkpoint"), clock=clock)
+    return lambda: lease.SQLiteLeaseStore(str(tmp_path / "leases.db"), clock=clock)
+
+
+def test_held_lease_is_refused_until_released(make_store):
+    first, second = make_store(), make_store()
+    assert first.acquire("", "a", 60) is None
+    assert second.acquire("", "b", 60).owner == "a"
+    # the owner renews its own lease
+    assert first.acquire("", "a", 60) is None
+    second.release("", "b")
+    assert second.acquire("", "b", 60).owner == "a"
+    first.release("", "a")
+    assert second.acquire("", "b", 60) is None
+
+
+def test_expired_lease_is_taken_over(make_store, clock):
+    first, second = make_store(), make_store()
+    assert first.acquire("", "a", 60) is None
+    clock.now += 59
+    assert second.acquire("", "b", 60).owner == "a"
+    clock.now += 1
+    assert second.acquire("", "b", 60) is None
+    assert first.acquire("", "a", 60).owner == "b"
+
+
+def test_leases_of_different_keys_are_independent(make_store):
+    store = make_store()
+    assert store.acquire("bench0", "a", 60) is None
+    assert store.acquire("bench1", "b", 60) is None
+    assert store.acquire("bench0", "b", 60).owner == "a"
+
+
+def test_one_of_concurrent_claims_wins(make_store):
+    stores = [make_store() for _ in range(8)]
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        holders = list(executor.map(lambda i: stores[i].acquire("", f"owner{i}", 60), range(8)))
+    assert sum(holder is None for holder in holders) == 1
+
+
+def test_secret_claim_losing_the_etag_race_is_refused(secret_client, clock):
+    store = lease.SecretManagerLeaseStore(SECRET + "/versions/latest", clock=clock)
+    rival = lease.SecretManagerLeaseStore(SECRET + "/versions/latest", clock=clock)
+    store.acquire("", "setup", 1)
+    clock.now += 1
+    # the rival updates the secret between the read and the write of "a"
+    secret_client.before_update = lambda: rival.acquire("", "b", 60)
+    assert store.acquire("", "a", 60).owner == "b"
+
+
+def test_lease_is_lost_once_taken_over(tmp_path, clock):
+    store = lease.FileLeaseStore(str(tmp_path / "checkpoint"), clock=clock)
+    held = lease.Lease(store, ttl=60, owner="a", clock=clock)
+    assert held.acquire()
+    assert not held.lost
+    clock.now += 61
+    assert held.lost
+    assert store.acquire("", "b", 60) is None
+    assert not held.renew()
+    held.release()
+    # releasing a lost lease leaves the new owner's alone
+    assert store.acquire("", "c", 60).owner == "b"
+
+
+def test_leased_store_stops_saving_once_lost(tmp_path, clock):
+    saved = []
+    class Store(CheckpointStore):
+        def load(self):
+            return Checkpoint()
+        def save(self, cp):
+            saved.append(cp)
+    held = lease.Lease(lease.FileLeaseStore(str(tmp_path / "checkpoint"), clock=clock),
+                       ttl=60, owner="a", clock=clock)
+    held.acquire()
+    store = lease.LeasedCheckpointStore(Store(), held)
+    store.save(Checkpoint("a"))
+    clock.now += 61
+    store.save(Checkpoint("b"))
+    assert saved == [Checkpoint("a")]
+    held.release()
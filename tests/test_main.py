@@ -0,0 +1,155 @@
+import importlib
+import json
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+import pytest
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+import transformer
+import utils
+
+SECRET_PREFIX = "projects/test/secrets/"
+
+
+class _SecretClient:
+    """Serves the startup secrets of the function."""
+
+    def __init__(self, values):
+        self.values = values
+
+    def access_secret_version(self, name=None, request=None):
+        name = name or request["name"]
+        return SimpleNamespace(name=name, payload=SimpleNamespace(
+            data=self.values[name.split("/")[3]].encode("utf-8")))
+
+
+def _service_account():
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    return json.dumps({
+        "type": "service_account",
+        "project_id": "test",
+        "private_key_id": "test",
+        "private_key": key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                         serialization.NoEncryption()).decode("ascii"),
+        "client_email": "test@test.iam.gserviceaccount.com",
+        "client_id": "0",
+        "token_uri": "http://127.0.0.1:1/token",
+    })
+
+
+def _object(i):
+    return {
+        "id": f"indicator--{i}",
+        "name": f"bad{i}.example.com",
+        "confidence": 80,
+        "pattern": f"[domain-name:value = 'bad{i}.example.com']",
+        "pattern_type": "stix",
+        "valid_from": "2024-01-01T00:00:00Z",
+        "valid_until": "2099-01-01T00:00:00Z",
+        "extensions": {transformer.CTM_EXTENSION: {
+            "main_observable_type": "Domain-Name",
+            "created_at": "2024-01-01T00:00:00Z",
+            "updated_at": "2024-01-01T00:00:00Z",
+            "score": 75,
+            "extension_type": "property-extension",
+            "type": "indicator",
+            "detection": True,
+        }},
+    }
+
+
+@pytest.fixture
+def ctm_url():
+    """URL of a CTM stand-in serving a single page of three indicators."""
+    body = json.dumps({"objects": [_object(i) for i in range(3)], "more": False, "next": ""}).encode("utf-8")
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_GET(self):  # pylint: disable=invalid-name
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):  # pylint: disable=arguments-differ
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}/objects"
+    server.shutdown()
+
+
+@pytest.fixture
+def function(monkeypatch, tmp_path):
+    """Imports main with the settings of the test, returns it and the summaries."""
+    def load(**env):
+        settings = {
+            "CHRONICLE_CUSTOMER_ID": SECRET_PREFIX + "customer/versions/latest",
+            "CHRONICLE_SERVICE_ACCOUNT": SECRET_PREFIX + "service_account/versions/latest",
+            "CTM_COLLECTION_ID": SECRET_PREFIX + "collection/versions/latest",
+            "CTM_KEY_ID": SECRET_PREFIX + "ctm_key/versions/latest",
+            "CTM_NEXT": SECRET_PREFIX + "CTM_NEXT/versions/latest",
+            "CHRONICLE_INGESTION_URL": "http://127.0.0.1:1",
+            "CHECKPOINT_BACKEND": "file",
+            "CHECKPOINT_PATH": str(tmp_path / "checkpoint"),
+            "METRICS_BACKEND": "file",
+            "METRICS_PATH": str(tmp_path / "metrics.jsonl"),
+            "RETRY_BASE_DELAY": "0",
+            "TOKEN_REFRESH_MARGIN": "0",
+        }
+        settings.update(env)
+        for name, value in settings.items():
+            monkeypatch.setenv(name, value)
+        monkeypatch.setattr(utils, "_client", _SecretClient({
+            "customer": "test-customer",
+            "service_account": _service_account(),
+            "collection": "test",
+            "ctm_key": "test-key",
+        }))
+        monkeypatch.setattr(utils, "_secret_cache", {})
+        # main reads its settings when imported, every test imports it again
+        monkeypatch.delitem(sys.modules, "main", raising=False)
+        module = importlib.import_module("main")
+        monkeypatch.delitem(sys.modules, "main")
+        def summaries():
+            with open(tmp_path / "metrics.jsonl", encoding="utf-8") as f:
+                return [json.loads(line) for line in f]
+        return module, summaries
+    return load
+
+
+def test_unreachable_ctm_is_answered_as_a_bad_gateway(function):
+    main, summaries = function(CTM_URL="http://127.0.0.1:1/objects", CTM_MAX_ATTEMPTS="2")
+    text, status = main.main(None)
+    assert status == 502
+    assert text
+    summary, = summaries()
+    assert summary["status"] == "GET error 0"
+    assert summary["get"]["requests"] == 2
+
+
+def test_failed_lease_release_is_counted(function, monkeypatch):
+    main, summaries = function(CTM_URL="http://127.0.0.1:1/objects", CTM_MAX_ATTEMPTS="1")
+    def release(key, owner):
+        raise OSError("lease store unavailable")
+    monkeypatch.setattr(main.instance.get().lease_store, "release", release)
+    assert main.main(None)[1] == 502
+    summary, = summaries()
+    assert summary["counters"]["lease.errors"] == 1
+
+
+def test_spool_counters_are_reported_per_invocation(function, ctm_url, tmp_path):
+    # Chronicle is unreachable, the batch of the page is spooled
+    main, summaries = function(CTM_URL=ctm_url, SPOOL_PATH=str(tmp_path / "spool"), UPLOAD_MAX_ATTEMPTS="1",
+                               BATCH_MAX_AGE="0", LEASE_BACKEND="none")
+    assert main.main(None) == "SPOOLED"
+    # the next invocation fails to drain them and spools nothing
+    assert main.main(None)[1] == 502
+    first, second = summaries()
+    assert first["spool"]["appended"] == 1
+    assert second["spool"]["appended"] == 0
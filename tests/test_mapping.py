@@ -0,0 +1,104 @@
+import re
+
+import pytest
+
+import mapping
+import transformer
+
+_IPV4 = re.compile(r"(\d+\.\d+\.\d+\.\d+)")
+
+# The observable handlers of transformer.py before the mapping spec.
+HAND_WRITTEN = {
+    "StixFile": lambda obj: ("FILE", "file.sha256", obj["name"], ()),
+    "Url": lambda obj: ("URL", "url", obj["name"], ()),
+    "Domain-Name": lambda obj: ("DOMAIN_NAME", "hostname", obj["name"], ()),
+    "IPv4-Addr": lambda obj: ("IP_ADDRESS", "ip", _IPV4.search(obj["name"]).group(1), ()),
+    "Hostname": lambda obj: ("DOMAIN_NAME", "hostname", obj["name"], ()),
+    "Email-Addr": lambda obj: ("USER", "user.emailAddresses[]", obj["name"], ()),
+}
+
+NAMES = {
+    "StixFile": "a" * 64,
+    "Url": "http://bad.example.com/login",
+    "Domain-Name": "bad.example.com",
+    "IPv4-Addr": "[ipv4-addr:value = '10.0.0.1']",
+    "Hostname": "host.example.net",
+    "Email-Addr": "phish@example.org",
+}
+
+
+def _object(observable_type, name, **ctm):
+    return {
+        "id": "indicator--1",
+        "name": name,
+        "confidence": 80,
+        "pattern": "[x:value = '1']",
+        "pattern_type": "stix",
+        "valid_from": "2024-01-01T00:00:00Z",
+        "valid_until": "2024-07-01T00:00:00Z",
+        "extensions": {mapping.CTM_EXTENSION: {
+            "main_observable_type": observable_type,
+            "created_at": "2024-01-01T00:00:00Z",
+            "updated_at": "2024-01-02T00:00:00Z",
+            "score": 75,
+            "extension_type": "property-extension",
+            "type": "indicator",
+            "detection": True,
+            **ctm,
+        }},
+    }
+
+
+@pytest.fixture(scope="module")
+def compiled():
+    return mapping.compile_spec(mapping.load_spec())
+
+
+@pytest.mark.parametrize("observable_type", sorted(HAND_WRITTEN))
+def test_default_spec_matches_the_hand_written_handlers(compiled, observable_type):
+    obj = _object(observable_type, NAMES[observable_type])
+    assert compiled[observable_type](obj) == HAND_WRITTEN[observable_type](obj)
+
+
+@pytest.mark.parametrize("observable_type, name, expected", [
+    ("StixFile", "d41d8cd98f00b204e9800998ecf8427e", {"file": {"md5": "d41d8cd98f00b204e9800998ecf8427e"}}),
+    ("StixFile", "da39a3ee5e6b4b0d3255bfef95601890afd80709",
+     {"file": {"sha1": "da39a3ee5e6b4b0d3255bfef95601890afd80709"}}),
+    ("StixFile", "z" * 32, {"file": {"sha256": "z" * 32}}),
+    ("IPv6-Addr", "[ipv6-addr:value = '2001:db8::1']", {"ip": "2001:db8::1"}),
+])
+def test_indicators_added_by_the_spec(observable_type, name, expected):
+    entity = transformer.transform_object(_object(observable_type, name), "2024-01-03T00:00:00Z")
+    assert entity.to_dict()["entity"] == expected
+
+
+def test_value_not_matching_extract_is_skipped(compiled):
+    assert compiled["IPv4-Addr"](_object("IPv4-Addr", "no address")) is None
+    assert transformer.transform_object(_object("IPv4-Addr", "no address"), "") is None
+
+
+def test_additional_attributes_are_read_from_the_object_and_extension():
+    handlers = mapping.compile_spec({
+        "observables": {"Url": {"entity_type": "URL", "field": "url",
+                                "additional": {"ctm_brand": "ctm.brand"}}},
+        "additional": {"stix_id": "id"},
+    })
+    _, _, value, extra = handlers["Url"](_object("Url", "http://x", brand="acme"))
+    assert value == "http://x"
+    assert dict(extra) == {"stix_id": "indicator--1", "ctm_brand": "acme"}
+    # attributes missing from the object are left out
+    assert dict(handlers["Url"](_object("Url", "http://x"))[3]) == {"stix_id": "indicator--1"}
+
+
+@pytest.mark.parametrize("spec", [
+    {"observables": {"Url": {"field": "url"}}},
+    {"observables": {"Url": {"entity_type": "URL", "field": "url", "colour": "red"}}},
+    {"observables": {"Url": [{"entity_type": "URL", "field": "url"},
+                             {"entity_type": "URL", "field": "url"}]}},
+    {"observables": {"Url": {"entity_type": "URL", "field": "url", "extract": "x"}}},
+    {"observables": {"Url": {"entity_type": "URL", "field": "url"}}, "additional": {"score": "ctm.score"}},
+    {"mappings": {}},
+])
+def test_invalid_specs_are_refused(spec):
+    with pytest.raises(ValueError):
+        mapping.compile_spec(spec)
@@ -0,0 +1,66 @@
+import pytest
+
+from paging import PageSizer
+
+
+def _sizer(**kwargs):
+    return PageSizer(**dict(dict(size=100, minimum=10, maximum=1000, max_bytes=1 << 20, max_seconds=10),
+                            **kwargs))
+
+
+def _observe(sizer, items=None, size_bytes=None, seconds=0.1, more=True, backlog=0.0):
+    items = sizer.size if items is None else items
+    return sizer.observe(sizer.size, items, 100 * items if size_bytes is None else size_bytes,
+                         seconds, more, backlog)
+
+
+def test_size_doubles_while_the_next_stage_waits_up_to_the_maximum():
+    sizer = _sizer()
+    assert [_observe(sizer) for _ in range(5)] == [200, 400, 800, 1000, 1000]
+    assert sizer.adjustments == 4
+
+
+def test_size_holds_while_pages_queue_up():
+    sizer = _sizer()
+    assert _observe(sizer, backlog=0.5) == 100
+    assert _observe(sizer, backlog=1.0) == 100
+    assert sizer.adjustments == 0
+
+
+def test_page_over_the_byte_bound_shrinks_the_next_ones_in_proportion():
+    sizer = _sizer(size=400, max_bytes=10000)
+    assert _observe(sizer, size_bytes=40000) == 100
+
+
+def test_slow_page_shrinks_the_next_ones_in_proportion():
+    sizer = _sizer(size=400, max_seconds=2)
+    assert _observe(sizer, seconds=8) == 100
+
+
+def test_growth_is_bounded_by_the_bytes_per_indicator():
+    sizer = _sizer(size=100, max_bytes=30000)
+    # 100 bytes per indicator, 300 fit in max_bytes
+    assert _observe(sizer) == 200
+    assert _observe(sizer) == 300
+    assert _observe(sizer) == 300
+
+
+def test_short_page_caps_the_size():
+    sizer = _sizer(size=400)
+    assert _observe(sizer, items=250) == 250
+    assert sizer.cap == 250
+    assert _observe(sizer) == 250
+
+
+def test_last_page_of_the_feed_changes_nothing():
+    sizer = _sizer(size=400)
+    assert _observe(sizer, items=3, more=False) == 400
+    assert sizer.cap is None and sizer.adjustments == 0
+
+
+@pytest.mark.parametrize("size, expected", [(1, 10), (500, 500), (10 ** 6, 1000)])
+def test_size_stays_within_the_bounds(size, expected):
+    assert _sizer(size=size).size == expected
+    sizer = _sizer(size=size)
+    _observe(sizer, size_bytes=10 ** 9)
+    assert sizer.size == 10
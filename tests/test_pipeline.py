@@ -0,0 +1,136 @@
+import json
+from concurrent import futures
+
+import pytest
+
+import pipeline
+import streaming
+from checkpoint import NO_MORE_DATA, Checkpoint
+from utils import pack_entities
+
+# three pages of four objects, the cursor of a page is its first object
+PAGES = {cursor: list(range(int(cursor or 0), int(cursor or 0) + 4)) for cursor in ("", "4", "8")}
+
+
+def _page(cursor):
+    objects = PAGES[cursor]
+    more = objects[-1] < 11
+    return {"objects": objects, "more": more, "next": str(objects[-1] + 1) if more else ""}
+
+
+def _stream(cursor):
+    return streaming.PageStream([json.dumps(_page(cursor)).encode("utf-8")])
+
+
+def _transform(objects, skip):
+    # one entity per batch, so that a run can stop between any two entities
+    for obj in list(objects)[skip:]:
+        yield from pack_entities([{"i": obj}], "customer", 1 << 20)
+
+
+class _Chronicle:
+    """Acknowledges the first accept entities, then answers 429."""
+
+    concurrency = 2
+
+    def __init__(self, accept=None):
+        self.accept = accept
+        self.sent = []
+        self.requests = []
+
+    def submit(self, batch):
+        future = futures.Future()
+        if self.accept is not None and len(self.sent) >= self.accept:
+            future.set_exception(pipeline.UploadError("quota", 429))
+            return future
+        self.sent.extend(entity["i"] for entity in json.loads(batch.body)["entities"])
+        self.requests.append(batch.count)
+        future.set_result(batch.count)
+        return future
+
+    @staticmethod
+    def wait(inflight):
+        for future in inflight:
+            if future.exception() is not None:
+                raise future.exception()
+
+
+def _run(start, chronicle, stream=False, should_stop=lambda: False, accumulator=None, transform=_transform):
+    checkpoints = []
+    engine = pipeline.Pipeline(_stream if stream else _page, transform, chronicle, stream=stream,
+                               accumulator=accumulator or pipeline.BatchAccumulator(max_entities=1))
+    try:
+        status = engine.run(start, checkpoints.append, should_stop)
+    except pipeline.UploadError:
+        status = "error"
+    return status, checkpoints
+
+
+@pytest.mark.parametrize("stream", [False, True])
+def test_pages_are_sent_in_order(stream):
+    chronicle = _Chronicle()
+    status, checkpoints = _run(Checkpoint(), chronicle, stream)
+    assert status == "ok"
+    assert chronicle.sent == list(range(12))
+    assert checkpoints[-1] == Checkpoint(NO_MORE_DATA)
+
+
+@pytest.mark.parametrize("stream", [False, True])
+def test_resume_at_offset_skips_the_acknowledged_entities(stream):
+    chronicle = _Chronicle()
+    status, checkpoints = _run(Checkpoint("4", offset=3), chronicle, stream)
+    assert status == "ok"
+    assert chronicle.sent == [7, 8, 9, 10, 11]
+    assert checkpoints[-1] == Checkpoint(NO_MORE_DATA)
+
+
+@pytest.mark.parametrize("stream", [False, True])
+@pytest.mark.parametrize("accept", [1, 5, 6, 9])
+def test_run_stopped_mid_page_resumes_without_gaps_or_duplicates(stream, accept):
+    first = _Chronicle(accept=accept)
+    status, checkpoints = _run(Checkpoint(), first, stream)
+    assert status == "error"
+    assert first.sent == list(range(accept))
+    second = _Chronicle()
+    status, _ = _run(checkpoints[-1], second, stream)
+    assert status == "ok"
+    assert first.sent + second.sent == list(range(12))
+
+
+def _transform_with_oversize(objects, skip):
+    # one entity per batch, the one of object 5 does not fit in a request
+    entities = [{"i": obj, "pad": "x" * 100 if obj == 5 else ""} for obj in list(objects)[skip:]]
+    return pack_entities(entities, "customer", 80)
+
+
+@pytest.mark.parametrize("stream", [False, True])
+@pytest.mark.parametrize("accept", [4, 5, 6])
+def test_oversize_entities_are_counted_in_the_offset(stream, accept):
+    first = _Chronicle(accept=accept)
+    _, checkpoints = _run(Checkpoint(), first, stream, transform=_transform_with_oversize)
+    assert first.sent == [i for i in range(12) if i != 5][:accept]
+    second = _Chronicle()
+    status, _ = _run(checkpoints[-1], second, stream, transform=_transform_with_oversize)
+    assert status == "ok"
+    assert first.sent + second.sent == [i for i in range(12) if i != 5]
+
+
+def test_run_stopped_between_pages_resumes_from_the_last_checkpoint():
+    first = _Chronicle()
+    status, checkpoints = _run(Checkpoint(), first, should_stop=lambda: True)
+    assert status == "TIMEOUT"
+    second = _Chronicle()
+    status, _ = _run(checkpoints[-1], second)
+    assert status == "ok"
+    assert first.sent + second.sent == list(range(12))
+
+
+@pytest.mark.parametrize("stream", [False, True])
+def test_batches_of_consecutive_pages_are_joined(stream):
+    chronicle = _Chronicle()
+    accumulator = pipeline.BatchAccumulator(max_entities=5, max_age=60)
+    status, checkpoints = _run(Checkpoint(), chronicle, stream, accumulator=accumulator)
+    assert status == "ok"
+    assert chronicle.requests == [5, 5, 2]
+    assert chronicle.sent == list(range(12))
+    assert checkpoints[-1] == Checkpoint(NO_MORE_DATA)
@@ -0,0 +1,75 @@
+from types import SimpleNamespace
+
+import pytest
+
+import priority
+
+DAY = 86400
+# 2024-01-01T00:00:00Z
+NOW = 1704067200
+
+
+def _entity(name, score, confidence=80, end_time="2024-07-01T00:00:00Z"):
+    return SimpleNamespace(name=name, score=score, confidence_details=str(confidence), end_time=end_time)
+
+
+def _names(entities):
+    return [entity.name for entity in entities]
+
+
+PAGE = [
+    _entity("low", 10),
+    _entity("expired", 99, end_time="2023-12-31T00:00:00Z"),
+    _entity("high", 90),
+    _entity("high-less-confident", 90, confidence=50),
+    _entity("high-expires-soon", 90, end_time="2024-01-02T00:00:00Z"),
+    _entity("high-never-expires", 90, end_time=None),
+    _entity("no-score", "n/a"),
+    _entity("mid", 50),
+]
+
+
+def test_entities_are_ranked_most_valuable_first_and_expired_dropped():
+    window = priority.PriorityWindow(clock=lambda: NOW)
+    ranked = _names(window.rank(PAGE, 0, window.reference))
+    assert ranked == ["high-never-expires", "high", "high-expires-soon", "high-less-confident",
+                      "mid", "low", "no-score"]
+    assert window.dropped == 1
+
+
+def test_ties_keep_the_feed_order():
+    window = priority.PriorityWindow(clock=lambda: NOW)
+    page = [_entity(str(i), 50) for i in range(5)]
+    assert _names(window.rank(page, 0, NOW)) == ["0", "1", "2", "3", "4"]
+
+
+def test_reference_zero_keeps_the_feed_order():
+    window = priority.PriorityWindow(clock=lambda: NOW)
+    assert _names(window.rank(PAGE, 2, 0)) == _names(PAGE[2:])
+    assert window.dropped == 0
+
+
+@pytest.mark.parametrize("skip", range(8))
+def test_resumed_page_sends_the_rest_of_its_ranking(skip):
+    ranked = _names(priority.PriorityWindow().rank(PAGE, 0, NOW))
+    # the next run starts a day later, the page is ranked at the saved ranked_at
+    later = priority.PriorityWindow(clock=lambda: NOW + DAY)
+    assert _names(later.rank(PAGE, skip, NOW)) == ranked[skip:]
+
+
+def test_ranking_at_a_later_time_would_reorder_the_page():
+    ranked = _names(priority.PriorityWindow().rank(PAGE, 0, NOW))
+    assert _names(priority.PriorityWindow().rank(PAGE, 0, NOW + DAY)) != ranked
+
+
+def test_defer_counts_the_entities_left_in_the_cut_page():
+    window = priority.PriorityWindow(clock=lambda: NOW)
+    list(window.rank(PAGE, 0, NOW))
+    list(window.rank(PAGE, 3, NOW))
+    assert window.defer(0, 5) == 2
+    # nothing of the second page was acknowledged in this run
+    assert window.defer(1, 3) == 0
+    # 3 of the 4 live entities after the skip were
+    assert window.defer(1, 6) == 1
+    assert window.defer(2, 1) == 0
+    assert window.deferred == 3
@@ -0,0 +1,126 @@
+import email.utils
+import time
+from types import SimpleNamespace
+
+import pytest
+import requests
+
+import retry
+
+
+def _response(status, **headers):
+    return SimpleNamespace(status_code=status, headers=headers, text="", close=lambda: None)
+
+
+def _policy(**kwargs):
+    slept = []
+    return retry.RetryPolicy(sleep=slept.append, **kwargs), slept
+
+
+def _send(*outcomes):
+    outcomes = list(outcomes)
+    def send():
+        outcome = outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+    return send
+
+
+def test_retryable_statuses_are_retried_until_success():
+    policy, slept = _policy(max_attempts=5, base_delay=1, max_delay=60)
+    response = policy.call(_send(_response(503), _response(429), _response(200)))
+    assert response.status_code == 200
+    assert len(slept) == 2
+    assert (policy.stats.requests, policy.stats.retries, policy.stats.throttled) == (3, 2, 1)
+
+
+def test_other_statuses_are_returned_at_once():
+    policy, slept = _policy()
+    assert policy.call(_send(_response(400))).status_code == 400
+    assert not slept
+
+
+def test_last_response_is_returned_after_max_attempts():
+    policy, slept = _policy(max_attempts=3)
+    response = policy.call(_send(_response(503), _response(502), _response(500)))
+    assert response.status_code == 500
+    assert len(slept) == 2
+    assert policy.stats.gave_up == 1
+
+
+def test_connection_errors_are_retried_then_raised():
+    policy, _ = _policy(max_attempts=2)
+    assert policy.call(_send(requests.ConnectionError(), _response(200))).status_code == 200
+    with pytest.raises(requests.Timeout):
+        policy.call(_send(requests.ConnectionError(), requests.Timeout()))
+    assert policy.stats.gave_up == 1
+
+
+def test_backoff_is_jittered_and_capped():
+    policy, _ = _policy(base_delay=1, max_delay=5)
+    for attempt in range(8):
+        for _ in range(20):
+            assert 0 <= policy.delay(attempt) <= min(5, 2 ** attempt)
+
+
+@pytest.mark.parametrize("value, expected", [
+    ("7", 7),
+    ("0.5", 0.5),
+    ("-3", 0),
+    ("soon", None),
+])
+def test_retry_after_seconds(value, expected):
+    assert retry.retry_after(_response(429, **{"Retry-After": value})) == expected
+
+
+def test_retry_after_date():
+    date = email.utils.formatdate(time.time() + 30, usegmt=True)
+    assert 25 <= retry.retry_after(_response(503, **{"Retry-After": date})) <= 30
+
+
+def test_retry_after_is_waited_within_max_delay():
+    policy, slept = _policy(max_delay=10)
+    policy.call(_send(_response(429, **{"Retry-After": "4"}), _response(429, **{"Retry-After": "120"}),
+                      _response(200)))
+    assert slept == [4, 10]
+
+
+def test_limiter_grows_by_one_per_round_and_halves_on_throttle():
+    limiter = retry.AdaptiveLimiter(4, maximum=16)
+    for _ in range(5):
+        limiter.on_success()
+    assert int(limiter.limit) == 5
+    before = limiter.limit
+    limiter.on_throttle(limiter.acquire())
+    limiter.release()
+    assert limiter.limit == before / 2
+    assert limiter.decreases == 1
+
+
+def test_limiter_halves_once_per_burst_of_throttles():
+    limiter = retry.AdaptiveLimiter(8)
+    tokens = [limiter.acquire() for _ in range(4)]
+    for token in tokens:
+        limiter.on_throttle(token)
+        limiter.release()
+    assert limiter.limit == 4 and limiter.decreases == 1
+
+
+def test_limiter_stays_within_its_bounds():
+    limiter = retry.AdaptiveLimiter(2, minimum=1, maximum=3)
+    for _ in range(50):
+        limiter.on_success()
+    assert limiter.limit == 3
+    for _ in range(5):
+        limiter.on_throttle(limiter.acquire())
+        limiter.release()
+    assert limiter.limit == 1
+
+
+def test_retried_responses_are_closed():
+    closed = []
+    first = SimpleNamespace(status_code=503, headers={}, text="", close=lambda: closed.append(503))
+    policy, _ = _policy(max_attempts=2)
+    assert policy.call(_send(first, _response(200))).status_code == 200
+    assert closed == [503]
@@ -0,0 +1,147 @@
+import json
+import os
+from concurrent import futures
+
+import pytest
+
+import spool
+from pipeline import UploadError
+from utils import Batch, pack_entities
+
+
+def _batches(count):
+    return [next(pack_entities([{"i": i}], "customer", 1 << 20)) for i in range(count)]
+
+
+class _Chronicle:
+    """Acknowledges the batches, failing the ones listed in reject."""
+
+    def __init__(self, reject=(), status=503):
+        self.reject = set(reject)
+        self.status = status
+        self.sent = []
+
+    def submit(self, batch):
+        future = futures.Future()
+        entity = json.loads(batch.body)["entities"][0]["i"]
+        if entity in self.reject:
+            future.set_exception(UploadError("rejected", self.status))
+        else:
+            self.sent.append(entity)
+            future.set_result(batch.count)
+        return future
+
+    @staticmethod
+    def wait(inflight):
+        for future in inflight:
+            if future.exception() is not None:
+                raise future.exception()
+
+
+def _spool(path, count, **kwargs):
+    spooled = spool.Spool(str(path), **kwargs)
+    for batch in _batches(count):
+        spooled.append(batch)
+    spooled.close()
+    return spooled
+
+
+def test_drain_sends_in_order_and_deletes_segments(tmp_path):
+    spooled = _spool(tmp_path, 5, segment_bytes=1)
+    assert len(spooled.segments()) == 5
+    chronicle = _Chronicle()
+    assert spooled.drain(chronicle.submit, chronicle.wait) == (5, 5)
+    assert chronicle.sent == [0, 1, 2, 3, 4]
+    assert spooled.segments() == []
+
+
+def test_partial_ack_is_replayed_from_the_failed_batch(tmp_path):
+    spooled = _spool(tmp_path, 5, max_attempts=5)
+    failing = _Chronicle(reject={2})
+    with pytest.raises(UploadError):
+        spooled.drain(failing.submit, failing.wait, window=1)
+    assert failing.sent == [0, 1]
+    chronicle = _Chronicle()
+    assert spooled.drain(chronicle.submit, chronicle.wait) == (3, 3)
+    assert chronicle.sent == [2, 3, 4]
+    assert spooled.segments() == []
+
+
+def test_ack_file_of_earlier_versions_is_read(tmp_path):
+    spooled = _spool(tmp_path, 3)
+    with open(spooled.segments()[0] + ".ack", "w", encoding="utf-8") as f:
+        f.write("2")
+    chronicle = _Chronicle()
+    spooled.drain(chronicle.submit, chronicle.wait)
+    assert chronicle.sent == [2]
+
+
+def test_corrupted_record_ends_its_segment(tmp_path):
+    spooled = _spool(tmp_path, 3)
+    segment = spooled.segments()[0]
+    records = list(spool.Spool._records(segment))  # pylint: disable=protected-access
+    # flip a byte of the body of the second record
+    position = len(records[0].body) + len(json.dumps(records[0].keys)) + 2 * spool._HEADER.size + 5  # pylint: disable=protected-access
+    with open(segment, "r+b") as f:
+        f.seek(position)
+        byte = f.read(1)
+        f.seek(position)
+        f.write(bytes([byte[0] ^ 0xFF]))
+    chronicle = _Chronicle()
+    assert spooled.drain(chronicle.submit, chronicle.wait) == (1, 1)
+    assert chronicle.sent == [0]
+
+
+def test_torn_record_ends_its_segment(tmp_path):
+    spooled = _spool(tmp_path, 3)
+    segment = spooled.segments()[0]
+    with open(segment, "r+b") as f:
+        f.truncate(os.path.getsize(segment) - 3)
+    chronicle = _Chronicle()
+    assert spooled.drain(chronicle.submit, chronicle.wait) == (2, 2)
+    assert chronicle.sent == [0, 1]
+
+
+def test_batch_failing_max_attempts_drains_is_quarantined(tmp_path):
+    spooled = _spool(tmp_path, 4, max_attempts=2)
+    with pytest.raises(UploadError):
+        spooled.drain(*_methods(_Chronicle(reject={1})), window=1)
+    chronicle = _Chronicle(reject={1})
+    assert spooled.drain(chronicle.submit, chronicle.wait, window=1) == (2, 2)
+    assert chronicle.sent == [2, 3]
+    assert spooled.quarantined == 1
+    assert spooled.segments() == []
+    quarantine = os.path.join(str(tmp_path), spool.QUARANTINE)
+    assert [json.loads(batch.body)["entities"][0]["i"]
+            for batch in spool.Spool._records(quarantine)] == [1]  # pylint: disable=protected-access
+
+
+def test_rejected_batch_is_quarantined_at_once(tmp_path):
+    spooled = _spool(tmp_path, 3)
+    chronicle = _Chronicle(reject={0}, status=400)
+    assert spooled.drain(chronicle.submit, chronicle.wait, window=1) == (2, 2)
+    assert chronicle.sent == [1, 2]
+    assert spooled.quarantined == 1
+
+
+def test_segment_appended_to_is_not_drained(tmp_path):
+    appender = spool.Spool(str(tmp_path))
+    appender.append(Batch(*_batches(1)[0][:2]))
+    chronicle = _Chronicle()
+    assert spool.Spool(str(tmp_path)).drain(chronicle.submit, chronicle.wait) == (0, 0)
+    appender.close()
+    assert spool.Spool(str(tmp_path)).drain(chronicle.submit, chronicle.wait) == (1, 1)
+
+
+def _methods(chronicle):
+    return chronicle.submit, chronicle.wait
+
+
+def test_oldest_segments_are_evicted_over_max_bytes(tmp_path):
+    size = len(_batches(1)[0].body)
+    # every record is a header, the body and an empty list of keys
+    spooled = _spool(tmp_path, 6, max_bytes=4 * (spool._HEADER.size + size + 2), segment_bytes=1)  # pylint: disable=protected-access
+    assert spooled.evicted == 2
+    chronicle = _Chronicle()
+    spooled.drain(chronicle.submit, chronicle.wait)
+    assert chronicle.sent == [2, 3, 4, 5]
@@ -0,0 +1,63 @@
+import json
+
+import pytest
+
+import streaming
+
+BODY = b'{"more": true, "objects": [1.5, 2, -3e+10, {"a": [1, "\\u00e9"]}, "x", true, null], "next": "n"}'
+
+
+def _chunks(body, size):
+    return [body[i:i + size] for i in range(0, len(body), size)]
+
+
+@pytest.mark.parametrize("size", range(1, 12))
+def test_values_split_across_chunks(size):
+    page = streaming.PageStream(_chunks(BODY, size))
+    assert list(page) == json.loads(BODY)["objects"]
+    assert page.more and page.next == "n"
+    assert page.count == 7 and page.bytes == len(BODY)
+
+
+def test_fields_after_the_objects_are_read():
+    page = streaming.PageStream([b'{"objects": [], "next": "n", "more": false}'])
+    assert list(page) == []
+    assert not page.more and page.next == "n"
+
+
+def test_number_split_in_its_fraction():
+    body = b'{"objects": [1.5, 2], "more": true}'
+    for size in (1, 3):
+        assert list(streaming.PageStream(_chunks(body, size))) == [1.5, 2]
+
+
+class _Cut(Exception):
+    pass
+
+
+def _cut(body, after):
+    yield body[:after]
+    raise _Cut("connection broken")
+
+
+def test_body_cut_short_is_downloaded_again():
+    reopened = []
+    def reopen():
+        reopened.append(True)
+        return _chunks(BODY, 5)
+    page = streaming.PageStream(_cut(BODY, 40), reopen=reopen, retry_on=(_Cut,), attempts=2)
+    assert list(page) == json.loads(BODY)["objects"]
+    assert len(reopened) == 1 and page.next == "n"
+
+
+def test_last_read_error_is_raised():
+    page = streaming.PageStream(_cut(BODY, 40), reopen=lambda: _cut(BODY, 40),
+                                retry_on=(_Cut,), attempts=2)
+    with pytest.raises(_Cut):
+        list(page)
+
+
+def test_malformed_body_is_not_retried():
+    page = streaming.PageStream([b'{"objects": [1 2]}'], reopen=lambda: [], retry_on=(_Cut,), attempts=3)
+    with pytest.raises(ValueError):
+        list(page)
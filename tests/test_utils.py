@@ -0,0 +1,64 @@
+import json
+
+import pytest
+
+from utils import batch_overhead, join_batches, pack_entities
+
+ENTITIES = [{"i": i, "value": "é" * (i % 7) + "x" * (i * 13 % 50)} for i in range(40)]
+
+
+@pytest.mark.parametrize("max_size", [200, 500, 1000, 1 << 20])
+def test_bodies_stay_within_max_size(max_size):
+    batches = list(pack_entities(ENTITIES, "customer", max_size))
+    assert all(len(batch.body) <= max_size for batch in batches)
+    assert sum(batch.count for batch in batches) == len(ENTITIES)
+
+
+def test_bodies_round_trip():
+    batches = list(pack_entities(ENTITIES, "customer", 300, log_type="STIX"))
+    entities = []
+    for batch in batches:
+        body = json.loads(batch.body)
+        assert body["customer_id"] == "customer" and body["log_type"] == "STIX"
+        assert len(body["entities"]) == batch.count
+        entities.extend(body["entities"])
+    assert entities == ENTITIES
+
+
+def test_bodies_are_filled():
+    batches = list(pack_entities(ENTITIES, "customer", 300))
+    # a body is only closed when the next entity does not fit in it
+    for batch, following in zip(batches, batches[1:]):
+        first = json.dumps(json.loads(following.body)["entities"][0], ensure_ascii=False,
+                           separators=(",", ":")).encode("utf-8")
+        assert len(batch.body) + 1 + len(first) > 300
+
+
+def test_joined_bodies_hold_the_entities_and_keys_in_order():
+    batches = list(pack_entities(ENTITIES, "customer", 300, key=lambda entity: entity["i"]))
+    joined = join_batches(batches)
+    assert json.loads(joined.body) == json.loads(next(pack_entities(ENTITIES, "customer", 1 << 20)).body)
+    assert joined.count == len(ENTITIES)
+    assert joined.keys == tuple(range(len(ENTITIES)))
+
+
+def test_joined_body_size_is_the_bodies_less_their_envelopes_but_one():
+    first, second = (next(pack_entities([entity], "customer", 1 << 20)) for entity in ENTITIES[1:3])
+    joined = join_batches([first, second])
+    assert len(joined.body) == len(first.body) + len(second.body) - batch_overhead(second) + 1
+    assert join_batches([first]) is first
+
+
+def test_oversize_entities_are_skipped_and_counted():
+    oversize = {"i": "oversize", "value": "x" * 300}
+    entities = ENTITIES[:5] + [oversize] + ENTITIES[5:10] + [oversize, oversize] + ENTITIES[10:20]
+    batches = list(pack_entities(entities, "customer", 300))
+    assert [entity for batch in batches for entity in json.loads(batch.body)["entities"]] == ENTITIES[:20]
+    assert sum(batch.skipped for batch in batches) == 3
+    # the position after a batch counts the entities skipped before it
+    position = 0
+    for batch in batches:
+        position += batch.skipped + batch.count
+        last = json.loads(batch.body)["entities"][-1]
+        assert entities[position - 1] == last
+    assert position == len(entities)